@@ -0,0 +1,4 @@
+from asyncmatrix.client import AsyncMatrixClient, MatrixError, MatrixHttpError, MatrixRequestError
+from asyncmatrix.names import DisplayNameCache
+from asyncmatrix.outbox import Outbox
+from asyncmatrix.session import SessionStore
@@ -0,0 +1,384 @@
+"""
+client.py
+Purpose: Minimal asyncio Matrix client-server API client.
+
+Covers what the bridge needs: password login, joining rooms, syncing and
+sending messages. All requests share one aiohttp session, so the connection
+to the homeserver is pooled and kept alive between requests.
+"""
+
+import asyncio
+import itertools
+import logging
+import time
+
+from urllib.parse import quote, urlparse
+
+import aiohttp
+
+from asyncmatrix.names import DisplayNameCache
+
+log = logging.getLogger(__name__)
+
+
+def _endpoint(path):
+    """
+    Reduce a request path to a label without IDs in it, e.g. "rooms/send".
+    """
+
+    parts = path.split("/")
+    if parts[1] == "rooms" and len(parts) > 3:
+        return "rooms/" + parts[3]
+    return parts[1]
+
+
+class MatrixError(Exception):
+    """
+    Base class for errors raised by AsyncMatrixClient.
+    """
+
+
+class MatrixRequestError(MatrixError):
+    """
+    The homeserver answered with an error status.
+    """
+
+    def __init__(self, code, content=""):
+        super().__init__("{}: {}".format(code, content))
+        self.code = code
+        self.content = content
+
+
+class MatrixHttpError(MatrixError):
+    """
+    The request did not get an answer from the homeserver.
+    """
+
+
+class AsyncMatrixClient:
+    """
+    Represents a session with a Matrix homeserver.
+    """
+
+    api_path = "/_matrix/client/r0"
+    media_path = "/_matrix/media/r0"
+
+    def __init__(self, base_url, token=None, user_id=None, pool_size=8, request_timeout=60):
+        o = urlparse(base_url)
+        if o.scheme not in ("http", "https") or not o.netloc:
+            raise ValueError("Bad homeserver URL: {!r}".format(base_url))
+
+        self.base_url = base_url.rstrip("/")
+        self.token = token
+        self.user_id = user_id
+        self.device_id = None
+        self.sync_token = None
+        self.pool_size = pool_size
+        self.request_timeout = request_timeout
+        self.listeners = []
+        self.room_listeners = {}
+        self.listener_task = None
+        self.bad_sync_timeout_limit = 60
+        self.display_names = DisplayNameCache()
+        # Called as request_observer(method, endpoint, status, seconds) after every request.
+        self.request_observer = None
+        # Called as sync_observer(response) once a sync response has been handled.
+        self.sync_observer = None
+
+        self._session = None
+        self._txn_ids = itertools.count()
+        self._txn_prefix = str(int(time.time() * 1000))
+
+    # HTTP helpers
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=75)
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    async def _send(self, method, path, content=None, query=None, api_path=None, timeout=None, raw=False,
+                    max_bytes=None):
+        """
+        Perform one API request and return the decoded JSON response, or with
+        raw the body and its content type. A raw body over max_bytes raises
+        ValueError without being read further.
+        """
+
+        url = self.base_url + (self.api_path if api_path is None else api_path) + path
+        headers = {}
+        if self.token:
+            headers["Authorization"] = "Bearer {}".format(self.token)
+        if timeout is None:
+            timeout = self.request_timeout
+
+        started = time.monotonic()
+        status = "error"
+        try:
+            async with self._get_session().request(method, url, json=content, params=query, headers=headers,
+                                                   timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+                status = response.status
+                if response.status >= 400:
+                    raise MatrixRequestError(response.status, await response.text())
+                if raw:
+                    return await self._read_body(response, max_bytes), response.headers.get("Content-Type")
+                return await response.json(content_type=None)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise MatrixHttpError("{} {} failed: {!r}".format(method, path, e)) from e
+        finally:
+            if self.request_observer is not None:
+                self.request_observer(method, _endpoint(path), status, time.monotonic() - started)
+
+    @staticmethod
+    async def _read_body(response, max_bytes):
+        if max_bytes is None:
+            return await response.read()
+        if response.content_length is not None and response.content_length > max_bytes:
+            raise ValueError("Body is {} bytes, more than {}".format(response.content_length, max_bytes))
+        body = bytearray()
+        async for chunk in response.content.iter_chunked(65536):
+            body += chunk
+            if len(body) > max_bytes:
+                raise ValueError("Body is more than {} bytes".format(max_bytes))
+        return bytes(body)
+
+    async def close(self):
+        """
+        Stop listening and release the pooled connections.
+        """
+
+        task = self.listener_task
+        self.stop_listener()
+        if task is not None:
+            await asyncio.gather(task, return_exceptions=True)
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    # API calls
+
+    async def login(self, username, password, device_id=None):
+        """
+        Log in with a password and remember the access token.
+        """
+
+        content = {
+            "type": "m.login.password",
+            "identifier": {"type": "m.id.user", "user": username},
+            "user": username,
+            "password": password,
+        }
+        if device_id:
+            content["device_id"] = device_id
+
+        response = await self._send("POST", "/login", content)
+        self.token = response["access_token"]
+        self.user_id = response["user_id"]
+        self.device_id = response.get("device_id")
+        return response
+
+    async def whoami(self):
+        """
+        Return the user ID the access token belongs to. Raises
+        MatrixRequestError with code 401 if the token is not valid (any more).
+        """
+
+        response = await self._send("GET", "/account/whoami")
+        self.user_id = response["user_id"]
+        return self.user_id
+
+    async def create_filter(self, filter):
+        """
+        Upload a sync filter and return its ID, for use with sync(filter=...).
+        """
+
+        path = "/user/{}/filter".format(quote(self.user_id, safe=""))
+        response = await self._send("POST", path, filter)
+        return response["filter_id"]
+
+    async def join_room(self, room_id_or_alias):
+        """
+        Join a room by ID or alias and return its room ID.
+        """
+
+        response = await self._send("POST", "/join/{}".format(quote(room_id_or_alias, safe="")), {})
+        return response.get("room_id", room_id_or_alias)
+
+    async def sync(self, timeout_ms=30000, filter=None, full_state=False, dispatch=True):
+        """
+        Fetch new events since the last sync and hand them to the listeners.
+        """
+
+        query = {"timeout": str(timeout_ms)}
+        if self.sync_token:
+            query["since"] = self.sync_token
+        if filter:
+            query["filter"] = filter
+        if full_state:
+            query["full_state"] = "true"
+
+        response = await self._send("GET", "/sync", query=query, timeout=timeout_ms / 1000 + self.request_timeout)
+        self.sync_token = response["next_batch"]
+        self._update_state(response)
+        if dispatch:
+            await self._dispatch_sync(response)
+        if self.sync_observer is not None:
+            self.sync_observer(response)
+        return response
+
+    def new_txn_id(self):
+        """
+        Return a transaction ID no other event sent by this client uses.
+        """
+
+        return "{}{}".format(self._txn_prefix, next(self._txn_ids))
+
+    async def send_message(self, room_id, content, event_type="m.room.message", txn_id=None):
+        """
+        Send an event to a room.
+
+        Sending again with the same txn_id does not create a second event, so
+        a retry should reuse the ID of the attempt it repeats.
+        """
+
+        if txn_id is None:
+            txn_id = self.new_txn_id()
+        path = "/rooms/{}/send/{}/{}".format(quote(room_id, safe=""), event_type, quote(txn_id, safe=""))
+        return await self._send("PUT", path, content)
+
+    async def send_text(self, room_id, text):
+        return await self.send_message(room_id, {"msgtype": "m.text", "body": text})
+
+    async def send_emote(self, room_id, text):
+        return await self.send_message(room_id, {"msgtype": "m.emote", "body": text})
+
+    async def get_display_name(self, user_id, room_id=None):
+        """
+        Return the display name of a user, or their ID if they have none.
+
+        With a room ID the name the user has in that room is returned. It is
+        served from display_names whenever possible, which membership events
+        from the sync stream keep up to date.
+        """
+
+        if room_id is None:
+            return await self._get_profile_name(user_id)
+
+        name = self.display_names.get(room_id, user_id)
+        if name is not None:
+            return name
+
+        path = "/rooms/{}/state/m.room.member/{}".format(quote(room_id, safe=""), quote(user_id, safe=""))
+        try:
+            response = await self._send("GET", path)
+            name = response.get("displayname") or user_id
+        except MatrixRequestError as e:
+            if e.code not in (403, 404):
+                raise
+            name = await self._get_profile_name(user_id)
+
+        self.display_names.set(room_id, user_id, name)
+        return name
+
+    async def _get_profile_name(self, user_id):
+        try:
+            response = await self._send("GET", "/profile/{}/displayname".format(quote(user_id, safe="")))
+        except MatrixRequestError as e:
+            if e.code == 404:
+                return user_id
+            raise
+        return response.get("displayname") or user_id
+
+    async def download(self, mxc_url, max_bytes=None):
+        """
+        Fetch the file behind an mxc:// URI. Returns its bytes and content type.
+        Files over max_bytes raise ValueError, checked against Content-Length
+        and while reading, so they are never held in memory whole.
+        """
+
+        o = urlparse(mxc_url)
+        if o.scheme != "mxc" or not o.netloc or not o.path.strip("/"):
+            raise ValueError("Bad mxc URI: {!r}".format(mxc_url))
+        path = "/download/{}/{}".format(quote(o.netloc, safe=""), quote(o.path.strip("/"), safe=""))
+        return await self._send("GET", path, api_path=self.media_path, raw=True, max_bytes=max_bytes)
+
+    def media_url(self, mxc_url):
+        """
+        Return the homeserver's public download URL for an mxc:// URI.
+        """
+
+        o = urlparse(mxc_url)
+        return "{}{}/download/{}/{}".format(self.base_url, self.media_path, o.netloc, o.path.strip("/"))
+
+    # Listening
+
+    def add_listener(self, callback):
+        """
+        Call callback(room_id, event) for timeline events of every joined room.
+        Coroutine functions are awaited before the next event is handled.
+        """
+
+        self.listeners.append(callback)
+
+    def add_room_listener(self, room_id, callback):
+        """
+        Call callback(room_id, event) for timeline events of one room.
+        """
+
+        self.room_listeners.setdefault(room_id, []).append(callback)
+
+    def _update_state(self, response):
+        """
+        Feed membership changes from a sync response into display_names.
+        """
+
+        for room_id, room in response.get("rooms", {}).get("join", {}).items():
+            for section in ("state", "timeline"):
+                for event in room.get(section, {}).get("events", []):
+                    if event.get("type") == "m.room.member":
+                        self.display_names.handle_member_event(room_id, event)
+        for room_id in response.get("rooms", {}).get("leave", {}):
+            self.display_names.discard_room(room_id)
+
+    async def _dispatch_sync(self, response):
+        for room_id, room in response.get("rooms", {}).get("join", {}).items():
+            for event in room.get("timeline", {}).get("events", []):
+                event["room_id"] = room_id
+                for callback in self.listeners + self.room_listeners.get(room_id, []):
+                    result = callback(room_id, event)
+                    if asyncio.iscoroutine(result):
+                        await result
+
+    async def listen_forever(self, timeout_ms=30000, filter=None):
+        """
+        Keep syncing, backing off while the homeserver is unreachable.
+        """
+
+        bad_sync_timeout = 5
+        while True:
+            try:
+                await self.sync(timeout_ms, filter)
+                bad_sync_timeout = 5
+            except asyncio.CancelledError:
+                raise
+            except MatrixError as e:
+                log.warning("Sync failed, retrying in {}s: {}".format(bad_sync_timeout, e))
+                await asyncio.sleep(bad_sync_timeout)
+                bad_sync_timeout = min(bad_sync_timeout * 2, self.bad_sync_timeout_limit)
+            except Exception:
+                log.exception("Exception while handling sync, retrying in {}s".format(bad_sync_timeout))
+                await asyncio.sleep(bad_sync_timeout)
+                bad_sync_timeout = min(bad_sync_timeout * 2, self.bad_sync_timeout_limit)
+
+    def start_listener(self, timeout_ms=30000, filter=None):
+        """
+        Run listen_forever as a task on the running event loop.
+        """
+
+        self.listener_task = asyncio.ensure_future(self.listen_forever(timeout_ms, filter))
+        return self.listener_task
+
+    def stop_listener(self):
+        if self.listener_task is not None:
+            self.listener_task.cancel()
+            self.listener_task = None
@@ -0,0 +1,108 @@
+"""
+echo.py
+Purpose: Recognise relayed messages coming back through another bridge.
+"""
+
+import re
+import time
+
+# "<name> " or "[name] " in front of a relayed message
+_prefix = re.compile(r"\s*(?:<([^<>]{1,64})>|\[([^\[\]]{1,64})\])\s+")
+
+
+def split_relayed(author, text):
+    """
+    Strip the relay prefixes from text and return the innermost author and
+    the rest, so "<glenda> <bob> hi" said by otherbot gives ("bob", "hi").
+    """
+
+    while True:
+        match = _prefix.match(text)
+        if match is None or match.end() == len(text):
+            return author, text
+        author = match.group(1) or match.group(2)
+        text = text[match.end():]
+
+
+class _Ring:
+    __slots__ = ("entries", "position", "index")
+
+    def __init__(self, size):
+        self.entries = [None] * size
+        self.position = 0
+        # fingerprint -> when it was last recorded
+        self.index = {}
+
+
+class EchoLedger:
+    """
+    Remembers the last size messages relayed in each room, by a fingerprint
+    of their original author and text, for window seconds.
+
+    A message that carries a relay prefix ("<name> text") and matches one of
+    them is another bridge or relay bot sending back something we relayed,
+    and relaying it again would start a loop. Plain messages are never
+    echoes, so people repeating themselves still get through.
+
+    Memory is fixed at size entries per room. Messages over the lobby's line
+    length come back in pieces and are not recognised.
+    """
+
+    def __init__(self, size=256, window=30, clock=time.monotonic):
+        self.size = size
+        self.window = window
+        self.clock = clock
+        self.rooms = {}
+        self.checked = 0
+        self.suppressed = 0
+        # room -> echoes suppressed there
+        self.suppressed_by_room = {}
+
+    @staticmethod
+    def fingerprint(author, text):
+        return hash((author.casefold(), " ".join(text.split()).casefold()))
+
+    def record(self, room, author, text):
+        """
+        Remember that text by author was relayed in room.
+        """
+
+        ring = self.rooms.get(room)
+        if ring is None:
+            ring = self.rooms[room] = _Ring(self.size)
+        now = self.clock()
+        fingerprint = self.fingerprint(*split_relayed(author, text))
+
+        old = ring.entries[ring.position]
+        if old is not None and ring.index.get(old[1]) == old[0]:
+            del ring.index[old[1]]
+        ring.entries[ring.position] = (now, fingerprint)
+        ring.index[fingerprint] = now
+        ring.position = (ring.position + 1) % self.size
+
+    def is_echo(self, room, author, text):
+        """
+        Return True if text said by author in room is something relayed there
+        within the last window seconds, coming back with a relay prefix.
+        """
+
+        self.checked += 1
+        original, rest = split_relayed(author, text)
+        ring = self.rooms.get(room)
+        if ring is None or rest is text:
+            return False
+        recorded = ring.index.get(self.fingerprint(original, rest))
+        if recorded is None or self.clock() - recorded > self.window:
+            return False
+        self.suppressed += 1
+        self.suppressed_by_room[room] = self.suppressed_by_room.get(room, 0) + 1
+        return True
+
+    def stats(self):
+        return {
+            "rooms": len(self.rooms),
+            "entries": sum(len(ring.index) for ring in self.rooms.values()),
+            "checked": self.checked,
+            "suppressed": self.suppressed,
+            "hit_rate": self.suppressed / self.checked if self.checked else 0.0,
+        }
@@ -0,0 +1,217 @@
+"""
+ingress.py
+Purpose: Bounded handoff of events into the asyncio event loop.
+"""
+
+import asyncio
+import collections
+import logging
+import threading
+import time
+import weakref
+
+from asyncspring import metrics
+
+log = logging.getLogger(__name__)
+
+BLOCK = "block"
+DROP_OLDEST = "drop-oldest"
+DROP_NEWEST = "drop-newest"
+
+policies = (BLOCK, DROP_OLDEST, DROP_NEWEST)
+
+_instances = weakref.WeakSet()
+
+
+def _dropped():
+    values = {}
+    for ingress in list(_instances):
+        for which, count in (("oldest", ingress.dropped_oldest), ("newest", ingress.dropped_newest)):
+            values[(ingress.name, which)] = values.get((ingress.name, which), 0) + count
+    return values
+
+
+def _handled():
+    values = {}
+    for ingress in list(_instances):
+        values[(ingress.name,)] = values.get((ingress.name,), 0) + ingress.handled
+    return values
+
+
+metrics.gauge("asyncmatrix_ingress_depth", "Items waiting in an ingress queue", ["ingress"],
+              lambda: {(ingress.name,): len(ingress.queue) for ingress in list(_instances)})
+metrics.counter("asyncmatrix_ingress_handled_total", "Items handled from an ingress queue", ["ingress"], _handled)
+metrics.counter("asyncmatrix_ingress_dropped_total", "Items dropped by an ingress overflow policy",
+                ["ingress", "dropped"], _dropped)
+enqueue_latency = metrics.histogram("asyncmatrix_ingress_enqueue_seconds",
+                                    "Time from submit() until an item is in the queue", ["ingress"])
+queue_wait = metrics.histogram("asyncmatrix_ingress_wait_seconds",
+                               "Time items spent in an ingress queue before being handled", ["ingress"])
+
+
+class Ingress:
+    """
+    Bounded queue between event producers and a handler running on the loop.
+
+    submit() may be called from any thread; items submitted off the loop reach
+    it through call_soon_threadsafe. A single consumer task calls
+    handler(*args) for each item in submission order, awaiting it if it
+    returns a coroutine.
+
+    When maxsize items are waiting, the overflow policy decides what happens:
+    "block" makes the producer wait for room, "drop-oldest" discards the item
+    that has waited longest and "drop-newest" discards the new one.
+    """
+
+    def __init__(self, handler, maxsize=1000, policy=DROP_OLDEST, loop=None, clock=time.monotonic, name="ingress"):
+        if policy not in policies:
+            raise ValueError("Unknown overflow policy {!r}".format(policy))
+
+        self.handler = handler
+        # label of this queue's metrics
+        self.name = name
+        self.maxsize = maxsize
+        self.policy = policy
+        self.loop = loop or asyncio.get_event_loop()
+        self.clock = clock
+        self.queue = collections.deque()
+        self.task = None
+
+        self.submitted = 0
+        self.handled = 0
+        self.dropped_oldest = 0
+        self.dropped_newest = 0
+        self.enqueue_latency_total = 0.0
+        self.enqueue_latency_max = 0.0
+        self.queue_wait_total = 0.0
+        self.queue_wait_max = 0.0
+
+        self._loop_thread = None
+        self._ready = asyncio.Event()
+        self._space = asyncio.Event()
+        # Only used by the block policy; counts free slots across threads.
+        self._slots = threading.Semaphore(maxsize)
+        _instances.add(self)
+
+    def __len__(self):
+        return len(self.queue)
+
+    def submit(self, *args):
+        """
+        Hand an item to the loop. Safe to call from any thread.
+        """
+
+        submitted = self.clock()
+        if threading.get_ident() == self._loop_thread:
+            if self.policy == BLOCK and not self._slots.acquire(blocking=False):
+                # Blocking the loop would deadlock the consumer; wait in a task.
+                asyncio.ensure_future(self._put_blocking(submitted, args))
+                return
+            self._put(submitted, args)
+            return
+
+        if self.policy == BLOCK:
+            self._slots.acquire()
+        self.loop.call_soon_threadsafe(self._put, submitted, args)
+
+    async def put(self, *args):
+        """
+        Hand an item over from a coroutine running on the loop.
+        """
+
+        submitted = self.clock()
+        if self.policy == BLOCK and not self._slots.acquire(blocking=False):
+            await self._put_blocking(submitted, args)
+        else:
+            self._put(submitted, args)
+
+    async def _put_blocking(self, submitted, args):
+        while not self._slots.acquire(blocking=False):
+            self._space.clear()
+            await self._space.wait()
+        self._put(submitted, args)
+
+    def _put(self, submitted, args):
+        now = self.clock()
+        latency = now - submitted
+        self.submitted += 1
+        self.enqueue_latency_total += latency
+        if latency > self.enqueue_latency_max:
+            self.enqueue_latency_max = latency
+        if metrics.enabled:
+            enqueue_latency.observe(latency, self.name)
+
+        if self.policy != BLOCK and len(self.queue) >= self.maxsize:
+            if self.policy == DROP_NEWEST:
+                self.dropped_newest += 1
+                return
+            self.queue.popleft()
+            self.dropped_oldest += 1
+
+        self.queue.append((now, args))
+        self._ready.set()
+
+    async def run(self):
+        """
+        Consume queued items forever.
+        """
+
+        self._loop_thread = threading.get_ident()
+        while True:
+            if not self.queue:
+                self._ready.clear()
+                await self._ready.wait()
+                continue
+
+            enqueued, args = self.queue.popleft()
+            if self.policy == BLOCK:
+                self._slots.release()
+                self._space.set()
+
+            wait = self.clock() - enqueued
+            self.queue_wait_total += wait
+            if wait > self.queue_wait_max:
+                self.queue_wait_max = wait
+            if metrics.enabled:
+                queue_wait.observe(wait, self.name)
+
+            try:
+                result = self.handler(*args)
+                if asyncio.iscoroutine(result):
+                    await result
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception("Exception while handling {!r}".format(args))
+            self.handled += 1
+
+    def start(self):
+        """
+        Run the consumer as a task on the loop.
+        """
+
+        self._loop_thread = threading.get_ident()
+        self.task = asyncio.ensure_future(self.run())
+        return self.task
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    def stats(self):
+        """
+        Return queue depth, drop counters and latencies.
+        """
+
+        return {
+            "depth": len(self.queue),
+            "submitted": self.submitted,
+            "handled": self.handled,
+            "dropped_oldest": self.dropped_oldest,
+            "dropped_newest": self.dropped_newest,
+            "enqueue_latency_mean": self.enqueue_latency_total / self.submitted if self.submitted else 0.0,
+            "enqueue_latency_max": self.enqueue_latency_max,
+            "queue_wait_mean": self.queue_wait_total / self.handled if self.handled else 0.0,
+            "queue_wait_max": self.queue_wait_max,
+        }
@@ -0,0 +1,341 @@
+"""
+media.py
+Purpose: Cache Matrix media on disk and serve it over short HTTP links.
+"""
+
+import asyncio
+import base64
+import collections
+import hashlib
+import logging
+import os
+import re
+
+from aiohttp import web
+
+from asyncmatrix.client import MatrixError
+
+log = logging.getLogger(__name__)
+
+# Media types shown in the browser; everything else is served as a download.
+inline_types = frozenset([
+    "image/png", "image/jpeg", "image/gif", "image/webp",
+    "video/mp4", "video/webm", "video/ogg",
+    "audio/mpeg", "audio/ogg", "audio/webm", "audio/mp4", "audio/wav",
+    "text/plain",
+])
+
+# mxc://<server name>/<media ID>, as the Matrix spec allows them
+mxc_pattern = re.compile(r"mxc://[A-Za-z0-9.\-]+(?::[0-9]{1,5})?/[A-Za-z0-9_\-]+\Z")
+content_type_pattern = re.compile(r"[A-Za-z0-9!#$&^_.+\-]+/[A-Za-z0-9!#$&^_.+\-]+\Z")
+
+
+class MediaCache:
+    """
+    Files stored under the SHA-256 of their content, so media posted more
+    than once is kept once. Holds at most max_bytes; the least recently used
+    files are deleted to make room. Files already in directory are adopted
+    on startup, oldest first.
+    """
+
+    def __init__(self, directory, max_bytes=256 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.files = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        os.makedirs(directory, exist_ok=True)
+        found = []
+        for entry in os.scandir(directory):
+            if entry.is_file() and len(entry.name) == 64:
+                stat = entry.stat()
+                found.append((stat.st_mtime, entry.name, stat.st_size))
+        for mtime, digest, size in sorted(found):
+            self.files[digest] = size
+            self.size += size
+        self._remove(self._evict())
+
+    def __len__(self):
+        return len(self.files)
+
+    def path(self, digest):
+        return os.path.join(self.directory, digest)
+
+    def get(self, digest):
+        """
+        Return the path of a cached file, or None.
+        """
+
+        if digest not in self.files:
+            self.misses += 1
+            return None
+        self.files.move_to_end(digest)
+        self.hits += 1
+        return self.path(digest)
+
+    async def put(self, data):
+        """
+        Store data and return its digest. Hashing and file I/O run in the
+        default executor, off the event loop.
+        """
+
+        loop = asyncio.get_event_loop()
+        digest = await loop.run_in_executor(None, self._write, data)
+        if digest in self.files:
+            self.files.move_to_end(digest)
+            return digest
+        self.files[digest] = len(data)
+        self.size += len(data)
+        victims = self._evict(keep=digest)
+        if victims:
+            await loop.run_in_executor(None, self._remove, victims)
+        return digest
+
+    def _write(self, data):
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path(digest)
+        if not os.path.exists(path):
+            tmp = "{}.{}.tmp".format(path, id(data))
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        return digest
+
+    def _evict(self, keep=None):
+        """
+        Forget least recently used files until the cache fits in max_bytes
+        and return their digests for _remove().
+        """
+
+        victims = []
+        while self.size > self.max_bytes and self.files:
+            digest, size = next(iter(self.files.items()))
+            if digest == keep:
+                break
+            del self.files[digest]
+            self.size -= size
+            self.evictions += 1
+            victims.append(digest)
+        return victims
+
+    def _remove(self, digests):
+        for digest in digests:
+            # It may have been stored again since it was evicted.
+            if digest in self.files:
+                continue
+            try:
+                os.remove(self.path(digest))
+            except OSError:
+                pass
+
+    def stats(self):
+        return {"files": len(self.files), "bytes": self.size, "hits": self.hits, "misses": self.misses,
+                "evictions": self.evictions}
+
+
+class MediaRelay:
+    """
+    Hands out short links for mxc:// URIs and serves them from a MediaCache,
+    downloading each file from the homeserver the first time it is asked for.
+
+    A link is base_url + "/m/" + an 11 character token derived from the mxc
+    URI. Tokens are appended to an index file from the default executor, so
+    links keep working after a restart; at most max_links are remembered.
+    """
+
+    def __init__(self, client, cache, base_url, max_links=100000, max_file_bytes=32 * 1024 * 1024):
+        self.client = client
+        self.cache = cache
+        self.base_url = base_url.rstrip("/")
+        self.max_links = max_links
+        self.max_file_bytes = max_file_bytes
+        # token -> [mxc URI, content digest or None, content type or None]
+        self.links = collections.OrderedDict()
+        self.downloads = 0
+        self.failures = 0
+        self.index_path = os.path.join(cache.directory, "index")
+        self._fetching = {}
+        self._runner = None
+        self._index_lines = 0
+        # index lines not written yet, and the task writing them
+        self._unwritten = []
+        self._index_writer = None
+        self._load_index()
+
+    @staticmethod
+    def token(mxc_url):
+        return base64.urlsafe_b64encode(hashlib.sha256(mxc_url.encode("utf-8")).digest()[:8]).decode().rstrip("=")
+
+    def link(self, mxc_url, prefetch=False):
+        """
+        Return the short link for an mxc:// URI. With prefetch, start
+        downloading it right away so the first visitor does not wait.
+        Raises ValueError if mxc_url is not a valid mxc:// URI.
+        """
+
+        if not mxc_pattern.match(mxc_url):
+            raise ValueError("Not an mxc:// URI: {!r}".format(mxc_url))
+        token = self.token(mxc_url)
+        if token not in self.links:
+            self._remember(token, mxc_url, None, None)
+        else:
+            self.links.move_to_end(token)
+        if prefetch and self.links[token][1] is None:
+            asyncio.ensure_future(self._prefetch(token))
+        return "{}/m/{}".format(self.base_url, token)
+
+    async def fetch(self, token):
+        """
+        Return the cached path and content type for a token, downloading the
+        file first if needed. Returns None for unknown tokens.
+        """
+
+        entry = self.links.get(token)
+        if entry is None:
+            return None
+        mxc_url, digest, content_type = entry
+        if digest is not None:
+            path = self.cache.get(digest)
+            if path is not None:
+                return path, content_type
+
+        # Concurrent requests for the same file share one download.
+        future = self._fetching.get(token)
+        if future is None:
+            future = self._fetching[token] = asyncio.ensure_future(self._download(token, mxc_url))
+            future.add_done_callback(lambda f: self._fetching.pop(token, None))
+        return await asyncio.shield(future)
+
+    async def _download(self, token, mxc_url):
+        data, content_type = await self.client.download(mxc_url, max_bytes=self.max_file_bytes)
+        self.downloads += 1
+        content_type = (content_type or "").split(";", 1)[0].strip().lower()
+        if not content_type_pattern.match(content_type):
+            content_type = None
+        digest = await self.cache.put(data)
+        self._remember(token, mxc_url, digest, content_type)
+        return self.cache.path(digest), content_type
+
+    async def _prefetch(self, token):
+        try:
+            await self.fetch(token)
+        except (MatrixError, ValueError, OSError) as e:
+            self.failures += 1
+            log.warning("Could not prefetch {}: {}".format(self.links[token][0], e))
+
+    def _remember(self, token, mxc_url, digest, content_type):
+        self.links[token] = [mxc_url, digest, content_type]
+        self.links.move_to_end(token)
+        while len(self.links) > self.max_links:
+            self.links.popitem(last=False)
+        self._unwritten.append(self._index_line(token, mxc_url, digest, content_type))
+        if self._index_writer is None:
+            self._index_writer = asyncio.ensure_future(self._write_index())
+
+    async def _write_index(self):
+        """
+        Append remembered links to the index until none are left unwritten,
+        compacting it once it holds twice as many lines as links.
+        """
+
+        loop = asyncio.get_event_loop()
+        try:
+            while self._unwritten:
+                lines, self._unwritten = self._unwritten, []
+                try:
+                    if self._index_lines + len(lines) > 2 * max(len(self.links), 1000):
+                        # The snapshot already holds the unwritten lines' links.
+                        await loop.run_in_executor(None, self._compact, list(self.links.items()))
+                    else:
+                        await loop.run_in_executor(None, self._append, lines)
+                except OSError as e:
+                    log.warning("Could not write media index {}: {}".format(self.index_path, e))
+        finally:
+            self._index_writer = None
+
+    @staticmethod
+    def _index_line(token, mxc_url, digest, content_type):
+        return "{}\t{}\t{}\t{}\n".format(token, mxc_url, digest or "-", content_type or "-")
+
+    def _append(self, lines):
+        with open(self.index_path, "a") as f:
+            f.writelines(lines)
+        self._index_lines += len(lines)
+
+    def _load_index(self):
+        try:
+            with open(self.index_path) as f:
+                for line in f:
+                    parts = line.rstrip("\n").split("\t")
+                    if len(parts) != 4:
+                        continue
+                    token, mxc_url, digest, content_type = parts
+                    # Skip anything a damaged or tampered index holds.
+                    if not mxc_pattern.match(mxc_url) or self.token(mxc_url) != token:
+                        continue
+                    self.links[token] = [mxc_url, None if digest == "-" else digest,
+                                         None if content_type == "-" else content_type]
+                    self.links.move_to_end(token)
+        except FileNotFoundError:
+            return
+        while len(self.links) > self.max_links:
+            self.links.popitem(last=False)
+        self._compact(list(self.links.items()))
+
+    def _compact(self, links):
+        """
+        Rewrite the index with one line per (token, entry) in links.
+        """
+
+        tmp = self.index_path + ".tmp"
+        with open(tmp, "w") as f:
+            for token, (mxc_url, digest, content_type) in links:
+                f.write(self._index_line(token, mxc_url, digest, content_type))
+        os.replace(tmp, self.index_path)
+        self._index_lines = len(links)
+
+    async def _handle(self, request):
+        try:
+            found = await self.fetch(request.match_info["token"])
+        except (MatrixError, ValueError, OSError) as e:
+            self.failures += 1
+            log.warning("Could not fetch {}: {}".format(request.match_info["token"], e))
+            raise web.HTTPBadGateway()
+        if found is None:
+            raise web.HTTPNotFound()
+        path, content_type = found
+        headers = {
+            "Cache-Control": "public, max-age=31536000, immutable",
+            "X-Content-Type-Options": "nosniff",
+            "Content-Security-Policy": "default-src 'none'; sandbox",
+        }
+        content_type = (content_type or "").split(";", 1)[0].strip().lower()
+        if content_type in inline_types:
+            headers["Content-Type"] = content_type
+        else:
+            # Anything else, HTML and SVG included, could run script on our origin.
+            headers["Content-Type"] = "application/octet-stream"
+            headers["Content-Disposition"] = "attachment"
+        return web.FileResponse(path, headers=headers)
+
+    async def start(self, host="127.0.0.1", port=8009):
+        app = web.Application()
+        app.router.add_get("/m/{token}", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+        if self._index_writer is not None:
+            await self._index_writer
+
+    def stats(self):
+        stats = self.cache.stats()
+        stats.update(links=len(self.links), downloads=self.downloads, failures=self.failures)
+        return stats
@@ -0,0 +1,80 @@
+"""
+names.py
+Purpose: Per-room display-name cache fed from m.room.member events.
+"""
+
+import collections
+import time
+
+
+class DisplayNameCache:
+    """
+    LRU cache of (room ID, user ID) -> display name.
+
+    Holds at most max_size entries; an entry is dropped ttl seconds after it
+    was last set, so names are refetched now and then even if a membership
+    event was missed.
+    """
+
+    def __init__(self, max_size=10000, ttl=3600, clock=time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, room_id, user_id):
+        """
+        Return the cached display name, or None if unknown or expired.
+        """
+
+        key = (room_id, user_id)
+        entry = self.entries.get(key)
+        if entry is None or entry[1] < self.clock():
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def set(self, room_id, user_id, name):
+        key = (room_id, user_id)
+        self.entries[key] = (name, self.clock() + self.ttl)
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def names(self, room_id):
+        """
+        Return the display names cached for a room, without counting hits.
+        """
+
+        now = self.clock()
+        return [entry[0] for key, entry in self.entries.items() if key[0] == room_id and entry[1] >= now]
+
+    def discard(self, room_id, user_id):
+        self.entries.pop((room_id, user_id), None)
+
+    def discard_room(self, room_id):
+        for key in [key for key in self.entries if key[0] == room_id]:
+            del self.entries[key]
+
+    def handle_member_event(self, room_id, event):
+        """
+        Update the cache from an m.room.member state event.
+        """
+
+        user_id = event.get("state_key")
+        if not user_id:
+            return
+        content = event.get("content", {})
+        if content.get("membership") in ("join", "invite"):
+            self.set(room_id, user_id, content.get("displayname") or user_id)
+        else:
+            self.discard(room_id, user_id)
@@ -0,0 +1,131 @@
+"""
+outbox.py
+Purpose: Per-room outbound message queues for AsyncMatrixClient.
+"""
+
+import asyncio
+import collections
+import logging
+
+from asyncmatrix.client import MatrixHttpError, MatrixRequestError
+
+log = logging.getLogger(__name__)
+
+
+class Outbox:
+    """
+    Sends messages to Matrix rooms without making the caller wait.
+
+    Each room gets its own queue and worker task, so rooms are served
+    concurrently while messages within a room keep their order. A worker waits
+    window seconds after the first message of a burst and then merges
+    consecutive messages of the same type, up to max_lines, into one
+    multi-line message. Failed sends are retried with exponential backoff.
+    """
+
+    def __init__(self, client, window=0.25, max_lines=20, max_retries=6, backoff=0.5, backoff_limit=30):
+        self.client = client
+        self.window = window
+        self.max_lines = max_lines
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.backoff_limit = backoff_limit
+        self.queues = {}
+        self.workers = {}
+        self.sent = 0
+        self.merged = 0
+        self.retries = 0
+        self.failed = 0
+        # Called as delivery_observer(room_id, received) for every message
+        # that was queued with a receipt time, once it has been sent.
+        self.delivery_observer = None
+
+    def send_text(self, room_id, text, received=None):
+        self.send(room_id, "m.text", text, received)
+
+    def send_emote(self, room_id, text, received=None):
+        self.send(room_id, "m.emote", text, received)
+
+    def send(self, room_id, msgtype, body, received=None):
+        """
+        Queue a message for room_id. received is when the message reached us,
+        as reported to delivery_observer.
+        """
+
+        self.queues.setdefault(room_id, collections.deque()).append((msgtype, body, received))
+        if room_id not in self.workers:
+            self.workers[room_id] = asyncio.ensure_future(self._work(room_id))
+
+    async def close(self):
+        """
+        Stop every worker. Messages still queued are not sent.
+        """
+
+        workers = list(self.workers.values())
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+    def pending(self):
+        return sum(len(queue) for queue in self.queues.values())
+
+    def _take(self, queue):
+        msgtype, body, received = queue.popleft()
+        lines = [body]
+        receipts = [received]
+        while queue and len(lines) < self.max_lines and queue[0][0] == msgtype:
+            msgtype, body, received = queue.popleft()
+            lines.append(body)
+            receipts.append(received)
+        self.merged += len(lines) - 1
+        return {"msgtype": msgtype, "body": "\n".join(lines)}, receipts
+
+    async def _work(self, room_id):
+        queue = self.queues[room_id]
+        try:
+            while queue:
+                if self.window:
+                    await asyncio.sleep(self.window)
+                content, receipts = self._take(queue)
+                if await self._deliver(room_id, content) and self.delivery_observer is not None:
+                    for received in receipts:
+                        if received is not None:
+                            self.delivery_observer(room_id, received)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            log.exception("Outbox worker for {} failed".format(room_id))
+        finally:
+            # Whatever is left is picked up by the worker the next send() starts.
+            del self.workers[room_id]
+            if not queue:
+                del self.queues[room_id]
+
+    async def _deliver(self, room_id, content):
+        delay = self.backoff
+        # One ID for every attempt: a request that failed after the homeserver
+        # stored the event must not post it twice.
+        txn_id = self.client.new_txn_id()
+        for attempt in range(self.max_retries + 1):
+            try:
+                await self.client.send_message(room_id, content, txn_id=txn_id)
+                self.sent += 1
+                return True
+            except MatrixRequestError as e:
+                if e.code != 429 and e.code < 500:
+                    log.error("Dropping message to {}: {}".format(room_id, e))
+                    self.failed += 1
+                    return False
+                error = e
+            except MatrixHttpError as e:
+                error = e
+
+            if attempt < self.max_retries:
+                self.retries += 1
+                log.warning("Sending to {} failed, retrying in {}s: {}".format(room_id, delay, error))
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.backoff_limit)
+
+        log.error("Giving up on message to {}: {}".format(room_id, error))
+        self.failed += 1
+        return False
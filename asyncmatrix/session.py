@@ -0,0 +1,97 @@
+"""
+session.py
+Purpose: Keep a Matrix session in a small state file across restarts.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import time
+
+log = logging.getLogger(__name__)
+
+
+class SessionStore:
+    """
+    A JSON object on disk holding the access token, device ID and last sync
+    token, plus whatever else the caller wants to keep between runs.
+
+    The file is replaced atomically and only readable by its owner, as it
+    holds a credential. update() writes at most once every min_interval
+    seconds; later changes are written when that interval is up.
+    """
+
+    def __init__(self, path, min_interval=1, clock=time.monotonic):
+        self.path = path
+        self.min_interval = min_interval
+        self.clock = clock
+        self.data = {}
+        self.writes = 0
+        self._written = None
+        self._handle = None
+
+    def load(self):
+        """
+        Read the state file. A missing or unreadable file gives an empty state.
+        """
+
+        try:
+            with open(self.path) as f:
+                self.data = json.load(f)
+        except FileNotFoundError:
+            self.data = {}
+        except (OSError, ValueError) as e:
+            log.warning("Ignoring unreadable state file {}: {}".format(self.path, e))
+            self.data = {}
+        return self.data
+
+    def save(self):
+        """
+        Write the state now.
+        """
+
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        tmp = "{}.tmp".format(self.path)
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump(self.data, f)
+        os.replace(tmp, self.path)
+        self._written = self.clock()
+        self.writes += 1
+
+    def update(self, **fields):
+        """
+        Change fields and write them out, no more often than min_interval.
+        """
+
+        self.data.update(fields)
+        if self._handle is not None:
+            return
+        wait = 0 if self._written is None else self._written + self.min_interval - self.clock()
+        if wait <= 0:
+            self._save_logged()
+        else:
+            self._handle = asyncio.get_event_loop().call_later(wait, self._save_logged)
+
+    def discard(self, *fields):
+        for field in fields:
+            self.data.pop(field, None)
+        self.save()
+
+    def flush(self):
+        """
+        Write out changes still waiting for min_interval to pass.
+        """
+
+        if self._handle is not None:
+            self.save()
+
+    def _save_logged(self):
+        self._handle = None
+        try:
+            self.save()
+        except OSError as e:
+            log.warning("Could not write state file {}: {}".format(self.path, e))
@@ -0,0 +1,189 @@
+"""
+capture.py
+Purpose: Record Lobby traffic to a file and replay it through a LobbyProtocol.
+
+A capture is an append-only text file with one record per line:
+
+    <time.monotonic()> <direction> <line>
+
+where direction is "<" for lines received from the server and ">" for lines
+sent to it. Every recording session starts with a "#" header line, and files
+whose name ends in .gz are gzip compressed (each session appends a member).
+
+Outbound lines carrying credentials, such as LOGIN and REGISTER, are recorded
+with everything after the username replaced by "<redacted>". Chat, private
+messages included, is recorded as is.
+"""
+
+import asyncio
+import gzip
+import logging
+import time
+
+from asyncblink import signal
+
+log = logging.getLogger(__name__)
+
+INBOUND = "<"
+OUTBOUND = ">"
+
+# verb -> words kept after it; the rest of the line is redacted
+redacted_verbs = {
+    "LOGIN": 1,
+    "REGISTER": 1,
+    "CHANGEPASSWORD": 0,
+    "RESETPASSWORD": 0,
+    "RESETPASSWORDREQUEST": 0,
+    "CHANGEEMAIL": 0,
+    "CHANGEEMAILREQUEST": 0,
+    "CONFIRMAGREEMENT": 0,
+}
+
+
+def redact(line):
+    """
+    Return line with any credentials it carries replaced by "<redacted>".
+    """
+
+    words = line.split(" ")
+    keep = redacted_verbs.get(words[0].upper())
+    if keep is None or len(words) <= keep + 1:
+        return line
+    return " ".join(words[:keep + 1] + ["<redacted>"])
+
+
+def open_capture(path, mode):
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+class Recorder:
+    """
+    Appends every line seen on signal("raw") and signal("lobby-send") to a
+    capture file. Writes are buffered and flushed every flush_interval
+    seconds, and on stop().
+    """
+
+    def __init__(self, path, flush_interval=1):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.records = 0
+        self._file = None
+        self._flush_handle = None
+
+    @property
+    def recording(self):
+        return self._file is not None
+
+    def start(self):
+        if self._file is not None:
+            return self
+        self._file = open_capture(self.path, "a")
+        self._file.write("# capture started {} monotonic {:.6f}\n".format(
+            time.strftime("%Y-%m-%dT%H:%M:%S%z"), time.monotonic()))
+        signal("raw").connect(self._inbound)
+        signal("lobby-send").connect(self._outbound)
+        self._schedule_flush()
+        log.info("Capturing lobby traffic to {}".format(self.path))
+        return self
+
+    def stop(self):
+        if self._file is None:
+            return
+        signal("raw").disconnect(self._inbound)
+        signal("lobby-send").disconnect(self._outbound)
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        self._file.close()
+        self._file = None
+
+    def _write(self, direction, line):
+        self._file.write("{:.6f} {} {}\n".format(time.monotonic(), direction, line))
+        self.records += 1
+
+    def _inbound(self, client, text):
+        self._write(INBOUND, text)
+
+    def _outbound(self, line):
+        self._write(OUTBOUND, redact(line))
+
+    def _schedule_flush(self):
+        self._flush_handle = asyncio.get_event_loop().call_later(self.flush_interval, self._flush)
+
+    def _flush(self):
+        if self._file is None:
+            return
+        self._file.flush()
+        self._schedule_flush()
+
+
+def read(path):
+    """
+    Yield (timestamp, direction, line) for every record of a capture. A new
+    session is yielded as (None, "#", header).
+    """
+
+    with open_capture(path, "r") as f:
+        for record in f:
+            record = record.rstrip("\n")
+            if record.startswith("#"):
+                yield None, "#", record
+                continue
+            timestamp, direction, line = record.split(" ", 2)
+            yield float(timestamp), direction, line
+
+
+async def replay(protocol, path, speed=1.0, chunk_size=4096):
+    """
+    Feed the inbound lines of a capture to protocol.data_received.
+
+    Lines keep their original spacing divided by speed. With speed 0 they are
+    fed as fast as the protocol takes them. Lines due at the same time are
+    passed in one call of up to chunk_size bytes, like a socket read, and the
+    event loop gets to run between calls. Gaps between sessions are skipped.
+    Returns the number of lines fed.
+    """
+
+    loop = asyncio.get_event_loop()
+    started = loop.time()
+    offset = None
+    fed = 0
+    pending = []
+    size = 0
+
+    def flush():
+        nonlocal size
+        protocol.data_received(b"".join(pending))
+        pending.clear()
+        size = 0
+
+    for timestamp, direction, line in read(path):
+        if direction == "#":
+            # Start the new session where the previous one left off.
+            offset = None
+            continue
+        if direction != INBOUND:
+            continue
+
+        if speed and timestamp is not None:
+            if offset is None:
+                offset = timestamp - (loop.time() - started) * speed
+            delay = (timestamp - offset) / speed - (loop.time() - started)
+            if delay > 0:
+                if pending:
+                    flush()
+                await asyncio.sleep(delay)
+
+        data = (line + "\n").encode("utf-8")
+        pending.append(data)
+        size += len(data)
+        fed += 1
+        if size >= chunk_size:
+            flush()
+            await asyncio.sleep(0)
+
+    if pending:
+        flush()
+    return fed
@@ -0,0 +1,126 @@
+"""
+coalesce.py
+Purpose: Merge bursts of chat from one sender before they reach the send queue.
+"""
+
+import asyncio
+import time
+
+from asyncspring.scheduler import TokenBucket
+
+
+class _Burst:
+    __slots__ = ("bucket", "parts", "size", "dropped", "origin", "handle")
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+        # (emote, text) pairs waiting to be sent
+        self.parts = []
+        self.size = 0
+        self.dropped = 0
+        self.origin = None
+        self.handle = None
+
+
+class Coalescer:
+    """
+    Hands chat to send(channel, sender, text, emote, origin), giving each
+    sender in a channel a budget of burst messages, refilled at rate per
+    second.
+
+    Within budget, a message is passed on straight away. Beyond it, messages
+    wait at least window seconds and are then joined with separator into one,
+    as soon as the budget allows. A sender's waiting text is capped at
+    max_bytes; the oldest messages are dropped to stay under it and the merged
+    message says how many were lost. Consecutive emotes and plain messages are
+    merged separately, so each keeps its kind.
+    """
+
+    def __init__(self, send, window=1.0, rate=0.5, burst=3, max_bytes=1200, separator=" | ", max_senders=1000,
+                 clock=time.monotonic):
+        self.send = send
+        self.window = window
+        self.rate = rate
+        self.burst = burst
+        self.max_bytes = max_bytes
+        self.separator = separator
+        self.max_senders = max_senders
+        self.clock = clock
+        # (channel, sender) -> _Burst
+        self.bursts = {}
+        self.passed = 0
+        self.merged = 0
+        self.dropped = 0
+
+    def add(self, channel, sender, text, emote=False, origin=None):
+        key = (channel, sender)
+        burst = self.bursts.get(key)
+        if burst is None:
+            if len(self.bursts) >= self.max_senders:
+                self._prune()
+            burst = self.bursts[key] = _Burst(TokenBucket(self.rate, self.burst, clock=self.clock))
+
+        if not burst.parts and burst.bucket.consume():
+            self.passed += 1
+            self.send(channel, sender, text, emote, origin)
+            return
+
+        if not burst.parts:
+            burst.origin = origin
+        burst.parts.append((emote, text))
+        burst.size += len(text.encode("utf-8"))
+        while burst.size > self.max_bytes and len(burst.parts) > 1:
+            burst.size -= len(burst.parts.pop(0)[1].encode("utf-8"))
+            burst.dropped += 1
+            self.dropped += 1
+        if burst.handle is None:
+            burst.handle = asyncio.get_event_loop().call_later(max(self.window, burst.bucket.delay()),
+                                                               self._flush, key)
+
+    def close(self):
+        """
+        Stop all pending flushes. Messages still waiting are not sent.
+        """
+
+        for burst in self.bursts.values():
+            if burst.handle is not None:
+                burst.handle.cancel()
+                burst.handle = None
+            burst.parts, burst.size, burst.dropped, burst.origin = [], 0, 0, None
+
+    def pending(self):
+        return sum(len(burst.parts) for burst in self.bursts.values())
+
+    def _flush(self, key):
+        burst = self.bursts[key]
+        burst.handle = None
+        if not burst.bucket.consume():
+            burst.handle = asyncio.get_event_loop().call_later(burst.bucket.delay(), self._flush, key)
+            return
+
+        channel, sender = key
+        parts, dropped, origin = burst.parts, burst.dropped, burst.origin
+        burst.parts, burst.size, burst.dropped, burst.origin = [], 0, 0, None
+        self.merged += len(parts)
+
+        texts = ["[{} earlier messages dropped]".format(dropped)] if dropped else []
+        emote = parts[0][0]
+        for part_emote, text in parts:
+            if part_emote != emote:
+                self.send(channel, sender, self.separator.join(texts), emote, origin)
+                texts, emote, origin = [], part_emote, None
+            texts.append(text)
+        self.send(channel, sender, self.separator.join(texts), emote, origin)
+
+    def _prune(self):
+        """
+        Forget senders with nothing waiting and a full budget.
+        """
+
+        for key, burst in list(self.bursts.items()):
+            if not burst.parts and burst.bucket.delay(self.burst) == 0:
+                del self.bursts[key]
+
+    def stats(self):
+        return {"senders": len(self.bursts), "pending": self.pending(), "passed": self.passed,
+                "merged": self.merged, "dropped": self.dropped}
@@ -0,0 +1,96 @@
+"""
+dispatch.py
+Purpose: Route parsed Lobby messages to the handlers registered for their verb.
+
+The table is filled at registration time, so dispatching a message is a single
+dict lookup on its interned verb. Lines whose verb nobody listens to can be
+dropped before they are parsed (see wants()).
+
+Receivers connected straight to a "spring-<verb>" signal keep working: the
+first time such a signal gets a receiver, the signal itself is added to the
+table as a handler for that verb.
+"""
+
+import functools
+
+from asyncblink import signal
+from blinker import receiver_connected
+
+from asyncspring import signals
+
+# verb -> tuple of handlers, replaced rather than mutated on registration
+handlers = {}
+
+# Receivers of this signal see every parsed message, whatever its verb.
+spring = signal("spring")
+
+_forwarded = set()
+
+
+def register(verb, handler):
+    """
+    Call handler(message) for every message with the given verb.
+    """
+
+    verb = verb.upper()
+    if handler not in handlers.get(verb, ()):
+        handlers[verb] = handlers.get(verb, ()) + (handler,)
+    return handler
+
+
+def unregister(verb, handler):
+    """
+    Stop calling handler for the given verb.
+    """
+
+    verb = verb.upper()
+    remaining = tuple(h for h in handlers.get(verb, ()) if h != handler)
+    if remaining:
+        handlers[verb] = remaining
+    else:
+        handlers.pop(verb, None)
+
+
+def on(verb):
+    """
+    Decorator form of register().
+    """
+
+    def process(f):
+        return register(verb, f)
+
+    return process
+
+
+def wants(verb):
+    """
+    Return whether a message with the given verb would reach any handler.
+    """
+
+    return verb in handlers or bool(spring.receivers)
+
+
+def dispatch(message):
+    """
+    Hand a parsed message to every handler registered for its verb.
+    """
+
+    if signals.timings is None:
+        for handler in handlers.get(message.verb, ()):
+            handler(message)
+    else:
+        for handler in handlers.get(message.verb, ()):
+            signals.call(handler, message)
+    if spring.receivers:
+        signals.send(spring, message)
+
+
+def _signal_connected(sig, **kwargs):
+    name = getattr(sig, "name", None)
+    if not isinstance(name, str) or not name.startswith("spring-") or name in _forwarded:
+        return
+    _forwarded.add(name)
+    register(name[len("spring-"):], functools.partial(signals.send, sig))
+
+
+receiver_connected.connect(_signal_connected)
@@ -0,0 +1,90 @@
+"""
+framer.py
+Purpose: Split the SpringRTS Lobby byte stream into decoded lines.
+"""
+
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class LineFramer:
+    """
+    Incremental line framer working on a single bytearray.
+
+    Bytes are searched for a newline only once, no matter how many reads it
+    takes for a line to arrive, and all lines completed by a read are decoded
+    in one go. Decoding stops at the last newline, so a multibyte UTF-8
+    character split across two reads is reassembled instead of raising.
+    Lines longer than max_line_length bytes are discarded.
+    """
+
+    def __init__(self, max_line_length=65536, encoding="utf-8", errors="replace"):
+        self.max_line_length = max_line_length
+        self.encoding = encoding
+        self.errors = errors
+        self.buf = bytearray()
+        self.overflows = 0
+        self._scanned = 0
+        self._discarding = False
+
+    def feed(self, data):
+        """
+        Append received bytes and return the list of lines they complete.
+        """
+
+        buf = self.buf
+        buf += data
+        end = buf.rfind(b"\n", self._scanned)
+
+        if end == -1:
+            self._scanned = len(buf)
+            if self._scanned > self.max_line_length:
+                self._discard()
+            return []
+
+        limit = self.max_line_length
+        start = 0
+        if self._discarding:
+            # The first line is the tail of one we already gave up on.
+            self._discarding = False
+            start = buf.find(b"\n") + 1
+
+        if end - start <= limit:
+            with memoryview(buf) as view:
+                text = str(view[start:end], self.encoding, self.errors)
+            del buf[:end + 1]
+            self._scanned = len(buf)
+            return [line.strip() for line in text.split("\n")] if end >= start else []
+
+        # Some line may be too long; measure each one in bytes before decoding it.
+        received = []
+        with memoryview(buf) as view:
+            while start <= end:
+                newline = buf.find(b"\n", start, end + 1)
+                if newline - start > limit:
+                    self.overflows += 1
+                    log.warning("Discarding line longer than {} bytes".format(limit))
+                else:
+                    received.append(str(view[start:newline], self.encoding, self.errors).strip())
+                start = newline + 1
+        del buf[:end + 1]
+        self._scanned = len(buf)
+        return received
+
+    def clear(self):
+        """
+        Drop any partially received line.
+        """
+
+        self.buf.clear()
+        self._scanned = 0
+        self._discarding = False
+
+    def _discard(self):
+        if not self._discarding:
+            self.overflows += 1
+            log.warning("Discarding line longer than {} bytes".format(self.max_line_length))
+        self._discarding = True
+        self.buf.clear()
+        self._scanned = 0
@@ -0,0 +1,103 @@
+"""
+heartbeat.py
+Purpose: Keep a Lobby connection alive and measure its lag.
+"""
+
+import asyncio
+import collections
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+
+class LagHistogram:
+    """
+    Rolling window over the last size lag samples.
+    """
+
+    def __init__(self, size=120):
+        self.samples = collections.deque(maxlen=size)
+
+    def __len__(self):
+        return len(self.samples)
+
+    def add(self, lag):
+        self.samples.append(lag)
+
+    def stats(self):
+        if not self.samples:
+            return {"samples": 0, "last": 0.0, "p50": 0.0, "p95": 0.0, "max": 0.0}
+        ordered = sorted(self.samples)
+        return {
+            "samples": len(ordered),
+            "last": self.samples[-1],
+            "p50": ordered[int(len(ordered) * 0.50)],
+            "p95": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+            "max": ordered[-1],
+        }
+
+
+class Heartbeat:
+    """
+    Sends PING on one connection every interval seconds and drops the
+    connection if no PONG arrives for timeout seconds. Owned by the
+    LobbyProtocol; stopped when the connection goes away.
+    """
+
+    def __init__(self, protocol, interval=29, timeout=90, window=120):
+        self.protocol = protocol
+        self.interval = interval
+        self.timeout = timeout
+        self.lag = LagHistogram(window)
+        self.timeouts = 0
+        self._handle = None
+        self._started = 0
+
+    @property
+    def running(self):
+        return self._handle is not None
+
+    def start(self):
+        """
+        Start pinging. Calling it again while running does nothing.
+        """
+
+        if self._handle is not None:
+            return
+        self._started = time.time()
+        self._beat()
+
+    def stop(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    def record(self, lag):
+        """
+        Called with the lag measured from a PONG.
+        """
+
+        self.lag.add(lag)
+
+    def _beat(self):
+        self._handle = None
+        protocol = self.protocol
+        if not protocol.work:
+            return
+
+        now = time.time()
+        if now - max(protocol.last_pong, self._started) > self.timeout:
+            self.timeouts += 1
+            log.warning("No PONG for {}s, dropping the connection.".format(self.timeout))
+            protocol.transport.abort()
+            return
+
+        # last_ping is stamped when the line is written, not while it waits in the queue.
+        protocol.writeln("PING")
+        self._handle = asyncio.get_event_loop().call_later(self.interval, self._beat)
+
+    def stats(self):
+        stats = self.lag.stats()
+        stats["timeouts"] = self.timeouts
+        return stats
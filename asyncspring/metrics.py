@@ -0,0 +1,205 @@
+"""
+metrics.py
+Purpose: Counters and histograms exported in the Prometheus text format.
+
+Metrics are cheap to declare and cost nothing while disabled: instrumented
+code checks metrics.enabled before measuring anything. Call enable() and
+then serve() and/or write_periodically() to export them.
+"""
+
+import asyncio
+import bisect
+import logging
+import os
+
+log = logging.getLogger(__name__)
+
+enabled = False
+
+registry = []
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def enable():
+    global enabled
+    enabled = True
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = ['{}="{}"'.format(name, _escape(value)) for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """
+    A monotonically increasing value per combination of label values. With a
+    callback, the values are instead read from callback() at export time,
+    for counts something else keeps anyway.
+    """
+
+    kind = "counter"
+
+    def __init__(self, name, documentation, labels=(), callback=None):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.callback = callback
+        self.values = {}
+
+    def inc(self, *label_values, amount=1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+        values = self.values if self.callback is None else self.callback()
+        for label_values, value in sorted(values.items()):
+            yield "{}{} {}".format(self.name, _format_labels(self.labels, label_values), _format_value(value))
+
+
+class Gauge:
+    """
+    A value read at export time from callback(), which returns a mapping of
+    label value tuples to numbers.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labels=(), callback=None):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.callback = callback
+
+    def render(self):
+        for label_values, value in sorted(self.callback().items()):
+            yield "{}{} {}".format(self.name, _format_labels(self.labels, label_values), _format_value(value))
+
+
+class Histogram:
+    """
+    Observations counted into cumulative buckets, per combination of label
+    values.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.values = {}
+
+    def observe(self, value, *label_values):
+        entry = self.values.get(label_values)
+        if entry is None:
+            entry = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    def render(self):
+        for label_values, (counts, total, count) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = 'le="{}"'.format(_format_value(bound))
+                yield "{}_bucket{} {}".format(self.name, _format_labels(self.labels, label_values, le), cumulative)
+            labels = _format_labels(self.labels, label_values)
+            yield "{}_sum{} {}".format(self.name, labels, _format_value(total))
+            yield "{}_count{} {}".format(self.name, labels, count)
+
+
+def _register(metric):
+    registry.append(metric)
+    return metric
+
+
+def counter(name, documentation, labels=(), callback=None):
+    return _register(Counter(name, documentation, labels, callback))
+
+
+def gauge(name, documentation, labels=(), callback=None):
+    return _register(Gauge(name, documentation, labels, callback))
+
+
+def histogram(name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+    return _register(Histogram(name, documentation, labels, buckets))
+
+
+def render():
+    """
+    Return every registered metric in the Prometheus text exposition format.
+    """
+
+    lines = []
+    for metric in registry:
+        lines.append("# HELP {} {}".format(metric.name, metric.documentation))
+        lines.append("# TYPE {} {}".format(metric.name, metric.kind))
+        try:
+            lines.extend(metric.render())
+        except Exception:
+            log.exception("Could not collect {}".format(metric.name))
+    return "\n".join(lines) + "\n"
+
+
+async def _handle_scrape(reader, writer):
+    try:
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+        body = render().encode("utf-8")
+        writer.write(b"HTTP/1.0 200 OK\r\n"
+                     b"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                     b"Content-Length: " + str(len(body)).encode() + b"\r\n\r\n" + body)
+        await writer.drain()
+    finally:
+        writer.close()
+
+
+async def serve(host="127.0.0.1", port=9105):
+    """
+    Answer every HTTP request on host:port with the current metrics.
+    """
+
+    return await asyncio.start_server(_handle_scrape, host, port)
+
+
+def write_file(path):
+    """
+    Atomically replace path with the current metrics.
+    """
+
+    tmp = "{}.tmp".format(path)
+    with open(tmp, "w") as f:
+        f.write(render())
+    os.replace(tmp, path)
+
+
+async def write_periodically(path, interval=15):
+    """
+    Rewrite path with the current metrics every interval seconds.
+    """
+
+    while True:
+        try:
+            write_file(path)
+        except OSError as e:
+            log.warning("Could not write metrics to {}: {}".format(path, e))
+        await asyncio.sleep(interval)
@@ -18,33 +18,112 @@ OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 """
 
 
+import sys
+from types import MappingProxyType
+
+# Shared by every message that arrives without tags.
+NO_TAGS = MappingProxyType({})
+
+_verbs = {}
+_VERB_CACHE_SIZE = 512
+
+
+def _intern_verb(token):
+    """
+    Return the interned, uppercased verb for token, caching the result.
+    """
+
+    verb = _verbs.get(token)
+    if verb is None:
+        verb = sys.intern(token.upper())
+        if len(_verbs) < _VERB_CACHE_SIZE:
+            _verbs[token] = verb
+    return verb
+
+
+def peek_verb(line):
+    """
+    Return the interned verb of an unparsed line without parsing the rest of
+    it, or None when the line starts with tags.
+    """
+
+    if line.startswith('@'):
+        return None
+    return _intern_verb(line.partition(' ')[0])
+
+
+def _word(params, index, words, line, head):
+    """
+    Return the index-th space separated word after the verb, even when it falls
+    inside the trailing argument. words is the number of words in head.
+    """
+
+    if index + 1 < words:
+        return params[index]
+    tail = line[len(head) + 1:].split(' ', index + 2 - words)
+    if index + 1 - words < len(tail):
+        return tail[index + 1 - words]
+    return "Lobby"
+
+
+def tokenize(line):
+    """
+    Split an unparsed Lobby line into (verb, params, source, tags).
+
+    The line is split on " :" once to find the trailing argument, and only the
+    part in front of it is split into parameters.
+    """
+
+    if isinstance(line, bytes):
+        line = line.decode('UTF-8', 'replace')
+
+    tags = None
+    if line.startswith('@'):
+        tag_str, _, line = line.partition(' ')
+        tags = {}
+        for tag in tag_str[1:].split(';'):
+            k, v = tag.split('=', 1)
+            tags[k] = v
+
+    head, sep, trailing = line.partition(' :')
+    params = head.split(' ')
+    words = len(params)
+    if sep:
+        params.append(trailing)
+
+    verb = _intern_verb(params[0])
+    del params[0]
+
+    source = "Lobby"
+    if verb == 'SAID' or verb == 'SAIDEX':
+        source = _word(params, 1, words, line, head)
+    elif verb == 'SAIDPRIVATE' or verb == 'SAIDPRIVATEEX':
+        source = _word(params, 0, words, line, head)
+
+    return verb, params, source, tags
+
+
 class LobbyMessage:
     """
     Represents an Lobby message.
     """
 
+    __slots__ = ("verb", "params", "source", "tags", "client")
+
+    def __init__(self, verb=None, params=None, source=None, tags=None):
+        self.verb = verb
+        self.params = params if params else []
+        self.source = source if source else None
+        self.tags = tags if tags else NO_TAGS
+        self.client = None
+
     @classmethod
     def from_data(cls, verb, params=None, source=None, tags=None):
         """
         Create a new RFC1459Message from the given verb, parameters, and source
         having the given tags.
         """
-        o = cls()
-        o.verb = verb
-        o.tags = dict()
-        o.source = None
-        o.params = list()
-
-        if params:
-            o.params = params
-
-        if source:
-            o.source = source
-
-        if tags:
-            o.tags.update(**tags)
-
-        return o
+        return cls(verb, params, source, tags)
 
     @classmethod
     def from_message(cls, message):
@@ -52,42 +131,7 @@ class LobbyMessage:
         Create a new LobbyMessage from an unparsed Lobby line.
         """
 
-        # print("RECEIVED:\t{}".format(message))
-
-        if isinstance(message, bytes):
-            message = message.decode('UTF-8', 'replace')
-
-        s = message.split(' ')
-
-        tags = None
-        if s[0].startswith('@'):
-            tag_str = s[0][1:].split(';')
-            s = s[1:]
-            tags = {}
-
-            for tag in tag_str:
-                k, v = tag.split('=', 1)
-                tags[k] = v
-
-        source = "Lobby"
-        if s[0] == 'SAID' or s[0] == 'SAIDEX':
-            source = s[2]
-        elif s[0] == 'SAIDPRIVATE' or s[0] == 'SAIDPRIVATEEX':
-            source = s[1]
-
-        verb = s[0].upper()
-        params = s[1:]
-
-        for param in params:
-            if param.startswith(':'):
-                idx = params.index(param)
-                arg = ' '.join(params[idx:])
-                arg = arg[1:]
-                params = params[:idx]
-                params.append(arg)
-                break
-
-        return cls.from_data(verb, params, source, tags)
+        return cls(*tokenize(message))
 
     def __str__(self):
         return "LobbyMessage: verb={}, params={}, source={}".format(self.verb, self.params, self.source)
@@ -1,21 +1,97 @@
+"""
+addressed.py
+Purpose: Recognise messages addressed to the bot and route bot commands.
+
+A public message is addressed to the bot when it starts with "<nick>: ",
+"<nick>, ", "<nick> " or a registered command character such as "!". The
+triggers are compiled into one pattern per nickname, rebuilt only when the
+nickname changes or command characters are (un)registered through the
+functions below. The text after the trigger is sent
+on signal("addressed"), and if its first word is a registered command, the
+command's handlers are called with the rest of the text.
+"""
+
+import re
+
 from asyncblink import signal
+from asyncspring import signals
+
+addressed = signal("addressed")
 
 command_character_registry = []
 
+# command name -> tuple of handlers, replaced rather than mutated on registration
+commands = {}
+
+# nickname -> compiled trigger pattern for the current command characters;
+# emptied whenever the command characters change
+_matchers = {}
+
 
 def register_command_character(c):
     command_character_registry.append(c)
+    _matchers.clear()
+
+
+def unregister_command_character(c):
+    command_character_registry.remove(c)
+    _matchers.clear()
+
+
+def register_command(name, handler):
+    """
+    Call handler(message, user=..., target=..., args=...) when a message
+    addressed to the bot starts with the command name.
+    """
+
+    name = name.lower()
+    if handler not in commands.get(name, ()):
+        commands[name] = commands.get(name, ()) + (handler,)
+    return handler
+
+
+def unregister_command(name, handler):
+    name = name.lower()
+    remaining = tuple(h for h in commands.get(name, ()) if h != handler)
+    if remaining:
+        commands[name] = remaining
+    else:
+        commands.pop(name, None)
+
+
+def command(name):
+    """
+    Decorator form of register_command().
+    """
+
+    def process(f):
+        return register_command(name, f)
+
+    return process
+
+
+def _matcher(nickname):
+    matcher = _matchers.get(nickname)
+    if matcher is None:
+        triggers = [i.format(nickname) for i in ["{}: ", "{}, ", "{} "] + command_character_registry]
+        # Alternatives are tried in order, so the first matching trigger wins as before.
+        matcher = _matchers[nickname] = re.compile("|".join(map(re.escape, triggers))).match
+    return matcher
 
 
 def handle_public_messages(message, user, target, text):
-    prefix = message.client.nickname
-    triggers = [i.format(prefix) for i in ["{}: ", "{}, ", "{} "] + command_character_registry]
-    for trigger in triggers:
-        if text.startswith(trigger):
-            text = text[len(trigger):]
-            signal("addressed").send(message, user=user, target=target, text=text)
-            return
+    match = _matcher(message.client.nickname)(text)
+    if match is None:
+        return
+    text = text[match.end():]
+    if addressed.receivers:
+        signals.send(addressed, message, user=user, target=target, text=text)
+
+    name, _, args = text.partition(" ")
+    for handler in commands.get(name.lower(), ()):
+        signals.call(handler, message, user=user, target=target, args=args.strip())
 
 
 signal("public-message").connect(handle_public_messages)
+signal("said").connect(handle_public_messages)
 signal("plugin-registered").send("asyncspring.plugins.addressed")
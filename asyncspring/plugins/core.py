@@ -1,6 +1,7 @@
 from asyncblink import signal
+from asyncspring import dispatch, metrics, signals
 from asyncspring.spring import get_user
-from asyncspring.parser import LobbyMessage
+from asyncspring.parser import LobbyMessage, peek_verb
 
 import asyncio
 import time
@@ -8,41 +9,54 @@ import logging
 
 log = logging.getLogger(__name__)
 
-ping_clients = []
+lines_received = metrics.counter("asyncspring_lines_received_total", "Lines received from the lobby server", ["verb"])
+parse_seconds = metrics.histogram("asyncspring_parse_seconds", "Time spent parsing a lobby line",
+                                  buckets=(0.000001, 0.0000025, 0.000005, 0.00001, 0.000025, 0.00005, 0.0001, 0.001))
+
+said = signal("said")
+saidex = signal("saidex")
+said_private = signal("said-private")
+saidex_private = signal("saidex-private")
+notice = signal("notice")
+join = signal("join")
+part = signal("part")
+quit_ = signal("quit")
+kick = signal("kick")
+nick = signal("nick")
 
 
 def _pong(message):
     message.client.writeln("PONG {}".format(message.params[0]))
 
 
-def _redispatch_message_common(message, mtype):
+def _redispatch_message_common(message, sig):
     user = message.source
     target, text = message.params[0], " ".join(message.params[2:])
-    signal(mtype).send(message, user=user, target=target, text=text)
+    signals.send(sig, message, user=user, target=target, text=text)
 
 
 def _redispatch_said(message):
-    _redispatch_message_common(message, "said")
+    _redispatch_message_common(message, said)
 
 
 def _redispatch_saidex(message):
-    _redispatch_message_common(message, "saidex")
+    _redispatch_message_common(message, saidex)
 
 
 def _redispatch_saidprivate(message):
-    _redispatch_message_common(message, "said-private")
+    _redispatch_message_common(message, said_private)
 
 
 def _redispatch_saidprivateex(message):
-    _redispatch_message_common(message, "saidex-private")
+    _redispatch_message_common(message, saidex_private)
 
 
 def _redispatch_notice(message):
-    _redispatch_message_common(message, "notice")
+    _redispatch_message_common(message, notice)
 
 
 def _redispatch_joined(message):
-    signal("join").send(message, user=get_user(message.source), channel=message.params[0])
+    signals.send(join, message, user=get_user(message.source), channel=message.params[0])
 
 
 def _redispatch_left(message):
@@ -50,17 +64,17 @@ def _redispatch_left(message):
     channel, reason = message.params[0], None
     if len(message.params) > 1:
         reason = message.params[1]
-    signal("part").send(message, user=user, channel=channel, reason=reason)
+    signals.send(part, message, user=user, channel=channel, reason=reason)
 
 
 def _redispatch_quit(message):
-    signal("quit").send(message, user=get_user(message.source), reason=message.params[0])
+    signals.send(quit_, message, user=get_user(message.source), reason=message.params[0])
 
 
 def _redispatch_kick(message):
     kicker = get_user(message.source)
     channel, kickee, reason = message.params[0], get_user(message.params[1]), message.params[2]
-    signal("kick").send(message, kicker=kicker, kickee=kickee, channel=channel, reason=reason)
+    signals.send(kick, message, kicker=kicker, kickee=kickee, channel=channel, reason=reason)
 
 
 def _redispatch_nick(message):
@@ -68,7 +82,7 @@ def _redispatch_nick(message):
     new_nick = message.params[0]
     if old_user.nick == message.client.nickname:
         message.client.nickname = new_nick
-    signal("nick").send(message, user=old_user, new_nick=new_nick)
+    signals.send(nick, message, user=old_user, new_nick=new_nick)
 
 
 def _parse_mode(message):
@@ -118,28 +132,26 @@ def _nick_in_use(message):
     # loop.call_later(5, callback)
 
 
-def _ping_servers():
-    for client in ping_clients:
-        if client.last_pong != 0 and time.time() - client.last_pong > 90:
-            client.connection_lost(Exception())
-        client.writeln("PING")
-        client.last_ping = time.time()
-    asyncio.get_event_loop().call_later(29, _ping_servers)
-
-
 def _catch_pong(message):
     message.client.last_pong = time.time()
     message.client.lag = message.client.last_pong - message.client.last_ping
-
-
-def _redispatch_spring(message):
-    signal("spring-{}".format(message.verb.lower())).send(message)
+    message.client.heartbeat.record(message.client.lag)
 
 
 def _redispatch_raw(client, text):
-    message = LobbyMessage.from_message(text)
+    verb = peek_verb(text)
+    if metrics.enabled:
+        lines_received.inc(verb or "")
+    if verb is not None and not dispatch.wants(verb):
+        return
+    if metrics.enabled:
+        started = time.perf_counter()
+        message = LobbyMessage.from_message(text)
+        parse_seconds.observe(time.perf_counter() - started)
+    else:
+        message = LobbyMessage.from_message(text)
     message.client = client
-    signal("spring").send(message)
+    dispatch.dispatch(message)
 
 
 def _register_client(client):
@@ -149,17 +161,24 @@ def _register_client(client):
 
 def _login_client(client):
     log.info("Server login")
-    asyncio.get_event_loop().call_later(1, client._login)
+    client.login_handle = asyncio.get_event_loop().call_later(1, client._login)
 
 
-def _queue_ping(client):
-    ping_clients.append(client)
-    _ping_servers()
+def _server_greeting(message):
+    # TASSERVER means the server is ready for LOGIN; don't wait out the delay
+    # if we already know what to log in as.
+    client = message.client
+    if client.login_handle is not None and getattr(client, "username", None) is not None:
+        client.login_handle.cancel()
+        client._login()
 
 
 def _connection_registered(message):
     message.client.registration_complete = True
-    _queue_ping(message.client)
+    if message.params:
+        # ACCEPTED carries the name we are logged in as.
+        message.client.nickname = message.params[0]
+    message.client.heartbeat.start()
     for channel in message.client.channels_to_join:
         message.client.join(channel)
 
@@ -172,45 +191,28 @@ def _parse_motd(message):
     pass
 
 
-def _matrix_clients(message):
-    pass
-
-
-def _matrix_channeltopic(message):
-    pass
-
-
 signal("raw").connect(_redispatch_raw)
-signal("spring").connect(_redispatch_spring)
 
 signal("connected").connect(_login_client)
 
-signal("spring-ping").connect(_pong)
-signal("spring-pong").connect(_catch_pong)
-
-signal("spring-said").connect(_redispatch_said)
-signal("spring-saidex").connect(_redispatch_saidex)
-signal("spring-saidprivate").connect(_redispatch_saidprivate)
-signal("spring-saidprivateex").connect(_redispatch_saidprivateex)
-
-signal("spring-notice").connect(_redispatch_notice)
-signal("spring-joined").connect(_redispatch_joined)
-signal("spring-left").connect(_redispatch_left)
-signal("spring-quit").connect(_redispatch_quit)
-signal("spring-kick").connect(_redispatch_kick)
-signal("spring-nick").connect(_redispatch_nick)
-signal("spring-mode").connect(_parse_mode)
-signal("spring-005").connect(_server_supports)
-signal("spring-accepted").connect(_connection_registered)
-signal("spring-denied").connect(_connection_denied)
-
-signal("spring-motd").connect(_parse_motd)
-
-# signal("spring-adduser").connect(_matrix_adduser)
-# signal("spring-removeuser").connect(_matrix_removeuser)
-
-# signal("spring-left").connect(_matrix_left)
-# signal("spring-joined").connect(_matrix_joined)
-
-signal("spring-clients").connect(_matrix_clients)
-signal("spring-channeltopic").connect(_matrix_channeltopic)
+dispatch.register("TASSERVER", _server_greeting)
+dispatch.register("PING", _pong)
+dispatch.register("PONG", _catch_pong)
+
+dispatch.register("SAID", _redispatch_said)
+dispatch.register("SAIDEX", _redispatch_saidex)
+dispatch.register("SAIDPRIVATE", _redispatch_saidprivate)
+dispatch.register("SAIDPRIVATEEX", _redispatch_saidprivateex)
+
+dispatch.register("NOTICE", _redispatch_notice)
+dispatch.register("JOINED", _redispatch_joined)
+dispatch.register("LEFT", _redispatch_left)
+dispatch.register("QUIT", _redispatch_quit)
+dispatch.register("KICK", _redispatch_kick)
+dispatch.register("NICK", _redispatch_nick)
+dispatch.register("MODE", _parse_mode)
+dispatch.register("005", _server_supports)
+dispatch.register("ACCEPTED", _connection_registered)
+dispatch.register("DENIED", _connection_denied)
+
+dispatch.register("MOTD", _parse_motd)
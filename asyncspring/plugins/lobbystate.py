@@ -0,0 +1,190 @@
+"""
+lobbystate.py
+Purpose: Track the SpringRTS Lobby user list and channel membership.
+
+Keeps client.lobby_state up to date from ADDUSER, REMOVEUSER, CLIENTS,
+JOINED, LEFT and CHANNELTOPIC, so who is online and who is in a channel can
+be answered without asking the server. User status comes from CLIENTSTATUS,
+the busiest verb on the lobby, and is only tracked after track_status().
+"""
+
+import sys
+
+from asyncblink import signal
+from asyncspring import dispatch
+
+states = {}
+
+
+class LobbyUser:
+    """
+    A user logged in to the lobby server.
+    """
+
+    __slots__ = ("name", "country", "account_id", "status", "channels")
+
+    def __init__(self, name, country=None, account_id=None):
+        self.name = name
+        self.country = country
+        self.account_id = account_id
+        self.status = 0
+        self.channels = set()
+
+    in_game = property(lambda self: bool(self.status & 1))
+    away = property(lambda self: bool(self.status & 2))
+    rank = property(lambda self: (self.status >> 2) & 7)
+    moderator = property(lambda self: bool(self.status & 32))
+    bot = property(lambda self: bool(self.status & 64))
+
+    def __repr__(self):
+        return "LobbyUser {}".format(self.name)
+
+
+class LobbyChannel:
+    """
+    A channel and the names of the users in it.
+    """
+
+    __slots__ = ("name", "users", "topic", "joined")
+
+    def __init__(self, name):
+        self.name = name
+        self.users = set()
+        self.topic = ""
+        self.joined = False
+
+    def __repr__(self):
+        return "LobbyChannel {}".format(self.name)
+
+
+class LobbyState:
+    def __init__(self):
+        self.users = {}
+        self.channels = {}
+
+    def user(self, name):
+        user = self.users.get(name)
+        if user is None:
+            name = sys.intern(name)
+            user = self.users[name] = LobbyUser(name)
+        return user
+
+    def channel(self, name):
+        channel = self.channels.get(name)
+        if channel is None:
+            name = sys.intern(name)
+            channel = self.channels[name] = LobbyChannel(name)
+        return channel
+
+    def add_members(self, channel_name, names):
+        channel = self.channel(channel_name)
+        for name in names:
+            user = self.user(name)
+            user.channels.add(channel.name)
+            channel.users.add(user.name)
+
+    def remove_member(self, channel_name, name):
+        channel = self.channels.get(channel_name)
+        if channel is not None:
+            channel.users.discard(name)
+        user = self.users.get(name)
+        if user is not None:
+            user.channels.discard(channel_name)
+
+    def remove_user(self, name):
+        user = self.users.pop(name, None)
+        if user is None:
+            return
+        for channel_name in user.channels:
+            channel = self.channels.get(channel_name)
+            if channel is not None:
+                channel.users.discard(name)
+
+    def who(self, channel_name):
+        """
+        Return the sorted names of the users in a channel.
+        """
+        channel = self.channels.get(channel_name) or self.channels.get(channel_name.lstrip("#"))
+        return sorted(channel.users) if channel is not None else []
+
+
+def create_state(client):
+    states[client.netid] = LobbyState()
+    client.lobby_state = states[client.netid]
+
+
+def get_state(message):
+    return message.client.lobby_state
+
+
+## event handlers
+
+def handle_adduser(message):
+    params = message.params
+    user = get_state(message).user(params[0])
+    if len(params) > 1:
+        user.country = params[1]
+    if len(params) > 2:
+        user.account_id = params[2].split("\t", 1)[0]
+
+
+def handle_removeuser(message):
+    get_state(message).remove_user(message.params[0])
+
+
+def handle_clients(message):
+    get_state(message).add_members(message.params[0], message.params[1:])
+
+
+def handle_joined(message):
+    get_state(message).add_members(message.params[0], message.params[1:2])
+
+
+def handle_left(message):
+    get_state(message).remove_member(message.params[0], message.params[1])
+
+
+def handle_join(message):
+    get_state(message).channel(message.params[0]).joined = True
+
+
+def handle_clientstatus(message):
+    # CLIENTSTATUS user status; ignore malformed lines rather than fail dispatch
+    if len(message.params) < 2:
+        return
+    user = get_state(message).users.get(message.params[0])
+    if user is None:
+        return
+    try:
+        user.status = int(message.params[1])
+    except ValueError:
+        pass
+
+
+def handle_channeltopic(message):
+    # CHANNELTOPIC channel author topic
+    get_state(message).channel(message.params[0]).topic = " ".join(message.params[2:])
+
+
+def track_status(enabled=True):
+    """
+    Start (or stop) keeping LobbyUser.status up to date. While nothing
+    handles CLIENTSTATUS its lines are dropped before they are parsed.
+    """
+    if enabled:
+        dispatch.register("CLIENTSTATUS", handle_clientstatus)
+    else:
+        dispatch.unregister("CLIENTSTATUS", handle_clientstatus)
+
+
+signal("netid-available").connect(create_state)
+
+dispatch.register("ADDUSER", handle_adduser)
+dispatch.register("REMOVEUSER", handle_removeuser)
+dispatch.register("CLIENTS", handle_clients)
+dispatch.register("JOINED", handle_joined)
+dispatch.register("LEFT", handle_left)
+dispatch.register("JOIN", handle_join)
+dispatch.register("CHANNELTOPIC", handle_channeltopic)
+
+signal("plugin-registered").send("asyncspring.plugins.lobbystate")
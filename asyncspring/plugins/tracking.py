@@ -1,15 +1,62 @@
 from asyncblink import signal
 from asyncspring.parser import LobbyMessage
 from collections import defaultdict
+from functools import lru_cache
 
 
 class Registry:
     def __init__(self):
-        self.mappings = set()
-        # mappings contains two-tuples (user, channel)
+        # Membership is indexed both ways: nick -> channels, channel -> nicks.
+        self.user_channels = {}
+        self.channel_users = {}
         self.users = {}
         self.channels = {}
 
+    @property
+    def mappings(self):
+        """
+        Two-tuples (nick, channel) for every membership. Built on demand.
+        """
+        return {(nick, channel) for nick, channels in self.user_channels.items() for channel in channels}
+
+    def add(self, nick, channel):
+        self.user_channels.setdefault(nick, set()).add(channel)
+        self.channel_users.setdefault(channel, set()).add(nick)
+
+    def discard(self, nick, channel):
+        channels = self.user_channels.get(nick)
+        if channels is not None:
+            channels.discard(channel)
+            if not channels:
+                del self.user_channels[nick]
+        nicks = self.channel_users.get(channel)
+        if nicks is not None:
+            nicks.discard(nick)
+            if not nicks:
+                del self.channel_users[channel]
+
+    def rename(self, old_nick, new_nick):
+        channels = self.user_channels.pop(old_nick, None)
+        if not channels:
+            return
+        self.user_channels.setdefault(new_nick, set()).update(channels)
+        for channel in channels:
+            nicks = self.channel_users[channel]
+            nicks.discard(old_nick)
+            nicks.add(new_nick)
+
+    def remove_user(self, nick):
+        """
+        Drop a user from every channel and return the channels they were in.
+        """
+        channels = self.user_channels.pop(nick, set())
+        for channel in channels:
+            nicks = self.channel_users[channel]
+            nicks.discard(nick)
+            if not nicks:
+                del self.channel_users[channel]
+        return channels
+
 
 registries = {}
 
@@ -35,7 +82,7 @@ class User:
         return "{}!{}@{}".format(self.nick, self.user, self.host)
 
     def _get_channels(self):
-        return list(map(lambda x: x[1], filter(lambda x: x[0] == self.nick, registries[self.netid].mappings)))
+        return list(registries[self.netid].user_channels.get(self.nick, ()))
 
     def __repr__(self):
         return "User {}!{}@{}".format(self.nick, self.user, self.host)
@@ -54,7 +101,7 @@ class Channel:
         self.flags = defaultdict(set)
 
     def _get_users(self):
-        return list(map(lambda x: x[0], filter(lambda x: x[1] == self.channel, registries[self.netid].mappings)))
+        return list(registries[self.netid].channel_users.get(self.channel, ()))
 
     def __repr__(self):
         return "Channel {}".format(self.channel)
@@ -65,7 +112,12 @@ class Channel:
 ## utility functions
 
 def parse_prefixes(server):  # -> {'v': '+', ...}
-    keys, values = server.server_supports['PREFIX'][1:].split(")")
+    return _parse_prefix(server.server_supports['PREFIX'])
+
+
+@lru_cache(maxsize=16)
+def _parse_prefix(prefix):
+    keys, values = prefix[1:].split(")")
     return {keys[i]: values[i] for i in range(len(keys))}
 
 
@@ -193,16 +245,12 @@ def handle_who_response(message):
 @names_response.connect
 def handle_names_response(message):
     dummy, channel, names = message.params[1:]
-    prefixes = parse_prefixes(message.client)
+    symbols = "".join(parse_prefixes(message.client).values())
+    flags = get_channel(message, channel).flags
     for name in names.split():
-        name_list = list(name)
-        applicable_prefixes = []
-
-        while name_list[0] in prefixes.values():  # multi-prefix support
-            applicable_prefixes.append(name_list.pop(0))
-
-        for prefix in applicable_prefixes:
-            get_channel(message, channel).flags[prefix].add("".join(name_list))
+        nick = name.lstrip(symbols)  # multi-prefix support
+        for prefix in name[:len(name) - len(nick)]:
+            flags[prefix].add(nick)
 
 
 @names_done.connect
@@ -237,7 +285,7 @@ def handle_join(message, user, channel, real=True):
     if user.nick == message.client.nickname and real:
         sync_channel(message.client, channel)
         get_channel(message, channel).available = True
-    message.client.tracking_registry.mappings.add((user.nick, channel))
+    message.client.tracking_registry.add(user.nick, channel)
 
 
 @extjoin.connect
@@ -259,20 +307,19 @@ def handle_part(message, user, channel, reason):
     user = get_user(message, user.nick)
     if user == message.client.nickname:
         get_channel(message, channel).available = False
-    message.client.tracking_registry.mappings.discard((user.nick, channel))
+    message.client.tracking_registry.discard(user.nick, channel)
 
 
 @quit_.connect
 def handle_quit(message, user, reason):
     user = get_user(message, user.nick)
     del message.client.tracking_registry.users[user.nick]
-    for channel in set(user.channels):
-        message.client.tracking_registry.mappings.remove((user.nick, channel))
+    message.client.tracking_registry.remove_user(user.nick)
 
 
 @kick.connect
 def handle_kick(message, kicker, kickee, channel, reason):
-    message.client.tracking_registry.mappings.discard((kickee, channel))
+    message.client.tracking_registry.discard(kickee, channel)
 
 
 @nick.connect
@@ -283,13 +330,7 @@ def handle_nick(message, user, new_nick):
     user.nick = new_nick
     del message.client.tracking_registry.users[old_nick]
     message.client.tracking_registry.users[new_nick] = user
-
-    mappings = set(message.client.tracking_registry.mappings)
-    original_mappings = message.client.tracking_registry.mappings
-    for i in mappings:
-        if i[0] == old_nick:
-            original_mappings.discard(i)
-            original_mappings.add((new_nick, i[1]))
+    message.client.tracking_registry.rename(old_nick, new_nick)
 
 
 @mode_set.connect
@@ -0,0 +1,366 @@
+"""
+scheduler.py
+Purpose: Pace outbound Lobby lines so they stay within the server's flood rules.
+"""
+
+import collections
+import time
+
+PRIORITY_PROTOCOL = 0
+PRIORITY_NORMAL = 1
+PRIORITY_CHAT = 2
+
+# Verbs that keep the connection and its channels alive go out ahead of
+# everything else. Chat goes last.
+verb_priorities = {
+    "PING": PRIORITY_PROTOCOL,
+    "PONG": PRIORITY_PROTOCOL,
+    "LOGIN": PRIORITY_PROTOCOL,
+    "REGISTER": PRIORITY_PROTOCOL,
+    "JOIN": PRIORITY_PROTOCOL,
+    "LEAVE": PRIORITY_PROTOCOL,
+    "SAY": PRIORITY_CHAT,
+    "SAYEX": PRIORITY_CHAT,
+    "SAYPRIVATE": PRIORITY_CHAT,
+    "SAYPRIVATEEX": PRIORITY_CHAT,
+}
+
+
+def line_verb(line):
+    """
+    Return the uppercased verb of an outbound line.
+    """
+
+    if isinstance(line, bytes):
+        return line.partition(b" ")[0].decode("ascii", "replace").upper()
+    return line.partition(" ")[0].upper()
+
+
+def line_target(line):
+    """
+    Return the channel or user an outbound line is addressed to, or None.
+    """
+
+    if isinstance(line, bytes):
+        parts = line.split(b" ", 2)
+        return parts[1].decode("utf-8", "replace") if len(parts) > 1 else None
+    parts = line.split(" ", 2)
+    return parts[1] if len(parts) > 1 else None
+
+
+def line_priority(line):
+    """
+    Return the priority class of an outbound line from its verb.
+    """
+
+    return verb_priorities.get(line_verb(line), PRIORITY_NORMAL)
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter: up to burst lines at once, refilled at rate
+    lines per second.
+
+    When the measured lag exceeds lag_threshold the refill rate is scaled down
+    in proportion, but never below min_rate.
+
+    Any object providing consume(), delay() and adapt() can be used in its
+    place as LobbyProtocol.rate_limiter.
+    """
+
+    def __init__(self, rate=2.0, burst=8, lag_threshold=1.0, min_rate=0.2, clock=time.monotonic):
+        self.base_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.lag_threshold = lag_threshold
+        self.min_rate = min_rate
+        self.clock = clock
+        self.tokens = float(burst)
+        self.updated = clock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def consume(self, tokens=1):
+        """
+        Take tokens from the bucket if that many are available.
+        """
+
+        self._refill()
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return True
+        return False
+
+    def delay(self, tokens=1):
+        """
+        Seconds until the given number of tokens will be available.
+        """
+
+        self._refill()
+        if self.tokens >= tokens:
+            return 0
+        return (tokens - self.tokens) / self.rate
+
+    def adapt(self, lag):
+        """
+        Slow down while the server is lagging behind, recover once it is not.
+        """
+
+        self._refill()
+        if lag > self.lag_threshold:
+            self.rate = max(self.min_rate, self.base_rate * self.lag_threshold / lag)
+        else:
+            self.rate = self.base_rate
+
+
+# Sent in place of the lines shed from a channel's backlog.
+shed_notice = "dropped {} messages to keep up"
+
+
+def shed_notice_line(line, count):
+    """
+    Return an emote to the target of line saying count lines were shed.
+    """
+
+    verb, target = line_verb(line), line_target(line)
+    if verb.startswith("SAYPRIVATE"):
+        return "SAYPRIVATEEX {} :{}".format(target, shed_notice.format(count))
+    return "SAYEX {} {}".format(target, shed_notice.format(count))
+
+
+class FairQueue:
+    """
+    Queue of (line, queued, origin) entries that takes turns between the
+    channels and users the lines are addressed to, so one busy channel cannot
+    hold up the others. Entries for the same target keep their order.
+
+    With a limit, a target holds at most that many lines: the oldest message
+    is shed to make room, and a notice saying how many were lost goes out at
+    the target's next turn. A message split over several lines is appended
+    with continued set on all but its first line, and is shed whole.
+    """
+
+    def __init__(self, limit=None):
+        self.limit = limit
+        # target -> deque of (line, queued, origin, continued), in turn order
+        self.targets = collections.OrderedDict()
+        # target -> [messages shed, when the first was shed, line it was shed from]
+        self.notices = {}
+        # targets whose message being appended was shed before its last line
+        self.shedding = set()
+        self.length = 0
+        self.shed = 0
+
+    def __len__(self):
+        return self.length
+
+    def __bool__(self):
+        return self.length > 0
+
+    def __iter__(self):
+        """
+        Iterate over the queued entries target by target; notices are not
+        included.
+        """
+
+        for queue in self.targets.values():
+            for line, queued, origin, continued in queue:
+                yield line, queued, origin
+
+    def entries(self):
+        """
+        Iterate over the queued (line, queued, origin, continued) entries
+        target by target.
+        """
+
+        for queue in self.targets.values():
+            yield from queue
+
+    def append(self, entry, continued=False):
+        line, queued, origin = entry
+        target = line_target(line)
+        if continued and target in self.shedding:
+            # The start of this message is gone; the rest goes with it.
+            self.shed += 1
+            return
+        self.shedding.discard(target)
+
+        queue = self.targets.get(target)
+        if queue is None:
+            queue = self.targets[target] = collections.deque()
+        queue.append((line, queued, origin, continued))
+        self.length += 1
+
+        if self.limit is not None and len(queue) > self.limit:
+            self._shed(target, queue)
+
+    def _shed(self, target, queue):
+        """
+        Drop the oldest whole message queued for target. Lines continuing a
+        message that has already started going out are left alone.
+        """
+
+        start = 0
+        while start < len(queue) and queue[start][3]:
+            start += 1
+        if start == len(queue):
+            return
+        end = start + 1
+        while end < len(queue) and queue[end][3]:
+            end += 1
+
+        line, queued = queue[start][0], queue[start][1]
+        if end == len(queue):
+            self.shedding.add(target)
+        for _ in range(end - start):
+            del queue[start]
+        self.shed += end - start
+        self.length -= end - start
+
+        notice = self.notices.get(target)
+        if notice is None:
+            # The notice takes the place of the shed message.
+            self.notices[target] = [1, queued, line]
+            self.length += 1
+        else:
+            notice[0] += 1
+
+    def popleft(self):
+        target, queue = next(iter(self.targets.items()))
+        notice = self.notices.get(target)
+        # A notice waits until the message the target is part way through is out.
+        if notice is not None and not (queue and queue[0][3]):
+            del self.notices[target]
+            entry = (shed_notice_line(notice[2], notice[0]), notice[1], None)
+        else:
+            line, queued, origin, continued = queue.popleft()
+            entry = (line, queued, origin)
+        self.length -= 1
+        if queue or target in self.notices:
+            self.targets.move_to_end(target)
+        else:
+            del self.targets[target]
+        return entry
+
+    def clear(self):
+        self.targets.clear()
+        self.notices.clear()
+        self.shedding.clear()
+        self.length = 0
+
+
+class SendQueue:
+    """
+    Outbound line queue with one deque per priority class.
+
+    Lines of the same class keep their order; a lower class number is always
+    sent first. Chat is the exception: it is a FairQueue taking turns between
+    channels, holding at most chat_backlog lines per channel. Depth and time
+    spent waiting are tracked for stats().
+    """
+
+    def __init__(self, classes=3, clock=time.monotonic, chat_backlog=None):
+        self.clock = clock
+        self.queues = [collections.deque() for _ in range(classes)]
+        if classes > PRIORITY_CHAT:
+            self.queues[PRIORITY_CHAT] = FairQueue(chat_backlog)
+        self.depth = 0
+        self.max_depth = 0
+        self.sent = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.last_wait = 0.0
+
+    def __len__(self):
+        return self.depth
+
+    def __bool__(self):
+        return self.depth > 0
+
+    def push(self, line, priority=None, origin=None, continued=False):
+        """
+        Queue a line. Its priority class is derived from its verb unless given.
+        origin is handed back by pop() along with the line. continued marks a
+        line carrying on the message of the one pushed before it, so chat
+        backlog sheds them together.
+        """
+
+        if priority is None:
+            priority = line_priority(line)
+        queue = self.queues[priority]
+        before = len(queue)
+        if continued and isinstance(queue, FairQueue):
+            queue.append((line, self.clock(), origin), continued)
+        else:
+            queue.append((line, self.clock(), origin))
+        self.depth += len(queue) - before
+        if self.depth > self.max_depth:
+            self.max_depth = self.depth
+
+    def ready(self, upto=None):
+        """
+        Return True if a line of priority class upto or lower is queued; any
+        class if upto is None.
+        """
+
+        if upto is None:
+            return self.depth > 0
+        return any(self.queues[:upto + 1])
+
+    def pop(self, upto=None):
+        """
+        Remove and return the next line to send and its origin, considering
+        only classes up to upto if given.
+        """
+
+        for queue in self.queues[:None if upto is None else upto + 1]:
+            if queue:
+                line, queued, origin = queue.popleft()
+                break
+        else:
+            raise IndexError("pop from an empty SendQueue")
+
+        waited = self.clock() - queued
+        self.depth -= 1
+        self.sent += 1
+        self.total_wait += waited
+        self.last_wait = waited
+        if waited > self.max_wait:
+            self.max_wait = waited
+        return line, origin
+
+    def drain(self):
+        """
+        Remove every queued line and return (line, priority, origin, continued)
+        tuples in send order, to be pushed again as they were.
+        """
+
+        lines = []
+        for priority, queue in enumerate(self.queues):
+            if isinstance(queue, FairQueue):
+                lines += [(line, priority, origin, continued) for line, queued, origin, continued in queue.entries()]
+            else:
+                lines += [(line, priority, origin, False) for line, queued, origin in queue]
+        for queue in self.queues:
+            queue.clear()
+        self.depth = 0
+        return lines
+
+    def stats(self):
+        """
+        Return a snapshot of queue depth and wait times.
+        """
+
+        return {
+            "depth": self.depth,
+            "depth_by_priority": [len(queue) for queue in self.queues],
+            "max_depth": self.max_depth,
+            "shed": sum(getattr(queue, "shed", 0) for queue in self.queues),
+            "sent": self.sent,
+            "last_wait": self.last_wait,
+            "max_wait": self.max_wait,
+            "mean_wait": self.total_wait / self.sent if self.sent else 0.0,
+        }
@@ -0,0 +1,156 @@
+"""
+signals.py
+Purpose: A faster way to send asyncblink signals on hot paths.
+
+asyncblink's send() resolves receivers through blinker's generic machinery and
+checks on every call whether each receiver is a coroutine function. After
+enable_fast_send(), send() instead calls plain receivers directly from a
+per-signal list built when receivers change, and only schedules coroutine
+receivers as tasks. Signals with receivers bound to a particular sender are
+always sent the regular way, as is everything if the blinker internals this
+relies on (tested with the versions in requirements.txt) are missing.
+
+With timing on, every receiver call made through send() or the verb dispatch
+table is timed, and receiver_stats() shows where the time goes.
+"""
+
+import asyncio
+import logging
+import time
+
+from blinker import receiver_connected
+
+try:
+    from blinker.base import ANY_ID, WeakTypes
+except ImportError:
+    # The fast path relies on blinker internals; without them every signal
+    # is sent the regular way.
+    ANY_ID = WeakTypes = None
+
+log = logging.getLogger(__name__)
+
+fast = False
+
+# receiver name -> [calls, total seconds, slowest call], while timing is on
+timings = None
+
+# signal -> (receiver count, tuple of (receiver, weak, coroutine)), or a None
+# tuple for signals that have to go through Signal.send()
+_receivers = {}
+
+_tasks = set()
+
+
+def enable_fast_send(timing=False):
+    global fast, timings
+    fast = True
+    timings = {} if timing else None
+
+
+def disable_fast_send():
+    global fast, timings
+    fast = False
+    timings = None
+    _receivers.clear()
+
+
+def _name(receiver):
+    return "{}.{}".format(getattr(receiver, "__module__", "?"),
+                          getattr(receiver, "__qualname__", None) or repr(receiver))
+
+
+def call(receiver, *args, **kwargs):
+    """
+    Call receiver, recording how long it took while timing is on.
+    """
+
+    if timings is None:
+        return receiver(*args, **kwargs)
+    started = time.perf_counter()
+    try:
+        return receiver(*args, **kwargs)
+    finally:
+        elapsed = time.perf_counter() - started
+        entry = timings.get(receiver)
+        if entry is None:
+            entry = timings[receiver] = [0, 0.0, 0.0]
+        entry[0] += 1
+        entry[1] += elapsed
+        if elapsed > entry[2]:
+            entry[2] = elapsed
+
+
+def receiver_stats():
+    """
+    Return calls, total and slowest time per receiver, slowest in total first.
+    """
+
+    if not timings:
+        return []
+    stats = [{"receiver": _name(receiver), "calls": calls, "total": total, "max": slowest}
+             for receiver, (calls, total, slowest) in timings.items()]
+    return sorted(stats, key=lambda entry: entry["total"], reverse=True)
+
+
+def _resolve(sig):
+    by_sender = getattr(sig, "_by_sender", None)
+    if ANY_ID is None or not isinstance(by_sender, dict) or any(
+            ids for sender_id, ids in by_sender.items() if sender_id != ANY_ID):
+        entry = (len(sig.receivers), None)
+    else:
+        receivers = []
+        for ref in sig.receivers.values():
+            weak = isinstance(ref, WeakTypes)
+            receiver = ref() if weak else ref
+            if receiver is not None:
+                receivers.append((ref, weak, asyncio.iscoroutinefunction(receiver)))
+        entry = (len(sig.receivers), tuple(receivers))
+    _receivers[sig] = entry
+    return entry
+
+
+def _task_done(task):
+    _tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        log.error("Signal receiver failed", exc_info=task.exception())
+
+
+def send(sig, sender=None, **kwargs):
+    """
+    Send sig like sig.send(sender, **kwargs), without collecting results.
+    """
+
+    if not fast:
+        sig.send(sender, **kwargs)
+        return
+    if not sig.receivers:
+        return
+
+    entry = _receivers.get(sig)
+    # Weak receivers that went away leave the count, connections trigger _connected().
+    if entry is None or entry[0] != len(sig.receivers):
+        entry = _resolve(sig)
+    if entry[1] is None:
+        sig.send(sender, **kwargs)
+        return
+
+    for receiver, weak, coroutine in entry[1]:
+        if weak:
+            receiver = receiver()
+            if receiver is None:
+                continue
+        if coroutine:
+            task = asyncio.ensure_future(receiver(sender, **kwargs))
+            _tasks.add(task)
+            task.add_done_callback(_task_done)
+        elif timings is None:
+            receiver(sender, **kwargs)
+        else:
+            call(receiver, sender, **kwargs)
+
+
+def _connected(sig, **kwargs):
+    _receivers.pop(sig, None)
+
+
+receiver_connected.connect(_connected)
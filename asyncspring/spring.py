@@ -6,9 +6,15 @@ import importlib
 import logging
 import random
 import ssl
+import time
 
 from asyncblink import signal
 
+from asyncspring import dispatch, metrics, signals
+from asyncspring.framer import LineFramer
+from asyncspring.heartbeat import Heartbeat
+from asyncspring.scheduler import PRIORITY_PROTOCOL, SendQueue, TokenBucket, line_verb
+
 loop = asyncio.get_event_loop()
 
 connections = {}
@@ -17,6 +23,22 @@ plugins = []
 
 log = logging.getLogger(__name__)
 
+raw = signal("raw")
+lobby_send = signal("lobby-send")
+
+lines_sent = metrics.counter("asyncspring_lines_sent_total", "Lines sent to the lobby server", ["verb"])
+queue_wait = metrics.histogram("asyncspring_send_queue_wait_seconds", "Time lines spent in the send queue")
+relay_latency = metrics.histogram("asyncspring_relay_latency_seconds",
+                                  "Time from receiving a bridged message to sending it on, per room",
+                                  ["direction", "room"])
+
+
+def _queue_depths():
+    return {(netid,): len(wrapper.queue) for netid, wrapper in connections.items()}
+
+
+metrics.gauge("asyncspring_send_queue_depth", "Lines waiting in the send queue", ["netid"], _queue_depths)
+
 
 def plugin_registered_handler(plugin_name):
     plugins.append(plugin_name)
@@ -52,6 +74,45 @@ class User:
         return self(None, None, hostmask)
 
 
+def _encode_line(line):
+    if isinstance(line, bytes):
+        return line + b"\r\n"
+    return (line + "\r\n").encode("utf-8")
+
+
+def split_message(prefix, message, limit):
+    """
+    Yield encoded lines of prefix followed by a piece of message, each at most
+    limit bytes long.
+
+    The message is encoded once and cut in a single pass. Cuts never fall inside
+    a UTF-8 sequence and go at the last space of a piece when that keeps at
+    least half of it; the space itself is dropped.
+    """
+
+    data = message.encode("utf-8")
+    room = max(limit - len(prefix), 4)
+    start, size = 0, len(data)
+
+    while start < size:
+        end = start + room
+        if end >= size:
+            yield prefix + data[start:]
+            return
+
+        # Back off to the first byte of the UTF-8 sequence the cut falls in.
+        while end > start and data[end] & 0xC0 == 0x80:
+            end -= 1
+
+        space = data.rfind(b" ", start + room // 2, end + 1)
+        if space > start:
+            yield prefix + data[start:space]
+            start = space + 1
+        else:
+            yield prefix + data[start:end]
+            start = end
+
+
 class LobbyProtocolWrapper:
     """
     Wraps an LobbyProtocol object to allow for automatic reconnection. Only used
@@ -60,6 +121,16 @@ class LobbyProtocolWrapper:
 
     def __init__(self, protocol):
         self.protocol = protocol
+        self.reconnecting = False
+        self.down_since = None
+        self.reconnect_stats = {
+            "disconnects": 0,
+            "attempts": 0,
+            "recoveries": 0,
+            "last_recovery": None,
+            "max_recovery": 0.0,
+            "total_downtime": 0.0,
+        }
 
     def __getattr__(self, attr):
         if attr in self.__dict__:
@@ -78,6 +149,19 @@ class LobbyProtocol(asyncio.Protocol):
     Represents a connection to SpringRTS Lobby.
     """
 
+    max_line_length = 65536
+    max_line_bytes = 450
+    send_rate = 2.0
+    send_burst = 8
+    # Chat lines waiting per channel before the oldest are dropped
+    chat_backlog = 100
+    ping_interval = 29
+    ping_timeout = 90
+    connect_timeout = 30
+    reconnect_delay = 1
+    reconnect_max_delay = 60
+    reconnect_window = 3600
+
     def connection_made(self, transport):
 
         self.work = True
@@ -87,16 +171,23 @@ class LobbyProtocol(asyncio.Protocol):
         self.last_ping = float('inf')
         self.last_pong = 0
         self.lag = 0
-        self.buf = ""
+        self.heartbeat = Heartbeat(self, self.ping_interval, self.ping_timeout)
+        self.framer = LineFramer(self.max_line_length)
         self.old_nickname = None
         self.nickname = ""
         self.server_supports = collections.defaultdict(lambda *_: None)
-        self.queue = []
-        self.queue_timer = 1.5
+        self.queue = SendQueue(chat_backlog=self.chat_backlog)
+        self.rate_limiter = TokenBucket(self.send_rate, self.send_burst)
+        self._queue_handle = None
+        self.paused = False
         self.caps = set()
         self.registration_complete = False
         self.channels_to_join = []
         self.autoreconnect = True
+        # Pending delayed LOGIN, see plugins.core
+        self.login_handle = None
+        # (line, origin, continued) left unsent by the previous connection, queued again once logged in.
+        self.carried = []
 
         signal("connected").send(self)
         self.logger.info("Connection success.")
@@ -106,17 +197,13 @@ class LobbyProtocol(asyncio.Protocol):
     def data_received(self, data):
         if not self.work:
             return
-        data = data.decode()
 
-        self.buf += data
-        while "\n" in self.buf:
-            index = self.buf.index("\n")
-            line_received = self.buf[:index].strip()
-            self.buf = self.buf[index + 1:]
-            # print(line_received)
-            signal("raw").send(self, text=line_received)
+        send = signals.send
+        for line_received in self.framer.feed(data):
+            send(raw, self, text=line_received)
 
     def connection_lost(self, exc):
+        self.heartbeat.stop()
         if not self.work:
             return
         self.logger.critical("Connection lost.")
@@ -126,44 +213,122 @@ class LobbyProtocol(asyncio.Protocol):
 
     def process_queue(self):
         """
-        Pull data from the pending messages queue and send it. Schedule ourself
-        to be executed again later.
+        Send as many pending messages as the rate limiter allows. If any are
+        left, schedule ourself for when the next one may go out.
         """
 
-        if not self.work:
+        self._queue_handle = None
+        if not self.work or self.paused:
             return
-        if self.queue:
-            self._writeln(self.queue.pop(0))
 
-        loop.call_later(self.queue_timer, self.process_queue)
+        self.rate_limiter.adapt(self.lag)
+        # Until the server has accepted our login it would reject anything but
+        # protocol lines, so the rest waits in the queue.
+        upto = None if self.registration_complete else PRIORITY_PROTOCOL
+        batch = []
+        origins = []
+        pinged = False
+        while self.queue.ready(upto) and self.rate_limiter.consume():
+            line, origin = self.queue.pop(upto)
+            batch.append(line)
+            if line == "PING":
+                pinged = True
+            if metrics.enabled:
+                queue_wait.observe(self.queue.last_wait)
+                if origin is not None:
+                    origins.append(origin)
+        if batch:
+            self._writelines(batch)
+            if pinged:
+                # Lag is measured from here, so time spent queued is not taken for server lag.
+                self.last_ping = time.time()
+
+        if origins:
+            now = time.monotonic()
+            for room, received in origins:
+                relay_latency.observe(now - received, "matrix-to-lobby", room)
+
+        if self.queue.ready(upto):
+            self._queue_handle = loop.call_later(self.rate_limiter.delay(), self.process_queue)
+
+    def queue_stats(self):
+        """
+        Return send queue depth and wait times, plus the current send rate.
+        """
+
+        stats = self.queue.stats()
+        stats["rate"] = getattr(self.rate_limiter, "rate", None)
+        return stats
+
+    def lag_stats(self):
+        """
+        Return p50/p95/max of recently measured lag and the number of timeouts.
+        """
+
+        return self.heartbeat.stats()
 
     def on(self, event):
 
         def process(f):
             """
             Register an event with Blinker. Convenience function.
+            "spring-<verb>" events go straight into the verb dispatch table.
             """
             self.logger.info("Registering function for event {}".format(event))
-            signal(event).connect(f)
+            if event.startswith("spring-"):
+                dispatch.register(event[len("spring-"):], f)
+            else:
+                signal(event).connect(f)
             return f
 
         return process
 
+    def pause_writing(self):
+        """
+        The transport buffer is full; stop sending until it drains.
+        """
+        self.paused = True
+        if self._queue_handle is not None:
+            self._queue_handle.cancel()
+            self._queue_handle = None
+
+    def resume_writing(self):
+        """
+        The transport buffer has drained; resume sending.
+        """
+        self.paused = False
+        if self._queue_handle is None:
+            self._queue_handle = loop.call_soon(self.process_queue)
+
+    def _writelines(self, lines):
+        """
+        Send raw messages to SpringRTS Lobby immediately, in a single write.
+        """
+        self.transport.writelines([_encode_line(line) for line in lines])
+        if metrics.enabled:
+            for line in lines:
+                lines_sent.inc(line_verb(line))
+        if lobby_send.receivers:
+            for line in lines:
+                signals.send(lobby_send, line.decode("utf-8", "replace") if isinstance(line, bytes) else line)
+
     def _writeln(self, line):
         """
         Send a raw message to SpringRTS Lobby immediately.
         """
-        if not isinstance(line, bytes):
-            line = line.encode("utf-8")
-        # print("SENT:\t\t{}".format(line))
-        self.transport.write(line + b"\r\n")
-        signal("lobby-send").send(line.decode())
+        self._writelines((line,))
 
-    def writeln(self, line):
+    def writeln(self, line, origin=None, continued=False):
         """
         Queue a message for sending to the currently connected SpringRTS Lobby server.
+        Protocol keepalives (PING, PONG, JOIN, ...) are sent ahead of chat.
+        origin, a (room, time.monotonic() of receipt) pair, is used to measure
+        relay latency when metrics are enabled. continued marks a line carrying
+        on the previous one's message; they are kept or shed together.
         """
-        self.queue.append(line)
+        self.queue.push(line, origin=origin, continued=continued)
+        if self._queue_handle is None and not self.paused:
+            self._queue_handle = loop.call_soon(self.process_queue)
         return self
 
     def register(self, username, password, email=None):
@@ -207,71 +372,69 @@ class LobbyProtocol(asyncio.Protocol):
         """
         Send Login message to SpringLobby Server.
         """
+        self.login_handle = None
         self.writeln("LOGIN {} {} 3200 * TurBoMatrix 0.1".format(self.username, self.password))
         signal("login-complete").send(self)
 
     def join(self, channel):
         """
-        Join a channel.
+        Join a channel, and join it again after reconnecting.
         """
+        if channel not in self.channels_to_join:
+            self.channels_to_join.append(channel)
         self.writeln("JOIN {}".format(channel))
 
         return self
 
     def leave(self, channel):
         """
-        Leave a channel.
+        Leave a channel, and stay out of it after reconnecting.
         """
 
+        for name in (channel, "#" + channel.lstrip("#"), channel.lstrip("#")):
+            if name in self.channels_to_join:
+                self.channels_to_join.remove(name)
         self.writeln("LEAVE {}".format(channel))
 
-    def say(self, channel, message):
+    def _say(self, prefix, message, origin=None):
         """
-        Send a MSG to SpringRTS Lobby room.
+        Queue message in as many lines starting with prefix as it takes to keep
+        each line within max_line_bytes.
         Carriage returns and line feeds are stripped to prevent bugs.
         """
 
         message = message.replace("\n", "").replace("\r", "")
 
-        while message:
-            self.writeln("SAY {} {}".format(channel, message[:400]))
-            message = message[400:]
+        for index, line in enumerate(split_message(prefix.encode("utf-8"), message, self.max_line_bytes)):
+            self.writeln(line, origin, continued=index > 0)
 
-    def say_ex(self, channel, message):
+    def say(self, channel, message, origin=None):
         """
-        Send a MSG to SpringRTS Lobby room using emote.
-        Carriage returns and line feeds are stripped to prevent bugs.
+        Send a MSG to SpringRTS Lobby room.
         """
 
-        message = message.replace("\n", "").replace("\r", "")
+        self._say("SAY {} ".format(channel), message, origin)
+
+    def say_ex(self, channel, message, origin=None):
+        """
+        Send a MSG to SpringRTS Lobby room using emote.
+        """
 
-        while message:
-            self.writeln("SAYEX {} {}".format(channel, message[:400]))
-            message = message[400:]
+        self._say("SAYEX {} ".format(channel), message, origin)
 
-    def say_private(self, username, message):
+    def say_private(self, username, message, origin=None):
         """
         Send a private message to SpringRTS Lobby user.
-        Carriage returns and line feeds are stripped to prevent bugs.
         """
 
-        message = message.replace("\n", "").replace("\r", "")
-
-        while message:
-            self.writeln("SAYPRIVATE {} :{}".format(username, message[:400]))
-            message = message[400:]
+        self._say("SAYPRIVATE {} :".format(username), message, origin)
 
-    def say_private_ex(self, username, message):
+    def say_private_ex(self, username, message, origin=None):
         """
         Send a private message to SpringRTS Lobby user in emote.
-        Carriage returns and line feeds are stripped to prevent bugs.
         """
 
-        message = message.replace("\n", "").replace("\r", "")
-
-        while message:
-            self.writeln("SAYPRIVATEEX {} :{}".format(username, message[:400]))
-            message = message[400:]
+        self._say("SAYPRIVATEEX {} :".format(username), message, origin)
 
     def nick_in_use_handler(self):
         """
@@ -325,32 +488,104 @@ def disconnected(client_wrapper):
     configuration. Called by LobbyProtocol when we lose the connection.
     """
 
-    client_wrapper.protocol.work = False
+    protocol = client_wrapper.protocol
+    protocol.work = False
+    protocol.transport.close()
     log.info("Disconnected from {}. Attempting to reconnect...".format(client_wrapper.netid))
-    signal("disconnected").send(client_wrapper.protocol)
-    if not client_wrapper.protocol.autoreconnect:
+    signal("disconnected").send(protocol)
+    if not protocol.autoreconnect:
         sys.exit(2)
 
-    connector = loop.create_connection(LobbyProtocol, **client_wrapper.server_info)
+    client_wrapper.reconnect_stats["disconnects"] += 1
+    if client_wrapper.down_since is None:
+        client_wrapper.down_since = time.monotonic()
+
+    # Keepalives and logins are sent afresh by the new connection, and it joins
+    # channels_to_join, which join() and leave() keep up to date.
+    carried = protocol.carried + [(line, origin, continued) for line, priority, origin, continued
+                                  in protocol.queue.drain() if priority != PRIORITY_PROTOCOL]
+
+    if client_wrapper.reconnecting:
+        return
+    client_wrapper.reconnecting = True
+    asyncio.ensure_future(_reconnect(client_wrapper, carried))
 
-    def reconnected(f):
-        """
-        Callback function for a successful reconnection.
-        """
 
-        log.info("Reconnected! {}".format(client_wrapper.netid))
-        transport, protocol = f.result()
-        protocol.login(client_wrapper.username, client_wrapper.password)
-        protocol.channels_to_join = client_wrapper.channels_to_join
-        protocol.server_info = client_wrapper.server_info
-        protocol.netid = client_wrapper.netid
-        protocol.wrapper = client_wrapper
-        signal("netid-available").send(protocol)
-        client_wrapper.protocol = protocol
+async def _reconnect(client_wrapper, carried):
+    """
+    Retry connecting with exponential backoff and full jitter until it works
+    or reconnect_window seconds have passed.
+    """
+
+    old = client_wrapper.protocol
+    delay = old.reconnect_delay
+    deadline = time.monotonic() + old.reconnect_window
+
+    while True:
+        client_wrapper.reconnect_stats["attempts"] += 1
+        try:
+            connector = loop.create_connection(LobbyProtocol, **client_wrapper.server_info)
+            transport, protocol = await asyncio.wait_for(connector, old.connect_timeout)
+            break
+        except (OSError, asyncio.TimeoutError) as e:
+            wait = random.uniform(0, delay)
+            if time.monotonic() + wait > deadline:
+                log.critical("Could not reconnect to {}, giving up: {}".format(client_wrapper.netid, e))
+                client_wrapper.reconnecting = False
+                signal("reconnect-failed").send(client_wrapper)
+                sys.exit(2)
+            log.warning("Reconnecting to {} failed, retrying in {:.1f}s: {}".format(client_wrapper.netid, wait, e))
+            await asyncio.sleep(wait)
+            delay = min(delay * 2, old.reconnect_max_delay)
+
+    log.info("Reconnected! {}".format(client_wrapper.netid))
+    # Lines queued on the dead connection while we were away.
+    carried += [(line, origin, continued) for line, priority, origin, continued in old.queue.drain()
+                if priority != PRIORITY_PROTOCOL]
+    protocol.login(client_wrapper.username, client_wrapper.password)
+    protocol.channels_to_join = client_wrapper.channels_to_join
+    protocol.server_info = client_wrapper.server_info
+    protocol.netid = client_wrapper.netid
+    protocol.wrapper = client_wrapper
+    protocol.carried = carried
+    signal("netid-available").send(protocol)
+    client_wrapper.protocol = protocol
+    client_wrapper.reconnecting = False
+
+
+def _recovered(message):
+    """
+    Logged in again after a reconnect: resend what the old connection could
+    not, and record how long we were gone.
+    """
 
-    asyncio.async(connector).add_done_callback(reconnected)
+    client = message.client
+    # Lines said while logging in were held back; they go out after the older ones carried over.
+    held = client.queue.drain()
+    carried, client.carried = client.carried, []
+    for line, origin, continued in carried:
+        client.writeln(line, origin, continued)
+    for line, priority, origin, continued in held:
+        client.queue.push(line, priority, origin, continued)
+    if client._queue_handle is None and not client.paused:
+        # Runs once ACCEPTED has been handled and registration_complete is set.
+        client._queue_handle = loop.call_soon(client.process_queue)
+
+    wrapper = client.wrapper
+    if wrapper is None or wrapper.down_since is None:
+        return
+    downtime = time.monotonic() - wrapper.down_since
+    wrapper.down_since = None
+    stats = wrapper.reconnect_stats
+    stats["recoveries"] += 1
+    stats["last_recovery"] = downtime
+    stats["max_recovery"] = max(stats["max_recovery"], downtime)
+    stats["total_downtime"] += downtime
+    log.info("Recovered {} after {:.1f}s, resent {} lines".format(wrapper.netid, downtime, len(carried)))
+    signal("reconnected").send(client, downtime=downtime, resent=carried)
 
 
 signal("connection-lost").connect(disconnected)
+dispatch.register("ACCEPTED", _recovered)
 
 import asyncspring.plugins.core
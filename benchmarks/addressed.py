@@ -0,0 +1,54 @@
+"""
+Cost of recognising addressed messages in asyncspring.plugins.addressed
+against the trigger list it used to rebuild for every message.
+
+Run from the repository root:
+
+    python -m benchmarks.addressed [messages] [command characters]
+"""
+
+import sys
+import time
+
+from asyncspring.plugins import addressed
+
+
+class Client:
+    nickname = "glenda"
+
+
+class Message:
+    client = Client()
+
+
+def legacy(message, user, target, text):
+    prefix = message.client.nickname
+    triggers = [i.format(prefix) for i in ["{}: ", "{}, ", "{} "] + addressed.command_character_registry]
+    for trigger in triggers:
+        if text.startswith(trigger):
+            return text[len(trigger):]
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    characters = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    for i in range(characters - 1):
+        addressed.register_command_character("{}>".format(i))
+    addressed.register_command_character("!")
+    addressed.register_command("who", lambda message, user, target, args: None)
+
+    # Mostly chat, with the odd command, like a busy bridged channel.
+    texts = ["gg wp everyone {}".format(i) if i % 20 else "!who" for i in range(count)]
+    message = Message()
+    print("{} messages, {} command characters".format(count, characters))
+
+    for name, handler in (("legacy", legacy), ("compiled", addressed.handle_public_messages)):
+        start = time.perf_counter()
+        for text in texts:
+            handler(message, "bob", "main", text)
+        elapsed = time.perf_counter() - start
+        print("{:>10}: {:8.4f}s {:10.0f} messages/s".format(name, elapsed, count / elapsed))
+
+
+if __name__ == "__main__":
+    main()
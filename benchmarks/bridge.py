@@ -0,0 +1,373 @@
+"""
+End-to-end benchmark of Glenda against a fake lobby server and a fake Matrix
+homeserver (see benchmarks.fakes).
+
+Scenarios, run in order against one bridge (pick the ones after startup with
+--scenarios):
+
+    startup           Glenda.run() until every bridged channel is joined
+    lobby-to-matrix   SAID lines relayed to Matrix rooms
+    matrix-to-lobby   Matrix messages relayed as SAY lines
+    clients-flood     CLIENTS lines the bridge only has to track
+    paste             one Matrix user pastes --paste lines into one room while
+                      every other room gets a single message, at --paste-rate
+                      lobby lines/s; reports how long the other rooms wait
+
+Each reports lines/s, relay latency percentiles where there is a relay, RSS
+growth and event loop lag, and the whole run is printed (or written to
+--output) as JSON so results can be compared between versions.
+
+The lobby send rate limit is lifted by default so matrix-to-lobby measures
+the bridge rather than the configured pacing; pass --lobby-rate to keep it.
+
+Run from the repository root:
+
+    python -m benchmarks.bridge [--rooms N] [--messages N] [--output results.json]
+
+Startup alone, for a config with dozens of rooms behind a homeserver 50ms away:
+
+    python -m benchmarks.bridge --scenarios "" --rooms 48 --homeserver-delay 0.05
+
+Run that twice with --state-file and --homeserver-port (and --history to make
+the initial sync expensive) to compare a cold start with a restart that
+resumes the session.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import re
+import resource
+import subprocess
+import sys
+import time
+
+from benchmarks.fakes import FakeHomeserver, FakeLobby
+
+MARKER = re.compile(r"bench-(\d+)")
+
+
+def percentiles(samples):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+
+    def at(fraction):
+        return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+    return {"p50": at(0.50), "p90": at(0.90), "p99": at(0.99), "max": ordered[-1],
+            "mean": sum(ordered) / len(ordered)}
+
+
+def rss_kb():
+    """
+    Resident set size of this process, falling back to its peak where
+    /proc is not available.
+    """
+
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class LoopLagMonitor:
+    """
+    Measures how late the event loop wakes up a task sleeping interval seconds.
+    """
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.samples = []
+        self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            self.samples.append(loop.time() - started - self.interval)
+
+    def start(self):
+        self.samples = []
+        self._task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        self._task.cancel()
+        return percentiles(self.samples)
+
+
+class Scenario:
+    """
+    Times a block of a benchmark and collects what it measured.
+    """
+
+    def __init__(self, name, results):
+        self.name = name
+        self.results = results
+        self.lag = LoopLagMonitor()
+        self.report = {}
+
+    def __enter__(self):
+        self.rss = rss_kb()
+        self.lag.start()
+        self.started = time.monotonic()
+        return self
+
+    def __exit__(self, *exc):
+        self.report["seconds"] = time.monotonic() - self.started
+        self.report["loop_lag"] = self.lag.stop()
+        self.report["rss_growth_kb"] = rss_kb() - self.rss
+        if "lines" in self.report:
+            self.report["lines_per_second"] = self.report["lines"] / self.report["seconds"]
+        self.results[self.name] = self.report
+
+
+def make_config(args, lobby, homeserver):
+    rooms = {"bench{}".format(i): "#bench{}:{}".format(i, homeserver.domain) for i in range(args.rooms)}
+    return {
+        "general": {"debug": 0, "fast_dispatch": args.fast_dispatch},
+        "matrix": {
+            "host": homeserver.url,
+            "domain": homeserver.domain,
+            "userid": "glenda",
+            "username": "glenda",
+            "pwd": "bench",
+            "coalesce_window": args.coalesce_window,
+            "state_file": args.state_file,
+        },
+        "lobby": {
+            "host": lobby.host,
+            "port": lobby.port,
+            "username": "glenda",
+            "pwd": "bench",
+            "user_rate": args.user_rate,
+            "user_burst": args.user_burst,
+            "chat_backlog": args.chat_backlog,
+        },
+        "rooms": rooms,
+        "metrics": {"enabled": args.metrics},
+    }
+
+
+async def startup(glenda, lobby, homeserver, results):
+    with Scenario("startup", results) as scenario:
+        await glenda.run()
+        # Lobby login is deferred by the core plugin; wait for the channel joins.
+        await lobby.wait_for(lambda: len(lobby.joined) >= len(glenda.cfg["rooms"]))
+        scenario.report["rooms"] = len(glenda.cfg["rooms"])
+        scenario.report["matrix_logins"] = homeserver.logins
+        scenario.report["phases"] = dict(glenda.startup_phases)
+        scenario.report["resumed"] = glenda.resumed
+        scenario.report["filters_created"] = len(homeserver.filters)
+
+
+async def lobby_to_matrix(args, lobby, homeserver, rooms, results):
+    sent = {}
+    received = {}
+    scanned = [0]
+
+    def count():
+        for when, room_id, content in homeserver.sent[scanned[0]:]:
+            for match in MARKER.finditer(content.get("body", "")):
+                received.setdefault(int(match.group(1)), when)
+        scanned[0] = len(homeserver.sent)
+        return len(received) >= args.messages
+
+    with Scenario("lobby-to-matrix", results) as scenario:
+        for start in range(0, args.messages, args.burst):
+            lines = []
+            for seq in range(start, min(start + args.burst, args.messages)):
+                lines.append("SAID {} player{} bench-{}".format(rooms[seq % len(rooms)], seq % 50, seq))
+                sent[seq] = time.monotonic()
+            lobby.send(*lines)
+            await lobby.drain()
+            await asyncio.sleep(args.interval)
+        await homeserver.wait_for(count, args.timeout)
+        scenario.report["lines"] = args.messages
+        scenario.report["matrix_sends"] = len(homeserver.sent)
+        scenario.report["latency"] = percentiles([received[seq] - sent[seq] for seq in sent])
+
+
+async def matrix_to_lobby(args, lobby, homeserver, rooms, results):
+    sent = {}
+    received = {}
+    scanned = [0]
+
+    def count():
+        for when, verb, channel, text in lobby.said[scanned[0]:]:
+            for match in MARKER.finditer(text):
+                received.setdefault(int(match.group(1)), when)
+        scanned[0] = len(lobby.said)
+        return len(received) >= args.messages
+
+    with Scenario("matrix-to-lobby", results) as scenario:
+        for start in range(0, args.messages, args.burst):
+            for seq in range(start, min(start + args.burst, args.messages)):
+                room = rooms[seq % len(rooms)]
+                homeserver.push(homeserver.room_id("#{}:{}".format(room, homeserver.domain)),
+                                "@user{}:{}".format(seq % 50, homeserver.domain), "bench-{}".format(seq))
+                sent[seq] = time.monotonic()
+            await asyncio.sleep(args.interval)
+        await lobby.wait_for(count, args.timeout)
+        scenario.report["lines"] = args.messages
+        scenario.report["latency"] = percentiles([received[seq] - sent[seq] for seq in sent])
+
+
+async def clients_flood(args, lobby, results):
+    channel_size = 100
+    lines = ["CLIENTS flood{} {}".format(i % 50, " ".join("user{}".format(i * channel_size + j)
+                                                         for j in range(channel_size)))
+             for i in range(args.flood)]
+
+    with Scenario("clients-flood", results) as scenario:
+        for start in range(0, len(lines), args.burst):
+            lobby.send(*lines[start:start + args.burst])
+        # The bridge has processed the flood once it answers a PING sent after it.
+        lobby.send("PING clients-flood")
+        await lobby.drain()
+        await lobby.wait_for(lambda: any(rest == "clients-flood" for when, rest in lobby.pongs), args.timeout)
+        scenario.report["lines"] = len(lines)
+        scenario.report["users"] = len(lines) * channel_size
+
+
+async def paste(args, lobby, homeserver, bridge, rooms, results):
+    from asyncspring.scheduler import TokenBucket
+
+    client = bridge.lobby_client.protocol
+    unlimited = client.rate_limiter
+    client.rate_limiter = TokenBucket(args.paste_rate, 8)
+    first = len(lobby.said)
+    others = {}
+
+    def done():
+        for when, verb, channel, text in lobby.said[first:]:
+            if channel != rooms[0] and "quiet-" in text:
+                others.setdefault(channel, when)
+        return len(others) >= len(rooms) - 1 and not client.queue and not bridge.lobby_outbox.pending()
+
+    try:
+        with Scenario("paste", results) as scenario:
+            noisy = homeserver.room_id("#{}:{}".format(rooms[0], homeserver.domain))
+            for i in range(args.paste):
+                homeserver.push(noisy, "@paster:{}".format(homeserver.domain), "pasted line {} of a long log".format(i))
+            started = time.monotonic()
+            for room in rooms[1:]:
+                homeserver.push(homeserver.room_id("#{}:{}".format(room, homeserver.domain)),
+                                "@quiet:{}".format(homeserver.domain), "quiet-{}".format(room))
+            await lobby.wait_for(done, args.timeout)
+            said = lobby.said[first:]
+            scenario.report["lines"] = args.paste + len(rooms) - 1
+            scenario.report["lobby_lines"] = len(said)
+            scenario.report["noisy_room_lines"] = sum(1 for when, verb, channel, text in said if channel == rooms[0])
+            scenario.report["other_rooms_wait"] = percentiles([when - started for when in others.values()])
+            scenario.report["coalescer"] = bridge.lobby_outbox.stats()
+            scenario.report["shed"] = client.queue_stats()["shed"]
+    finally:
+        client.rate_limiter = unlimited
+
+
+async def run(args):
+    import glenda
+    from asyncspring import spring
+    if args.lobby_rate:
+        spring.LobbyProtocol.send_rate = args.lobby_rate
+    else:
+        spring.LobbyProtocol.send_rate = spring.LobbyProtocol.send_burst = 1e9
+
+    lobby = await FakeLobby().start()
+    homeserver = await FakeHomeserver(port=args.homeserver_port, delay=args.homeserver_delay,
+                                      history=args.history).start()
+    cfg = make_config(args, lobby, homeserver)
+    bridge = glenda.Glenda(cfg)
+    bridge.log.setLevel(logging.WARNING)
+    rooms = sorted(cfg["rooms"])
+
+    results = {}
+    report = {
+        "benchmark": "bridge",
+        "label": args.label,
+        "revision": revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": {k.replace("_", "-"): v for k, v in sorted(vars(args).items()) if k != "output"},
+        "scenarios": results,
+    }
+
+    rss = rss_kb()
+    try:
+        await startup(bridge, lobby, homeserver, results)
+        if "lobby-to-matrix" in args.scenarios:
+            await lobby_to_matrix(args, lobby, homeserver, rooms, results)
+        if "matrix-to-lobby" in args.scenarios:
+            await matrix_to_lobby(args, lobby, homeserver, rooms, results)
+        if "clients-flood" in args.scenarios:
+            await clients_flood(args, lobby, results)
+        if "paste" in args.scenarios:
+            await paste(args, lobby, homeserver, bridge, rooms, results)
+    finally:
+        report["rss_growth_kb"] = rss_kb() - rss
+        await bridge.stop()
+        lobby.close()
+        await homeserver.close()
+
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end benchmark of the Glenda bridge.")
+    parser.add_argument("--scenarios", default="lobby-to-matrix,matrix-to-lobby,clients-flood",
+                        help="comma-separated scenarios to run after startup")
+    parser.add_argument("--rooms", type=int, default=10, help="bridged rooms")
+    parser.add_argument("--homeserver-delay", type=float, default=0,
+                        help="seconds the fake homeserver holds every request")
+    parser.add_argument("--messages", type=int, default=2000, help="messages relayed in each direction")
+    parser.add_argument("--burst", type=int, default=50, help="messages injected at a time")
+    parser.add_argument("--interval", type=float, default=0.01, help="seconds between bursts")
+    parser.add_argument("--history", type=int, default=0, help="events per room in the initial sync")
+    parser.add_argument("--state-file", default=None, help="Matrix state file; run twice to time a restart")
+    parser.add_argument("--homeserver-port", type=int, default=0,
+                        help="fixed port for the fake homeserver, so a state file matches it on the next run")
+    parser.add_argument("--flood", type=int, default=2000, help="CLIENTS lines of 100 users each")
+    parser.add_argument("--coalesce-window", type=float, default=0.25, help="Outbox coalescing window")
+    parser.add_argument("--lobby-rate", type=float, default=0, help="lobby lines/s, 0 for unlimited")
+    parser.add_argument("--user-rate", type=float, default=0.5, help="messages/s each Matrix user may send")
+    parser.add_argument("--user-burst", type=int, default=3, help="messages each Matrix user may send at once")
+    parser.add_argument("--chat-backlog", type=int, default=100, help="lobby lines waiting per channel")
+    parser.add_argument("--paste", type=int, default=50, help="lines pasted in the paste scenario")
+    parser.add_argument("--paste-rate", type=float, default=2.0, help="lobby lines/s during the paste scenario")
+    parser.add_argument("--metrics", action="store_true", help="run with metrics enabled")
+    parser.add_argument("--fast-dispatch", action="store_true", help="run with general.fast_dispatch")
+    parser.add_argument("--timeout", type=float, default=120, help="seconds to wait for a scenario")
+    parser.add_argument("--label", default=None, help="free-form label stored with the results")
+    parser.add_argument("--output", default=None, help="write JSON here instead of stdout")
+    args = parser.parse_args()
+    args.scenarios = args.scenarios.split(",")
+    # Only problems go to stderr; debug logging would skew the numbers.
+    logging.basicConfig(level=logging.WARNING, format="%(levelname)s %(name)s: %(message)s")
+
+    from asyncspring import spring
+    report = spring.loop.run_until_complete(run(args))
+
+    data = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(data + "\n")
+    else:
+        print(data)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
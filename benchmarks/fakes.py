@@ -0,0 +1,322 @@
+"""
+Local stand-ins for a SpringRTS lobby server and a Matrix homeserver, for
+driving Glenda and asyncspring without production servers.
+
+Both record what they receive with time.monotonic() stamps, so a benchmark can
+match what it injected on one side with what came out on the other.
+"""
+
+import asyncio
+import collections
+import json
+import time
+
+from aiohttp import web
+
+
+class _Recorder:
+    """
+    Lets callers wait until what was recorded satisfies a condition.
+    """
+
+    def __init__(self):
+        self._changed = asyncio.Event()
+
+    def _notify(self):
+        self._changed.set()
+
+    async def wait_for(self, predicate, timeout=60):
+        """
+        Wait until predicate() is true, or raise asyncio.TimeoutError.
+        """
+
+        deadline = time.monotonic() + timeout
+        while not predicate():
+            self._changed.clear()
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise asyncio.TimeoutError()
+            try:
+                await asyncio.wait_for(self._changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+
+
+class FakeLobby(_Recorder):
+    """
+    Accepts any LOGIN, answers JOIN with JOIN and CLIENTS, PING with PONG, and
+    records everything the client sends. Lines are pushed to every connected
+    client with send().
+    """
+
+    greeting = "TASSERVER 0.38-33-ga5f3b28 * 8201 0"
+
+    def __init__(self, host="127.0.0.1", port=0):
+        super().__init__()
+        self.host = host
+        self.port = port
+        self.server = None
+        self.writers = []
+        # (time.monotonic(), line) for every line received
+        self.received = []
+        # (time.monotonic(), verb, channel, text) for every SAY and SAYEX
+        self.said = []
+        self.joined = set()
+        self.pongs = []
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    def close(self):
+        for writer in self.writers:
+            writer.close()
+        if self.server is not None:
+            self.server.close()
+
+    def send(self, *lines):
+        """
+        Send lines to every connected client in one write each.
+        """
+
+        data = "".join(line + "\n" for line in lines).encode("utf-8")
+        for writer in self.writers:
+            writer.write(data)
+
+    async def drain(self):
+        for writer in self.writers:
+            await writer.drain()
+
+    async def _handle(self, reader, writer):
+        self.writers.append(writer)
+        writer.write((self.greeting + "\n").encode())
+        try:
+            while True:
+                data = await reader.readline()
+                if not data:
+                    break
+                self._line(writer, data.decode("utf-8", "replace").rstrip("\r\n"))
+        except ConnectionError:
+            pass
+        finally:
+            self.writers.remove(writer)
+            writer.close()
+
+    def _line(self, writer, line):
+        now = time.monotonic()
+        self.received.append((now, line))
+        verb, _, rest = line.partition(" ")
+
+        if verb in ("SAY", "SAYEX"):
+            channel, _, text = rest.partition(" ")
+            self.said.append((now, verb, channel, text))
+        elif verb == "LOGIN":
+            writer.write("ACCEPTED {}\n".format(rest.split(" ", 1)[0]).encode())
+        elif verb == "JOIN":
+            channel = rest.split(" ", 1)[0].lstrip("#")
+            self.joined.add(channel)
+            writer.write("JOIN {}\nCLIENTS {} {}\n".format(channel, channel, "glenda").encode())
+        elif verb == "PING":
+            writer.write("{}\n".format(("PONG " + rest).rstrip()).encode())
+        elif verb == "PONG":
+            self.pongs.append((now, rest))
+
+        self._notify()
+
+
+class FakeHomeserver(_Recorder):
+    """
+    Implements the client-server API calls AsyncMatrixClient makes: login,
+    join, long-polling sync fed by push(), send, room member state, profiles
+    and media downloads of files added with upload(). Room aliases #name:domain join as !name:domain.
+
+    Access tokens are "bench-<user>", so a token issued by one instance is
+    accepted by the next unless it is listed in revoked. A sync without a
+    since token returns history events in every joined room, like the full
+    initial sync of a busy room.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, domain="bench", sync_batch=100, delay=0, history=0):
+        super().__init__()
+        self.host = host
+        self.port = port
+        self.domain = domain
+        self.sync_batch = sync_batch
+        # seconds every request is held, like the round trip to a real homeserver
+        self.delay = delay
+        self.history = history
+        self.revoked = set()
+        self.runner = None
+        self.events = asyncio.Queue()
+        self.batch = 0
+        self.pushed = 0
+        self.logins = 0
+        # filter ID -> definition, for every filter uploaded
+        self.filters = {}
+        # filter query parameter of every sync
+        self.sync_filters = []
+        self.syncs = 0
+        self.joined = set()
+        # (time.monotonic(), room_id, content) for every event sent
+        self.sent = []
+        # statuses to answer the next requests with, instead of handling them
+        self.errors = collections.deque()
+        # statuses to answer the next sends with after storing their events
+        self.lost_replies = collections.deque()
+        # (room_id, txn ID) -> event ID, so a repeated send is not stored twice
+        self.transactions = {}
+        self.member_lookups = 0
+        # mxc:// URI -> (bytes, content type)
+        self.media = {}
+        self.downloads = 0
+
+    @property
+    def url(self):
+        return "http://{}:{}".format(self.host, self.port)
+
+    async def start(self):
+        app = web.Application(middlewares=[self._delay])
+        api = "/_matrix/client/r0"
+        app.router.add_post(api + "/login", self._login)
+        app.router.add_get(api + "/account/whoami", self._whoami)
+        app.router.add_post(api + "/join/{room}", self._join)
+        app.router.add_post(api + "/user/{user}/filter", self._filter)
+        app.router.add_get(api + "/sync", self._sync)
+        app.router.add_put(api + "/rooms/{room}/send/{type}/{txn}", self._send)
+        app.router.add_get(api + "/rooms/{room}/state/m.room.member/{user}", self._member)
+        app.router.add_get(api + "/profile/{user}/displayname", self._profile)
+        app.router.add_get("/_matrix/media/r0/download/{server}/{media}", self._download)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        return self
+
+    async def close(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+    @web.middleware
+    async def _delay(self, request, handler):
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        if self.errors:
+            status = self.errors.popleft()
+            return web.json_response({"errcode": "M_BENCH", "error": "Injected error"}, status=status)
+        return await handler(request)
+
+    def room_id(self, alias):
+        return "!" + alias.lstrip("#!")
+
+    def push(self, room_id, sender, body, msgtype="m.text", url=None):
+        """
+        Queue an m.room.message for the next sync response.
+        """
+
+        self.pushed += 1
+        content = {"msgtype": msgtype, "body": body}
+        if url is not None:
+            content["url"] = url
+        self.events.put_nowait((room_id, {
+            "type": "m.room.message",
+            "sender": sender,
+            "event_id": "$bench{}".format(self.pushed),
+            "origin_server_ts": int(time.time() * 1000),
+            "content": content,
+        }))
+
+    def upload(self, data, content_type="application/octet-stream"):
+        """
+        Make data downloadable and return its mxc:// URI.
+        """
+
+        mxc_url = "mxc://{}/media{}".format(self.domain, len(self.media))
+        self.media[mxc_url] = (data, content_type)
+        return mxc_url
+
+    async def _login(self, request):
+        self.logins += 1
+        content = await request.json()
+        return web.json_response({
+            "access_token": "bench-{}".format(content.get("user")),
+            "user_id": "@{}:{}".format(content.get("user"), self.domain),
+            "device_id": content.get("device_id") or "BENCH",
+        })
+
+    async def _whoami(self, request):
+        token = request.headers.get("Authorization", "")[len("Bearer "):]
+        if not token.startswith("bench-") or token in self.revoked:
+            return web.json_response({"errcode": "M_UNKNOWN_TOKEN", "error": "Unknown token"}, status=401)
+        return web.json_response({"user_id": "@{}:{}".format(token[len("bench-"):], self.domain)})
+
+    async def _filter(self, request):
+        filter_id = str(len(self.filters))
+        self.filters[filter_id] = await request.json()
+        return web.json_response({"filter_id": filter_id})
+
+    async def _join(self, request):
+        room_id = self.room_id(request.match_info["room"])
+        self.joined.add(room_id)
+        self._notify()
+        return web.json_response({"room_id": room_id})
+
+    async def _sync(self, request):
+        self.syncs += 1
+        self.sync_filters.append(request.query.get("filter"))
+        events = []
+        if "since" in request.query:
+            timeout = int(request.query.get("timeout", "0")) / 1000
+            try:
+                events.append(await asyncio.wait_for(self.events.get(), timeout))
+            except asyncio.TimeoutError:
+                pass
+            while len(events) < self.sync_batch and not self.events.empty():
+                events.append(self.events.get_nowait())
+
+        else:
+            for room_id in sorted(self.joined):
+                for i in range(self.history):
+                    events.append((room_id, {
+                        "type": "m.room.message",
+                        "sender": "@user{}:{}".format(i % 50, self.domain),
+                        "event_id": "$history{}".format(i),
+                        "origin_server_ts": 0,
+                        "content": {"msgtype": "m.text", "body": "history {} ".format(i) * 8},
+                    }))
+
+        rooms = {}
+        for room_id, event in events:
+            rooms.setdefault(room_id, {"timeline": {"events": []}})["timeline"]["events"].append(event)
+        self.batch += 1
+        return web.json_response({"next_batch": "s{}".format(self.batch), "rooms": {"join": rooms}})
+
+    async def _send(self, request):
+        key = (request.match_info["room"], request.match_info["txn"])
+        event_id = self.transactions.get(key)
+        if event_id is None:
+            content = json.loads(await request.text())
+            self.sent.append((time.monotonic(), request.match_info["room"], content))
+            event_id = self.transactions[key] = "$sent{}".format(len(self.sent))
+            self._notify()
+        if self.lost_replies:
+            status = self.lost_replies.popleft()
+            return web.json_response({"errcode": "M_BENCH", "error": "Injected error"}, status=status)
+        return web.json_response({"event_id": event_id})
+
+    async def _member(self, request):
+        self.member_lookups += 1
+        user = request.match_info["user"]
+        return web.json_response({"membership": "join", "displayname": user[1:].split(":", 1)[0]})
+
+    async def _download(self, request):
+        found = self.media.get("mxc://{server}/{media}".format(**request.match_info))
+        if found is None:
+            return web.json_response({"errcode": "M_NOT_FOUND", "error": "Not found"}, status=404)
+        self.downloads += 1
+        return web.Response(body=found[0], content_type=found[1])
+
+    async def _profile(self, request):
+        user = request.match_info["user"]
+        return web.json_response({"displayname": user[1:].split(":", 1)[0]})
@@ -0,0 +1,79 @@
+"""
+Throughput of asyncspring.framer.LineFramer against the str buffer that
+LobbyProtocol.data_received used before it.
+
+Run from the repository root:
+
+    python -m benchmarks.framer [lines] [read size]
+"""
+
+import sys
+import time
+
+from asyncspring.framer import LineFramer
+
+
+class LegacyFramer:
+    """
+    The previous data_received loop, kept verbatim for comparison.
+    """
+
+    def __init__(self):
+        self.buf = ""
+
+    def feed(self, data):
+        lines = []
+        data = data.decode()
+
+        self.buf += data
+        while "\n" in self.buf:
+            index = self.buf.index("\n")
+            line_received = self.buf[:index].strip()
+            self.buf = self.buf[index + 1:]
+            lines.append(line_received)
+        return lines
+
+
+def login_flood(count):
+    """
+    Build the ADDUSER/CLIENTS burst a lobby server sends right after login.
+    """
+
+    lines = []
+    for i in range(count):
+        if i % 10:
+            lines.append("ADDUSER Player{0} DE {0} {0} SpringLobby 0.270".format(i))
+        else:
+            names = " ".join("Player{}".format(j) for j in range(i, i + 50))
+            lines.append("CLIENTS main {}".format(names))
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+def chunks(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+def run(framer, reads):
+    start = time.perf_counter()
+    received = 0
+    for data in reads:
+        received += len(framer.feed(data))
+    return received, time.perf_counter() - start
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    read_size = int(sys.argv[2]) if len(sys.argv) > 2 else 65536
+
+    data = login_flood(count)
+    reads = chunks(data, read_size)
+    print("{} lines, {} bytes, {} reads of {} bytes".format(count, len(data), len(reads), read_size))
+
+    for name, framer in (("legacy", LegacyFramer()), ("LineFramer", LineFramer())):
+        received, elapsed = run(framer, reads)
+        assert received == count, (name, received)
+        print("{:>12}: {:8.3f}s {:12.0f} lines/s".format(name, elapsed, count / elapsed))
+
+
+if __name__ == "__main__":
+    main()
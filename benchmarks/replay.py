@@ -0,0 +1,165 @@
+"""
+Replay a lobby capture (see asyncspring.capture) through LobbyProtocol and
+report how fast it was processed, as JSON.
+
+Without a capture file a synthetic one is generated: a login burst of ADDUSER
+and CLIENTS lines followed by chat and status changes from the same users.
+
+Run from the repository root:
+
+    python -m benchmarks.replay [--capture lobby.capture.gz] [--speed 0] [--output results.json]
+"""
+
+import argparse
+import asyncio
+import importlib
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+
+from asyncblink import signal
+
+from asyncspring import capture, signals, spring
+from benchmarks.bridge import LoopLagMonitor, revision, rss_kb
+
+
+class NullTransport(asyncio.Transport):
+    """
+    Counts what the protocol writes and throws it away.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.lines = 0
+        self.closed = False
+
+    def write(self, data):
+        self.lines += data.count(b"\n")
+
+    def writelines(self, list_of_data):
+        for data in list_of_data:
+            self.write(data)
+
+    def is_closing(self):
+        return self.closed
+
+    def close(self):
+        self.closed = True
+
+    def abort(self):
+        self.closed = True
+
+
+def synthesize(path, users=5000, chat=20000, seconds=600):
+    """
+    Write a capture of a busy evening: everyone logging in at once, then chat
+    and status changes spread over seconds.
+    """
+
+    rng = random.Random(0)
+    names = ["Player{}".format(i) for i in range(users)]
+    channels = ["main", "newbies", "tournament", "weekend"] + ["clan{}".format(i) for i in range(20)]
+    now = time.monotonic()
+
+    with capture.open_capture(path, "w") as f:
+        f.write("# capture synthesized {} users {} chat lines\n".format(users, chat))
+        for name in names:
+            f.write("{:.6f} < ADDUSER {} DE {}\n".format(now, name, rng.randrange(100000)))
+        for channel in channels:
+            for start in range(0, users, 200):
+                members = " ".join(n for n in names[start:start + 200] if rng.random() < 0.2)
+                f.write("{:.6f} < CLIENTS {} {}\n".format(now, channel, members))
+        for i in range(chat):
+            now += rng.expovariate(chat / seconds)
+            name = rng.choice(names)
+            if i % 5 == 0:
+                f.write("{:.6f} < CLIENTSTATUS {} {}\n".format(now, name, rng.randrange(128)))
+            else:
+                f.write("{:.6f} < SAID {} {} gg wp {}\n".format(now, rng.choice(channels), name, i))
+
+
+def make_protocol():
+    """
+    A LobbyProtocol on a NullTransport, set up the way spring.connect() does.
+    """
+
+    protocol = spring.LobbyProtocol()
+    protocol.connection_made(NullTransport())
+    protocol.wrapper = spring.LobbyProtocolWrapper(protocol)
+    protocol.server_info = {"host": "replay", "port": 0, "ssl": False}
+    protocol.netid = "replay"
+    signal("netid-available").send(protocol)
+    return protocol
+
+
+async def run(args, path):
+    protocol = make_protocol()
+    lag = LoopLagMonitor()
+    rss = rss_kb()
+    lag.start()
+    started = time.monotonic()
+    lines = await capture.replay(protocol, path, args.speed, args.chunk_size)
+    seconds = time.monotonic() - started
+    report = {
+        "lines": lines,
+        "seconds": seconds,
+        "lines_per_second": lines / seconds if seconds else None,
+        "lines_sent": protocol.transport.lines,
+        "loop_lag": lag.stop(),
+        "rss_growth_kb": rss_kb() - rss,
+    }
+    if signals.timings is not None:
+        report["receivers"] = signals.receiver_stats()
+    protocol.work = False
+    protocol.heartbeat.stop()
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a lobby capture through LobbyProtocol.")
+    parser.add_argument("--capture", default=None, help="capture file, synthesized if not given")
+    parser.add_argument("--speed", type=float, default=0, help="replay speed, 0 for as fast as possible")
+    parser.add_argument("--chunk-size", type=int, default=4096, help="bytes per data_received call")
+    parser.add_argument("--plugins", default="asyncspring.plugins.lobbystate",
+                        help="comma-separated plugins to load")
+    parser.add_argument("--fast-send", action="store_true", help="use signals.enable_fast_send()")
+    parser.add_argument("--profile", action="store_true", help="time every receiver (implies --fast-send)")
+    parser.add_argument("--label", default=None, help="free-form label stored with the results")
+    parser.add_argument("--output", default=None, help="write JSON here instead of stdout")
+    args = parser.parse_args()
+
+    for plugin in filter(None, args.plugins.split(",")):
+        importlib.import_module(plugin)
+    if args.fast_send or args.profile:
+        signals.enable_fast_send(timing=args.profile)
+
+    path = args.capture
+    if path is None:
+        path = os.path.join(tempfile.mkdtemp(), "synthetic.capture")
+        synthesize(path)
+
+    report = {
+        "benchmark": "replay",
+        "label": args.label,
+        "revision": revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": {"capture": args.capture, "speed": args.speed, "chunk-size": args.chunk_size,
+                       "plugins": args.plugins, "fast-send": args.fast_send, "profile": args.profile},
+        "result": spring.loop.run_until_complete(run(args, path)),
+    }
+
+    data = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(data + "\n")
+    else:
+        print(data)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,104 @@
+"""
+Membership tracking cost of asyncspring.plugins.tracking.Registry against the
+flat (nick, channel) set it replaced.
+
+Run from the repository root:
+
+    python -m benchmarks.tracking [users] [channels] [channels per user]
+"""
+
+import random
+import sys
+import time
+
+from asyncspring.plugins.tracking import Registry
+
+
+class LegacyRegistry:
+    """
+    The previous flat set, with the scans User.channels, Channel.users,
+    handle_nick and handle_quit used to do.
+    """
+
+    def __init__(self):
+        self.mappings = set()
+
+    def add(self, nick, channel):
+        self.mappings.add((nick, channel))
+
+    def discard(self, nick, channel):
+        self.mappings.discard((nick, channel))
+
+    def user_channels(self, nick):
+        return list(map(lambda x: x[1], filter(lambda x: x[0] == nick, self.mappings)))
+
+    def channel_users(self, channel):
+        return list(map(lambda x: x[0], filter(lambda x: x[1] == channel, self.mappings)))
+
+    def rename(self, old_nick, new_nick):
+        for i in set(self.mappings):
+            if i[0] == old_nick:
+                self.mappings.discard(i)
+                self.mappings.add((new_nick, i[1]))
+
+    def remove_user(self, nick):
+        for channel in set(self.user_channels(nick)):
+            self.mappings.remove((nick, channel))
+
+
+class IndexedRegistry:
+    """
+    Adapts Registry to the interface above.
+    """
+
+    def __init__(self):
+        self.registry = Registry()
+        self.add = self.registry.add
+        self.discard = self.registry.discard
+        self.rename = self.registry.rename
+        self.remove_user = self.registry.remove_user
+
+    def user_channels(self, nick):
+        return list(self.registry.user_channels.get(nick, ()))
+
+    def channel_users(self, channel):
+        return list(self.registry.channel_users.get(channel, ()))
+
+
+def timed(f, *args):
+    start = time.perf_counter()
+    f(*args)
+    return time.perf_counter() - start
+
+
+def run(registry, memberships, nicks, channels, operations):
+    results = {}
+    results["join"] = timed(lambda: [registry.add(n, c) for n, c in memberships])
+    sample = random.Random(1).sample(nicks, operations)
+    results["user channels"] = timed(lambda: [registry.user_channels(n) for n in sample])
+    results["channel users"] = timed(lambda: [registry.channel_users(c) for c in channels[:operations]])
+    results["rename"] = timed(lambda: [registry.rename(n, n + "_") for n in sample])
+    results["quit"] = timed(lambda: [registry.remove_user(n + "_") for n in sample])
+    return results
+
+
+def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    channel_count = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    per_user = int(sys.argv[3]) if len(sys.argv) > 3 else 5
+    operations = 200
+
+    rng = random.Random(0)
+    nicks = ["Player{}".format(i) for i in range(users)]
+    channels = ["#chan{}".format(i) for i in range(channel_count)]
+    memberships = [(n, c) for n in nicks for c in rng.sample(channels, per_user)]
+    print("{} users, {} channels, {} memberships, {} lookups/renames/quits".format(
+        users, channel_count, len(memberships), operations))
+
+    for name, registry in (("legacy", LegacyRegistry()), ("Registry", IndexedRegistry())):
+        for operation, elapsed in run(registry, memberships, nicks, channels, operations).items():
+            print("{:>10} {:>14}: {:9.4f}s".format(name, operation, elapsed))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,25 @@
 #!/usr/bin/env python3
 
 import sys
+import hashlib
+import json
 import logging
 import asyncio
+import time
 import yaml
 
-from asyncspring import spring
+from asyncspring import metrics, signals, spring
+from asyncspring.capture import Recorder
+from asyncspring.coalesce import Coalescer
+# Lobby channel membership, for "!who" asked from Matrix
+import asyncspring.plugins.lobbystate
+from asyncspring.plugins import addressed
 
-from matrix_client.client import MatrixClient
-from matrix_client.api import MatrixRequestError, MatrixHttpLibError
-from requests.exceptions import MissingSchema
+from asyncmatrix import AsyncMatrixClient, MatrixHttpError, MatrixRequestError, Outbox, SessionStore
+from asyncmatrix.echo import EchoLedger
+from asyncmatrix.ingress import Ingress
 
-from urllib.parse import urlparse
+from asyncmatrix.media import MediaCache, MediaRelay
 
 loop = asyncio.get_event_loop()
 # loop.set_debug(True)
@@ -19,8 +27,14 @@ loop = asyncio.get_event_loop()
 
 FORMAT = "[%(asctime)s] [%(name)s] [%(levelname)s]  %(message)s (%(filename)s:%(lineno)d)"
 
-logging.basicConfig(filename='glenda.log', level=logging.DEBUG, format=FORMAT)
-logging.getLogger("urllib3").setLevel(logging.WARNING)
+echoes_suppressed = metrics.counter("glenda_echoes_suppressed_total",
+                                    "Relayed messages that came back through another bridge and were dropped",
+                                    ["direction", "room"])
+
+MEDIA_MSGTYPES = ("m.image", "m.file", "m.video", "m.audio")
+
+matrix_request_seconds = metrics.histogram("glenda_matrix_request_seconds", "Matrix API request latency",
+                                           ["method", "endpoint", "status"])
 
 
 class Glenda:
@@ -35,10 +49,46 @@ class Glenda:
         self.matrix_rooms = {}
         self.lobby_rooms = {}
         self.matrix_client = None
+        self.matrix_outbox = None
         self.lobby_client = None
+        self.lobby_recorder = None
+        self.media_relay = None
+        self.metrics_server = None
+        # Tasks run alongside the bridge, cancelled by stop()
+        self.background_tasks = []
+        # phase -> seconds it took, filled in by run()
+        self.startup_phases = {}
+        # Matrix session and sync token kept across restarts, if configured
+        self.session = SessionStore(self.cfg["matrix"]["state_file"]) if self.cfg["matrix"].get("state_file") else None
+        self.resumed = False
+        self.sync_filter_id = None
+        # What has been relayed in each bridged room, to drop it when it comes back
+        self.echoes = EchoLedger(size=self.cfg["general"].get("echo_history", 256),
+                                 window=self.cfg["general"].get("echo_window", 30))
+
+        # Matrix messages on their way to the lobby, merged per sender when
+        # they come faster than the sender's budget
+        self.lobby_outbox = Coalescer(self.relay_to_lobby,
+                                      window=self.cfg["lobby"].get("coalesce_window", 1),
+                                      rate=self.cfg["lobby"].get("user_rate", 0.5),
+                                      burst=self.cfg["lobby"].get("user_burst", 3))
+
+        # Matrix events wait here until on_room_message gets to them.
+        self.matrix_ingress = Ingress(self.on_room_message, name="matrix",
+                                      maxsize=self.cfg["matrix"].get("ingress_size", 1000),
+                                      policy=self.cfg["matrix"].get("ingress_policy", "drop-oldest"))
+
+    def on_matrix_event(self, room, event):
+        """
+        Listener for bridged rooms: stamp the event and queue it for on_room_message.
+        Membership events only feed the display-name cache and are not queued.
+        """
+        if event["type"] != "m.room.message":
+            return None
+        return self.matrix_ingress.put(room, event, time.monotonic() if metrics.enabled else None)
 
     # Called when a message is recieved from the matrix
-    def on_room_message(self, room, event):
+    async def on_room_message(self, room, event, received=None):
         if event['sender'] == "@{}:{}".format(self.cfg["matrix"]["userid"], self.cfg["matrix"]["domain"]):
             # ignore messages sent by ourself
             return
@@ -50,32 +100,72 @@ class Glenda:
             return
 
         lobby_room = self.matrix_rooms[event["room_id"]]
-        if event['content']['msgtype'] == "m.text":
-            user = self.matrix_client.get_user(event['sender'])
-            user_display_name = user.get_display_name()
-            self.lobby_client.say(lobby_room, "<{}> {}".format(user_display_name, event['content']['body']))
-        elif event['content']['msgtype'] == "m.emote":
-            user = self.matrix_client.get_user(event['sender'])
-            user_display_name = user.get_display_name()
-            self.lobby_client.say_ex(lobby_room, "<{}> {}".format(user_display_name, event['content']['body']))
-        elif event['content']['msgtype'] == "m.image":
-            user = self.matrix_client.get_user(event['sender'])
-            user_display_name = user.get_display_name()
-            mxc_url = event['content']['url']
-            o = urlparse(mxc_url)
-            domain = o.netloc
-            pic_code = o.path
-            url = "https://{0}/_matrix/media/v1/download/{0}{1}".format(domain, pic_code)
-            msg = "<{}> {}".format(user_display_name, url)
-            self.lobby_client.say_ex(lobby_room, "<{}> {}".format(user_display_name, msg))
-
-    def setup_bridge(self, lobby_room, matrix_room):
-        self.lobby_client.channels_to_join.append("#{}".format(lobby_room))
+        origin = (lobby_room, received) if received is not None else None
+        msgtype = event['content'].get('msgtype')
+        if msgtype in ("m.text", "m.emote"):
+            body = event['content']['body']
+        elif msgtype in MEDIA_MSGTYPES and event['content'].get('url'):
+            body = "{} {}".format(event['content'].get('body', ""), self.media_link(event['content']['url']))
+        else:
+            return
+        if msgtype == "m.text" and body.strip() == self.cfg["lobby"].get("command_character", "!") + "who":
+            self.on_matrix_who_command(lobby_room)
+
+        user_display_name = await self.matrix_client.get_display_name(event['sender'], event['room_id'])
+        # Another bridge may have merged several of our lines into one message.
+        lines = [line for line in body.splitlines() if line.strip()]
+        if lines and all(self.echoes.is_echo(lobby_room, user_display_name, line) for line in lines):
+            if metrics.enabled:
+                echoes_suppressed.inc("matrix-to-lobby", lobby_room)
+            return
+        self.lobby_outbox.add(lobby_room, user_display_name, body, msgtype != "m.text", origin)
+
+    def relay_to_lobby(self, lobby_room, user_display_name, body, emote, origin):
+        """
+        Say a message, or a burst merged by lobby_outbox, in the lobby.
+        """
+        # Recorded as the lobby will show it, with the line breaks dropped.
+        self.echoes.record(lobby_room, user_display_name, body.replace("\n", "").replace("\r", ""))
+        if emote:
+            self.lobby_client.say_ex(lobby_room, "<{}> {}".format(user_display_name, body), origin)
+        else:
+            self.lobby_client.say(lobby_room, "<{}> {}".format(user_display_name, body), origin)
+
+    def media_link(self, mxc_url):
+        """
+        Short link to the relay's copy of the media, or the homeserver's own
+        download link when the relay is off or the URI is not an mxc:// one.
+        """
+        if not mxc_url.startswith("mxc://"):
+            return mxc_url
+        if self.media_relay is None:
+            return self.matrix_client.media_url(mxc_url)
+        try:
+            return self.media_relay.link(mxc_url, prefetch=self.cfg["media"].get("prefetch", False))
+        except ValueError as e:
+            self.log.warning("Not linking media: {}".format(e))
+            return ""
+
+    async def start_media(self):
+        """
+        Serve Matrix media to lobby users from a local cache, if configured.
+        """
+        cfg = self.cfg.get("media") or {}
+        if not cfg.get("enabled"):
+            return
+        cache = MediaCache(cfg.get("directory", "media"), max_bytes=cfg.get("max_size_mb", 256) * 1024 * 1024)
+        host, port = cfg.get("host", "127.0.0.1"), cfg.get("port", 8009)
+        base_url = cfg.get("public_url") or "http://{}:{}".format(host, port)
+        self.media_relay = MediaRelay(self.matrix_client, cache, base_url)
+        await self.media_relay.start(host, port)
+        self.log.info("Serving media on {}:{}, {} files cached".format(host, port, len(cache)))
+
+    async def setup_bridge(self, lobby_room, matrix_room):
         try:
-            response = self.matrix_client.join_room(matrix_room)
-            response.add_listener(self.on_room_message)
-            self.lobby_rooms[lobby_room] = response
-            self.matrix_rooms[response.room_id] = lobby_room
+            room_id = await self.matrix_client.join_room(matrix_room)
+            self.matrix_client.add_room_listener(room_id, self.on_matrix_event)
+            self.lobby_rooms[lobby_room] = room_id
+            self.matrix_rooms[room_id] = lobby_room
         except MatrixRequestError as e:
             if e.code == 400:
                 self.log.error("Room ID/Alias in the wrong format")
@@ -84,14 +174,181 @@ class Glenda:
                 self.log.error("Couldn't find  %s room." % (matrix_room))
                 sys.exit(12)
 
-    async def run(self):
+    def send_text(self, lobby_room, text, received=None):
+        """
+        Queue text for the Matrix room bridged to lobby_room.
+        """
+        self.matrix_outbox.send_text(self.lobby_rooms[lobby_room], text, received)
+
+    def send_emote(self, lobby_room, text, received=None):
+        self.matrix_outbox.send_emote(self.lobby_rooms[lobby_room], text, received)
+
+    def is_lobby_echo(self, lobby_room, user, text):
+        """
+        Check whether a lobby message is our own relaying coming back, and
+        remember it as relayed if it is not.
+        """
+        if self.echoes.is_echo(lobby_room, user, text):
+            if metrics.enabled:
+                echoes_suppressed.inc("lobby-to-matrix", lobby_room)
+            return True
+        self.echoes.record(lobby_room, user, text)
+        return False
+
+    # Called when something is said in a lobby channel
+    def on_lobby_said(self, parsed, user, target, text):
+        # The lobby may join a channel before its Matrix room has been joined.
+        if user == self.cfg["lobby"]["username"] or target not in self.lobby_rooms:
+            return
+        if self.is_lobby_echo(target, user, text):
+            return
+        self.send_text(target, "<{}> {}".format(user, text), time.monotonic() if metrics.enabled else None)
 
+    def on_lobby_saidex(self, parsed, user, target, text):
+        if user == self.cfg["lobby"]["username"] or target not in self.lobby_rooms:
+            return
+        if self.is_lobby_echo(target, user, text):
+            return
+        self.send_emote(target, "<{}> {}".format(user, text), time.monotonic() if metrics.enabled else None)
+
+    def on_lobby_reconnected(self, client, downtime, resent):
+        """
+        Lines from Matrix resent after a reconnect may be older than the echo
+        window by now; remember them afresh.
+        """
+        for line, origin, continued in resent:
+            if origin is None:
+                continue
+            if isinstance(line, bytes):
+                line = line.decode("utf-8", "replace")
+            verb, lobby_room, text = (line.split(" ", 2) + ["", ""])[:3]
+            if lobby_room in self.lobby_rooms:
+                self.echoes.record(lobby_room, self.cfg["lobby"]["username"], text)
+
+    # Bot commands said in a bridged lobby channel, e.g. "!who"
+    def on_who_command(self, message, user, target, args):
+        room_id = self.lobby_rooms.get(target)
+        if room_id is None:
+            return
+        names = sorted(self.matrix_client.display_names.names(room_id))
+        message.client.say(target, "On Matrix ({}): {}".format(len(names), ", ".join(names) or "nobody seen yet"))
+
+    # "!who" said in a bridged Matrix room, answered from what the lobby told us
+    def on_matrix_who_command(self, lobby_room):
+        state = getattr(self.lobby_client, "lobby_state", None)
+        names = state.who(lobby_room) if state is not None else []
+        self.send_text(lobby_room, "In the lobby ({}): {}".format(len(names), ", ".join(names) or "nobody seen yet"))
+
+    def on_lag_command(self, message, user, target, args):
+        lag = message.client.lag_stats()
+        queue = message.client.queue_stats()
+        message.client.say(target, "Lobby lag p50 {:.2f}s p95 {:.2f}s, {} lines queued ({} shed), {} to Matrix "
+                                   "pending".format(lag["p50"], lag["p95"], queue["depth"], queue["shed"],
+                                                    self.matrix_outbox.pending()))
+
+    def on_matrix_delivery(self, room_id, received):
+        spring.relay_latency.observe(time.monotonic() - received, "lobby-to-matrix", self.matrix_rooms[room_id])
+
+    @staticmethod
+    def on_matrix_request(method, endpoint, status, seconds):
+        if metrics.enabled:
+            matrix_request_seconds.observe(seconds, method, endpoint, str(status))
+
+    async def start_metrics(self):
+        """
+        Export metrics over HTTP and/or to a file, as configured.
+        """
+        cfg = self.cfg.get("metrics") or {}
+        if not cfg.get("enabled"):
+            return
+        metrics.enable()
+        if cfg.get("port"):
+            self.metrics_server = await metrics.serve(cfg.get("host", "127.0.0.1"), cfg["port"])
+            self.log.info("Serving metrics on {}:{}".format(cfg.get("host", "127.0.0.1"), cfg["port"]))
+        if cfg.get("file"):
+            self.background_tasks.append(
+                asyncio.ensure_future(metrics.write_periodically(cfg["file"], cfg.get("interval", 15))))
+
+    async def log_receiver_stats(self, interval=300):
+        """
+        Periodically log the signal receivers that took the most time.
+        """
+        while True:
+            await asyncio.sleep(interval)
+            for entry in signals.receiver_stats()[:10]:
+                self.log.info("{receiver}: {calls} calls, {total:.3f}s total, {max:.4f}s max".format(**entry))
+
+    async def timed(self, phase, coro):
+        """
+        Await coro and record how long it took as a startup phase.
+        """
+        started = time.monotonic()
+        try:
+            return await coro
+        finally:
+            self.startup_phases[phase] = time.monotonic() - started
+
+    async def connect_lobby(self):
+        spring.LobbyProtocol.chat_backlog = self.cfg["lobby"].get("chat_backlog", 100)
         self.lobby_client = await spring.connect(self.cfg["lobby"]["host"], port=self.cfg["lobby"]["port"])
+        self.lobby_client.on("said")(self.on_lobby_said)
+        self.lobby_client.on("saidex")(self.on_lobby_saidex)
+        self.lobby_client.on("reconnected")(self.on_lobby_reconnected)
+        addressed.register_command_character(self.cfg["lobby"].get("command_character", "!"))
+        addressed.register_command("who", self.on_who_command)
+        addressed.register_command("lag", self.on_lag_command)
+
+        # Channels are joined as soon as the server accepts the login.
+        self.lobby_client.channels_to_join.extend("#{}".format(lobby_room) for lobby_room in self.cfg["rooms"])
+        self.lobby_client.login(self.cfg["lobby"]["username"], self.cfg["lobby"]["pwd"])
 
-        self.matrix_client = MatrixClient(self.cfg["matrix"]["host"])
+    async def resume_session(self):
+        """
+        Reuse the access token and sync token from the state file if they
+        belong to the configured account and the homeserver still accepts
+        the token.
+        """
+        state = self.session.load()
+        if (not state.get("access_token") or state.get("homeserver") != self.cfg["matrix"]["host"]
+                or state.get("username") != self.cfg["matrix"]["username"]):
+            return False
+
+        self.matrix_client.token = state["access_token"]
+        self.matrix_client.device_id = state.get("device_id")
+        try:
+            await self.matrix_client.whoami()
+        except MatrixRequestError as e:
+            if e.code != 401:
+                raise
+            self.log.info("Stored Matrix session was rejected, logging in again.")
+            self.matrix_client.token = None
+            self.session.discard("access_token", "next_batch")
+            return False
 
+        self.matrix_client.sync_token = state.get("next_batch")
+        return True
+
+    def on_matrix_sync(self, response):
+        self.session.update(next_batch=response["next_batch"])
+
+    async def login_matrix(self):
         try:
-            self.matrix_client.login(self.cfg["matrix"]["username"], self.cfg["matrix"]["pwd"], sync=True)
+            if self.session is not None and await self.resume_session():
+                self.resumed = True
+                self.log.info("Resumed Matrix session as {}".format(self.matrix_client.user_id))
+                return
+
+            device_id = self.session.data.get("device_id") if self.session is not None else None
+            await self.matrix_client.login(self.cfg["matrix"]["username"], self.cfg["matrix"]["pwd"], device_id)
+            if self.session is not None:
+                self.session.data = {
+                    "homeserver": self.cfg["matrix"]["host"],
+                    "username": self.cfg["matrix"]["username"],
+                    "user_id": self.matrix_client.user_id,
+                    "access_token": self.matrix_client.token,
+                    "device_id": self.matrix_client.device_id,
+                }
+                self.session.save()
 
         except MatrixRequestError as e:
             self.log.debug(e)
@@ -102,36 +359,139 @@ class Glenda:
                 self.log.error("Check your sever details are correct.")
                 sys.exit(2)
 
-        except MissingSchema as e:
+        except MatrixHttpError as e:
             self.log.error("Bad URL format.")
             self.log.error(e)
             sys.exit(3)
 
-        for lobby_room, matrix_room in self.cfg["rooms"].items():
-            self.setup_bridge(lobby_room, matrix_room)
-
-        self.lobby_client.login(self.cfg["lobby"]["username"], self.cfg["lobby"]["pwd"])
+        except OSError as e:
+            self.log.error("Could not write state file: {}".format(e))
+            sys.exit(5)
+
+    def sync_filter(self):
+        """
+        Sync only the bridged rooms' messages and the memberships needed for
+        display names; no presence, typing, receipts or account data.
+        """
+        return {
+            "account_data": {"not_types": ["*"]},
+            "presence": {"not_types": ["*"]},
+            "event_fields": ["type", "sender", "content", "state_key", "event_id"],
+            "room": {
+                "rooms": sorted(self.matrix_rooms),
+                "timeline": {"types": ["m.room.message", "m.room.member"], "limit": 50},
+                "state": {"types": ["m.room.member"], "lazy_load_members": True},
+                "ephemeral": {"not_types": ["*"]},
+                "account_data": {"not_types": ["*"]},
+            },
+        }
+
+    async def register_sync_filter(self):
+        """
+        Upload sync_filter(), unless the state file has the ID of an identical
+        filter of the same user.
+        """
+        definition = self.sync_filter()
+        digest = hashlib.sha1(json.dumps([self.matrix_client.user_id, definition], sort_keys=True).encode()).hexdigest()
+        if self.session is not None and self.session.data.get("filter_hash") == digest:
+            self.sync_filter_id = self.session.data["filter_id"]
+            return
 
         try:
-            self.matrix_client.login(self.cfg["matrix"]["username"], self.cfg["matrix"]["pwd"], sync=True)
+            self.sync_filter_id = await self.matrix_client.create_filter(definition)
+        except (MatrixRequestError, MatrixHttpError) as e:
+            self.log.warning("Could not create a sync filter, syncing everything: {}".format(e))
+            return
+        if self.session is not None:
+            self.session.update(filter_id=self.sync_filter_id, filter_hash=digest)
+
+    async def setup_matrix(self):
+        """
+        Log in once, or resume the stored session, then join every bridged
+        room at the same time.
+        """
+        await self.timed("matrix login", self.login_matrix())
+        await self.timed("room joins", asyncio.gather(
+            *(self.setup_bridge(lobby_room, matrix_room) for lobby_room, matrix_room in self.cfg["rooms"].items())))
+        await self.timed("sync filter", self.register_sync_filter())
+        if self.session is not None:
+            self.matrix_client.sync_observer = self.on_matrix_sync
+        if not self.matrix_client.sync_token:
+            # Only relay what is said from now on, not the rooms' history.
+            await self.timed("initial sync", self.matrix_client.sync(timeout_ms=0, filter=self.sync_filter_id,
+                                                                     dispatch=False))
 
-        except MatrixRequestError as e:
-            if e.code == 403:
-                self.log.error("Bad username or password.")
-                sys.exit(4)
-            else:
-                self.log.error("Check your sever details are correct.")
-                sys.exit(2)
+    async def run(self):
+        started = time.monotonic()
+
+        await self.start_metrics()
+
+        if self.cfg["general"].get("fast_dispatch"):
+            signals.enable_fast_send(timing=self.cfg["general"].get("profile_receivers", False))
+            if signals.timings is not None:
+                self.background_tasks.append(asyncio.ensure_future(self.log_receiver_stats()))
 
-        except MissingSchema as e:
+        if self.cfg["lobby"].get("capture"):
+            self.lobby_recorder = Recorder(self.cfg["lobby"]["capture"]).start()
+
+        try:
+            self.matrix_client = AsyncMatrixClient(self.cfg["matrix"]["host"])
+        except ValueError as e:
             self.log.error("Bad URL format.")
-            self.log.debug(e)
+            self.log.error(e)
             sys.exit(3)
-
-        self.matrix_client.start_listener_thread()
+        self.matrix_client.request_observer = self.on_matrix_request
+        self.matrix_outbox = Outbox(self.matrix_client, window=self.cfg["matrix"].get("coalesce_window", 0.25))
+        self.matrix_outbox.delivery_observer = self.on_matrix_delivery
+        await self.start_media()
+
+        # The lobby connection does not depend on anything Matrix does.
+        await asyncio.gather(self.timed("lobby connect", self.connect_lobby()), self.setup_matrix())
+
+        self.matrix_ingress.start()
+        self.matrix_client.start_listener(filter=self.sync_filter_id)
+
+        self.startup_phases["total"] = time.monotonic() - started
+        self.log.info("Started in {:.2f}s ({})".format(self.startup_phases["total"], ", ".join(
+            "{} {:.2f}s".format(phase, seconds) for phase, seconds in self.startup_phases.items() if phase != "total")))
+
+    async def stop(self):
+        """
+        Shut the bridge down: stop relaying, close both connections and the
+        local servers, and write out the session.
+        """
+        if self.matrix_ingress.task is not None:
+            self.background_tasks.append(self.matrix_ingress.task)
+        self.matrix_ingress.stop()
+        self.lobby_outbox.close()
+        for task in self.background_tasks:
+            task.cancel()
+        await asyncio.gather(*self.background_tasks, return_exceptions=True)
+        self.background_tasks = []
+
+        if self.matrix_outbox is not None:
+            await self.matrix_outbox.close()
+        if self.lobby_client is not None:
+            self.lobby_client.protocol.work = False
+            self.lobby_client.transport.close()
+        if self.lobby_recorder is not None:
+            self.lobby_recorder.stop()
+        if self.media_relay is not None:
+            await self.media_relay.stop()
+        if self.metrics_server is not None:
+            self.metrics_server.close()
+            await self.metrics_server.wait_closed()
+            self.metrics_server = None
+        if self.session is not None:
+            self.session.flush()
+        if self.matrix_client is not None:
+            await self.matrix_client.close()
 
 
 def main():
+    logging.basicConfig(filename='glenda.log', level=logging.DEBUG, format=FORMAT)
+    logging.getLogger("aiohttp").setLevel(logging.WARNING)
+
     with open("config.yaml", 'r') as yml_file:
         cfg = yaml.load(yml_file)
 
@@ -144,24 +504,12 @@ def main():
 
     loop.run_until_complete(glenda.run())
 
-    @glenda.lobby_client.on("said")
-    def on_lobby_said(parsed, user, target, text):
-        if user == cfg["lobby"]["username"]:
-            return
-        matrix_room = glenda.lobby_rooms[target]
-        try:
-            matrix_room.send_text("<{}> {}".format(user, text))
-        except MatrixHttpLibError:
-            matrix_room.send_text("<{}> {}".format(user, text))
-
-    @glenda.lobby_client.on("saidex")
-    def on_lobby_saidex(parsed, user, target, text):
-        if user == cfg["lobby"]["username"]:
-            return
-        matrix_room = glenda.lobby_rooms[target]
-        matrix_room.send_emote("<{}> {}".format(user, text))
-
-    loop.run_forever()
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        loop.run_until_complete(glenda.stop())
 
 
 if __name__ == "__main__":
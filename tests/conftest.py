@@ -0,0 +1,17 @@
+import asyncio
+
+import pytest
+
+
+@pytest.fixture
+def run():
+    """
+    Run a coroutine to completion on a fresh event loop.
+    """
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop.run_until_complete
+    loop.run_until_complete(loop.shutdown_asyncgens())
+    loop.close()
+    asyncio.set_event_loop(None)
@@ -0,0 +1,40 @@
+import pytest
+
+from asyncspring.plugins import addressed
+
+
+class Client:
+    nickname = "glenda"
+
+
+class Message:
+    client = Client()
+
+
+@pytest.fixture
+def registry():
+    yield
+    addressed.command_character_registry.clear()
+    addressed.commands.clear()
+    addressed._matchers.clear()
+
+
+def test_commands_are_routed(registry):
+    calls = []
+    addressed.register_command_character("!")
+    addressed.register_command("who", lambda message, **kwargs: calls.append(kwargs))
+
+    for text in ("!who", "glenda: WHO all", "glenda, who", "who", "!what"):
+        addressed.handle_public_messages(Message(), "bob", "main", text)
+    assert [call["args"] for call in calls] == ["", "all", ""]
+
+
+def test_matchers_follow_command_characters(registry):
+    calls = []
+    addressed.register_command("lag", lambda message, **kwargs: calls.append(kwargs["user"]))
+    addressed.handle_public_messages(Message(), "bob", "main", "?lag")
+    addressed.register_command_character("?")
+    addressed.handle_public_messages(Message(), "alice", "main", "?lag")
+    addressed.unregister_command_character("?")
+    addressed.handle_public_messages(Message(), "carol", "main", "?lag")
+    assert calls == ["alice"]
@@ -0,0 +1,29 @@
+from asyncblink import signal
+
+from asyncspring import capture
+
+
+def test_credentials_are_redacted(tmp_path, run):
+    path = str(tmp_path / "lobby.capture")
+
+    async def main():
+        recorder = capture.Recorder(path).start()
+        signal("lobby-send").send("LOGIN glenda c2VjcmV0 3200 * TurBoMatrix 0.1")
+        signal("lobby-send").send("SAY main hello")
+        signal("raw").send(None, text="SAIDPRIVATE bob hi")
+        recorder.stop()
+
+    run(main())
+    records = [(direction, line) for timestamp, direction, line in capture.read(path) if direction != "#"]
+    assert records == [
+        (">", "LOGIN glenda <redacted>"),
+        (">", "SAY main hello"),
+        ("<", "SAIDPRIVATE bob hi"),
+    ]
+
+
+def test_redact_leaves_other_lines_alone():
+    assert capture.redact("REGISTER glenda c2VjcmV0 glenda@example.org") == "REGISTER glenda <redacted>"
+    assert capture.redact("CHANGEPASSWORD old new") == "CHANGEPASSWORD <redacted>"
+    assert capture.redact("LOGIN") == "LOGIN"
+    assert capture.redact("SAY main LOGIN glenda secret") == "SAY main LOGIN glenda secret"
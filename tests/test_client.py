@@ -0,0 +1,148 @@
+import asyncio
+
+import pytest
+
+from asyncmatrix import AsyncMatrixClient, MatrixHttpError, MatrixRequestError, Outbox
+from benchmarks.fakes import FakeHomeserver
+
+
+async def connected(**kwargs):
+    homeserver = await FakeHomeserver(**kwargs).start()
+    return homeserver, AsyncMatrixClient(homeserver.url)
+
+
+def test_login_stores_token_and_device(run):
+    async def main():
+        homeserver, client = await connected()
+        try:
+            await client.login("glenda", "secret", device_id="DEVICE")
+            assert client.token == "bench-glenda"
+            assert client.user_id == "@glenda:bench"
+            assert client.device_id == "DEVICE"
+            assert await client.whoami() == "@glenda:bench"
+        finally:
+            await client.close()
+            await homeserver.close()
+
+    run(main())
+
+
+def test_sync_advances_token_and_dispatches(run):
+    async def main():
+        homeserver, client = await connected()
+        received = []
+        try:
+            await client.login("glenda", "secret")
+            room_id = await client.join_room("#main:bench")
+            client.add_room_listener(room_id, lambda room, event: received.append(event["content"]["body"]))
+
+            await client.sync(timeout_ms=0)
+            first = client.sync_token
+            homeserver.push(room_id, "@alice:bench", "hello")
+            await client.sync(timeout_ms=1000)
+
+            assert client.sync_token != first
+            assert received == ["hello"]
+        finally:
+            await client.close()
+            await homeserver.close()
+
+    run(main())
+
+
+@pytest.mark.parametrize("status", [403, 429, 502])
+def test_error_status_maps_to_request_error(run, status):
+    async def main():
+        homeserver, client = await connected()
+        try:
+            homeserver.errors.append(status)
+            with pytest.raises(MatrixRequestError) as raised:
+                await client.login("glenda", "secret")
+            assert raised.value.code == status
+            assert client.token is None
+        finally:
+            await client.close()
+            await homeserver.close()
+
+    run(main())
+
+
+def test_unreachable_homeserver_is_http_error(run):
+    async def main():
+        homeserver, client = await connected()
+        await homeserver.close()
+        try:
+            with pytest.raises(MatrixHttpError):
+                await client.login("glenda", "secret")
+        finally:
+            await client.close()
+
+    run(main())
+
+
+def test_outbox_retries_rate_limits_and_server_errors_only(run):
+    async def main():
+        homeserver, client = await connected()
+        try:
+            await client.login("glenda", "secret")
+            outbox = Outbox(client, window=0, backoff=0.01)
+            homeserver.errors.extend([429, 503])
+            outbox.send_text("!main", "retried")
+            await homeserver.wait_for(lambda: homeserver.sent, 5)
+            assert outbox.retries == 2 and outbox.sent == 1
+
+            homeserver.errors.append(400)
+            outbox.send_text("!main", "dropped")
+            while outbox.workers:
+                await asyncio.sleep(0.01)
+            assert outbox.failed == 1 and len(homeserver.sent) == 1
+        finally:
+            await client.close()
+            await homeserver.close()
+
+    run(main())
+
+
+def test_outbox_retry_does_not_duplicate_stored_event(run):
+    async def main():
+        homeserver, client = await connected()
+        try:
+            await client.login("glenda", "secret")
+            outbox = Outbox(client, window=0, backoff=0.01)
+            homeserver.lost_replies.append(502)
+            outbox.send_text("!main", "once")
+            while outbox.workers:
+                await asyncio.sleep(0.01)
+            assert outbox.retries == 1 and outbox.sent == 1
+            assert [content["body"] for _, _, content in homeserver.sent] == ["once"]
+        finally:
+            await client.close()
+            await homeserver.close()
+
+    run(main())
+
+
+def test_display_names_are_cached_per_room(run):
+    async def main():
+        homeserver, client = await connected()
+        try:
+            await client.login("glenda", "secret")
+            assert await client.get_display_name("@alice:bench", "!main") == "alice"
+            assert await client.get_display_name("@alice:bench", "!main") == "alice"
+            assert homeserver.member_lookups == 1
+
+            # A membership event from the sync stream replaces the cached name.
+            await client.join_room("!main")
+            homeserver.events.put_nowait(("!main", {
+                "type": "m.room.member", "sender": "@alice:bench", "state_key": "@alice:bench",
+                "content": {"membership": "join", "displayname": "Alice"},
+            }))
+            client.sync_token = "s0"
+            await client.sync(timeout_ms=1000)
+            assert await client.get_display_name("@alice:bench", "!main") == "Alice"
+            assert homeserver.member_lookups == 1
+        finally:
+            await client.close()
+            await homeserver.close()
+
+    run(main())
@@ -0,0 +1,95 @@
+from asyncmatrix.echo import EchoLedger, split_relayed
+from glenda import Glenda
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_split_relayed_takes_the_innermost_author():
+    assert split_relayed("otherbot", "<glenda> <bob> hi") == ("bob", "hi")
+    assert split_relayed("otherbot", "[glenda] <bob>  hi there") == ("bob", "hi there")
+    assert split_relayed("alice", "<3 you") == ("alice", "<3 you")
+    assert split_relayed("alice", "<bob>") == ("alice", "<bob>")
+
+
+def test_only_prefixed_repeats_are_echoes():
+    ledger = EchoLedger()
+    ledger.record("main", "bob", "hi")
+    assert ledger.is_echo("main", "otherbot", "<glenda> <bob> hi")
+    assert ledger.is_echo("main", "otherbot", "<BOB>   HI")
+    # People repeating themselves, or others, are let through.
+    assert not ledger.is_echo("main", "bob", "hi")
+    assert not ledger.is_echo("main", "alice", "hi")
+    assert not ledger.is_echo("dev", "otherbot", "<bob> hi")
+    assert not ledger.is_echo("main", "otherbot", "<alice> hi")
+    assert ledger.stats()["suppressed"] == 2
+
+
+def test_echoes_expire_after_the_window():
+    clock = Clock()
+    ledger = EchoLedger(window=30, clock=clock)
+    ledger.record("main", "bob", "hi")
+    clock.now = 30
+    assert ledger.is_echo("main", "otherbot", "<bob> hi")
+    clock.now = 31
+    assert not ledger.is_echo("main", "otherbot", "<bob> hi")
+
+
+def test_eviction_keeps_a_newer_duplicate():
+    clock = Clock()
+    ledger = EchoLedger(size=2, clock=clock)
+    ledger.record("main", "bob", "hi")
+    clock.now = 1
+    ledger.record("main", "bob", "hi")
+    clock.now = 2
+    # Overwrites the first "hi"; the second must still be known.
+    ledger.record("main", "bob", "bye")
+    assert ledger.is_echo("main", "otherbot", "<bob> hi")
+    ledger.record("main", "alice", "yo")
+    assert not ledger.is_echo("main", "otherbot", "<bob> hi")
+    assert ledger.stats()["entries"] == 2
+
+
+class Client:
+    async def get_display_name(self, user_id, room_id=None):
+        return user_id[1:].split(":", 1)[0]
+
+
+class Outbox:
+    def __init__(self):
+        self.added = []
+
+    def add(self, channel, sender, text, emote=False, origin=None):
+        self.added.append((channel, sender, text))
+
+
+def bridge():
+    glenda = Glenda.__new__(Glenda)
+    glenda.cfg = {"matrix": {"userid": "glenda", "domain": "bench"}, "lobby": {}}
+    glenda.matrix_rooms = {"!main": "main"}
+    glenda.matrix_client = Client()
+    glenda.echoes = EchoLedger()
+    glenda.lobby_outbox = Outbox()
+    return glenda
+
+
+def message(sender, body):
+    return {"type": "m.room.message", "room_id": "!main", "sender": sender,
+            "content": {"msgtype": "m.text", "body": body}}
+
+
+def test_merged_matrix_body_is_dropped_only_if_every_line_is_an_echo(run):
+    glenda = bridge()
+    glenda.echoes.record("main", "bob", "one")
+    glenda.echoes.record("main", "alice", "two")
+
+    run(glenda.on_room_message("!main", message("@relay:bench", "<bob> one\n\n<alice> two")))
+    assert glenda.lobby_outbox.added == []
+
+    run(glenda.on_room_message("!main", message("@relay:bench", "<bob> one\n<carol> new")))
+    assert glenda.lobby_outbox.added == [("main", "relay", "<bob> one\n<carol> new")]
@@ -0,0 +1,24 @@
+from asyncspring.framer import LineFramer
+
+
+def test_lines_split_across_reads():
+    framer = LineFramer()
+    assert framer.feed(b"PING\r\nSAID main bob h") == ["PING"]
+    assert framer.feed("éllo\nPONG\n".encode("utf-8")[:1]) == []
+    assert framer.feed("éllo\nPONG\n".encode("utf-8")[1:]) == ["SAID main bob héllo", "PONG"]
+
+
+def test_limit_is_in_bytes_for_complete_lines():
+    framer = LineFramer(max_line_length=10)
+    # 6 characters but 12 bytes
+    assert framer.feed("éééééé\nshort\n".encode("utf-8")) == ["short"]
+    assert framer.overflows == 1
+    assert framer.feed("ééééé\n".encode("utf-8")) == ["ééééé"]
+
+
+def test_limit_is_in_bytes_for_buffered_lines():
+    framer = LineFramer(max_line_length=10)
+    assert framer.feed("éééééé".encode("utf-8")) == []
+    assert framer.overflows == 1
+    assert framer.feed(b"tail\nnext\n") == ["next"]
+    assert framer.overflows == 1
@@ -0,0 +1,53 @@
+import asyncio
+import time
+
+from asyncspring import spring
+
+
+class Transport:
+    def __init__(self):
+        self.written = []
+
+    def writelines(self, data):
+        self.written.extend(data)
+
+    def close(self):
+        pass
+
+
+class Closed:
+    """
+    Rate limiter that lets nothing through until opened.
+    """
+
+    open = False
+
+    def consume(self):
+        return self.open
+
+    def delay(self):
+        return 3600
+
+    def adapt(self, lag):
+        pass
+
+
+def test_ping_is_stamped_when_written_not_when_queued():
+    asyncio.set_event_loop(spring.loop)
+    protocol = spring.LobbyProtocol()
+    protocol.connection_made(Transport())
+    protocol.rate_limiter = Closed()
+    try:
+        protocol.writeln("PING")
+        protocol.process_queue()
+        assert protocol.transport.written == []
+        assert protocol.last_ping == float("inf")
+
+        protocol.rate_limiter.open = True
+        protocol.process_queue()
+        assert protocol.transport.written == [b"PING\r\n"]
+        assert time.time() - protocol.last_ping < 1
+    finally:
+        protocol.work = False
+        if protocol._queue_handle is not None:
+            protocol._queue_handle.cancel()
@@ -0,0 +1,36 @@
+import asyncio
+
+from asyncmatrix.ingress import DROP_NEWEST, DROP_OLDEST, Ingress
+from asyncspring import metrics
+
+
+def test_drop_oldest_keeps_newest_items(run):
+    handled = []
+
+    async def main():
+        ingress = Ingress(handled.append, maxsize=2, policy=DROP_OLDEST, name="test-oldest")
+        for i in range(5):
+            await ingress.put(i)
+        ingress.start()
+        while len(ingress):
+            await asyncio.sleep(0)
+        ingress.stop()
+        return ingress
+
+    ingress = run(main())
+    assert handled == [3, 4]
+    assert ingress.stats()["dropped_oldest"] == 3
+
+
+def test_counters_are_exported(run):
+    async def main():
+        ingress = Ingress(lambda item: None, maxsize=1, policy=DROP_NEWEST, name="test-newest")
+        await ingress.put(1)
+        await ingress.put(2)
+        return ingress
+
+    ingress = run(main())
+    text = metrics.render()
+    assert 'asyncmatrix_ingress_dropped_total{ingress="test-newest",dropped="newest"} 1' in text
+    assert 'asyncmatrix_ingress_depth{ingress="test-newest"} 1' in text
+    del ingress
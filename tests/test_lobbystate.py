@@ -0,0 +1,46 @@
+from asyncspring import dispatch
+from asyncspring.parser import LobbyMessage
+from asyncspring.plugins import lobbystate
+
+
+class Client:
+    netid = "test"
+
+
+def feed(client, line):
+    message = LobbyMessage.from_message(line)
+    message.client = client
+    getattr(lobbystate, "handle_" + message.verb.lower())(message)
+
+
+def test_membership_and_status():
+    client = Client()
+    lobbystate.create_state(client)
+    feed(client, "ADDUSER bob DE 123")
+    feed(client, "CLIENTS main bob alice")
+    feed(client, "LEFT main alice")
+    feed(client, "CLIENTSTATUS bob 3")
+
+    assert client.lobby_state.who("#main") == ["bob"]
+    bob = client.lobby_state.users["bob"]
+    assert bob.in_game and bob.away and bob.channels == {"main"}
+
+
+def test_malformed_clientstatus_is_ignored():
+    client = Client()
+    lobbystate.create_state(client)
+    feed(client, "ADDUSER bob DE 123")
+    feed(client, "CLIENTSTATUS bob")
+    feed(client, "CLIENTSTATUS bob away")
+    feed(client, "CLIENTSTATUS")
+    assert client.lobby_state.users["bob"].status == 0
+
+
+def test_clientstatus_is_only_handled_when_tracked():
+    assert not dispatch.wants("CLIENTSTATUS")
+    lobbystate.track_status()
+    try:
+        assert dispatch.wants("CLIENTSTATUS")
+    finally:
+        lobbystate.track_status(False)
+    assert not dispatch.wants("CLIENTSTATUS")
@@ -0,0 +1,112 @@
+import asyncio
+
+import aiohttp
+import pytest
+
+from asyncmatrix import AsyncMatrixClient
+from asyncmatrix.media import MediaCache, MediaRelay
+from benchmarks.fakes import FakeHomeserver
+
+
+async def relay_for(tmp_path, **kwargs):
+    homeserver = await FakeHomeserver().start()
+    client = AsyncMatrixClient(homeserver.url)
+    relay = MediaRelay(client, MediaCache(str(tmp_path)), "http://relay", **kwargs)
+    return homeserver, client, relay
+
+
+def test_concurrent_fetches_share_one_download(tmp_path, run):
+    async def main():
+        homeserver, client, relay = await relay_for(tmp_path)
+        try:
+            first = relay.link(homeserver.upload(b"x" * 100, "image/png")).rsplit("/", 1)[1]
+            second = relay.link(homeserver.upload(b"x" * 100, "image/png")).rsplit("/", 1)[1]
+            results = await asyncio.gather(*(relay.fetch(first) for _ in range(5)))
+            await relay.fetch(second)
+            assert homeserver.downloads == 2
+            assert len({path for path, content_type in results}) == 1
+            # Identical content is stored once.
+            assert len(relay.cache) == 1
+        finally:
+            await client.close()
+            await homeserver.close()
+
+    run(main())
+
+
+def test_large_files_are_refused_before_reading(tmp_path, run):
+    async def main():
+        homeserver, client, relay = await relay_for(tmp_path, max_file_bytes=1000)
+        try:
+            token = relay.link(homeserver.upload(b"x" * 5000)).rsplit("/", 1)[1]
+            with pytest.raises(ValueError):
+                await relay.fetch(token)
+            assert len(relay.cache) == 0
+        finally:
+            await client.close()
+            await homeserver.close()
+
+    run(main())
+
+
+def test_only_safe_types_are_served_inline(tmp_path, run):
+    async def main():
+        homeserver, client, relay = await relay_for(tmp_path)
+        await relay.start("127.0.0.1", 0)
+        port = relay._runner.addresses[0][1]
+        try:
+            html = relay.link(homeserver.upload(b"<script>alert(1)</script>", "text/html"))
+            png = relay.link(homeserver.upload(b"\x89PNG", "image/png"))
+            async with aiohttp.ClientSession() as session:
+                async with session.get("http://127.0.0.1:{}/m/{}".format(port, html.rsplit("/", 1)[1])) as response:
+                    assert response.headers["Content-Type"] == "application/octet-stream"
+                    assert response.headers["Content-Disposition"] == "attachment"
+                    assert response.headers["X-Content-Type-Options"] == "nosniff"
+                async with session.get("http://127.0.0.1:{}/m/{}".format(port, png.rsplit("/", 1)[1])) as response:
+                    assert response.headers["Content-Type"] == "image/png"
+                    assert "Content-Disposition" not in response.headers
+                async with session.get("http://127.0.0.1:{}/m/unknown".format(port)) as response:
+                    assert response.status == 404
+        finally:
+            await relay.stop()
+            await client.close()
+            await homeserver.close()
+
+    run(main())
+
+
+def test_cache_evicts_least_recently_used(tmp_path, run):
+    async def main():
+        cache = MediaCache(str(tmp_path), max_bytes=250)
+        first = await cache.put(b"a" * 100)
+        second = await cache.put(b"b" * 100)
+        cache.get(first)
+        await cache.put(b"c" * 100)
+        assert cache.get(first) is not None
+        assert cache.get(second) is None
+        assert not (tmp_path / second).exists()
+
+    run(main())
+
+
+def test_links_survive_a_restart_and_bad_uris_are_refused(tmp_path, run):
+    async def main():
+        homeserver, client, relay = await relay_for(tmp_path)
+        try:
+            mxc_url = homeserver.upload(b"x" * 100, "image/png")
+            link = relay.link(mxc_url)
+            for bad in ("mxc://bench/abc\tmxc://evil/x", "mxc://bench/abc\nxyz", "https://bench/abc"):
+                with pytest.raises(ValueError):
+                    relay.link(bad)
+            await relay.stop()
+            with open(relay.index_path, "a") as f:
+                f.write("forged\tmxc://evil/x\t-\t-\n")
+
+            reloaded = MediaRelay(client, MediaCache(str(tmp_path)), "http://relay")
+            assert list(reloaded.links) == [link.rsplit("/", 1)[1]]
+            assert reloaded.links[link.rsplit("/", 1)[1]][0] == mxc_url
+        finally:
+            await client.close()
+            await homeserver.close()
+
+    run(main())
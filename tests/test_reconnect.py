@@ -0,0 +1,63 @@
+import asyncio
+
+from asyncspring import spring
+from asyncspring.scheduler import PRIORITY_CHAT, SendQueue
+
+
+class Transport:
+    def writelines(self, data):
+        pass
+
+    def close(self):
+        pass
+
+
+def test_drain_keeps_origins():
+    queue = SendQueue()
+    queue.push("SAY main <alice> hi", origin=("main", 1.0))
+    queue.push("PING")
+    queue.push("SAY main <alice> there", origin=("main", 1.0), continued=True)
+    assert queue.drain() == [("PING", 0, None, False), ("SAY main <alice> hi", PRIORITY_CHAT, ("main", 1.0), False),
+                             ("SAY main <alice> there", PRIORITY_CHAT, ("main", 1.0), True)]
+
+
+def test_leave_survives_reconnect():
+    asyncio.set_event_loop(spring.loop)
+    protocol = spring.LobbyProtocol()
+    protocol.connection_made(Transport())
+    try:
+        protocol.channels_to_join.extend(["#main", "#dev"])
+        protocol.join("#games")
+        protocol.leave("dev")
+        assert protocol.channels_to_join == ["#main", "#games"]
+    finally:
+        protocol.work = False
+        if protocol._queue_handle is not None:
+            protocol._queue_handle.cancel()
+
+
+def test_chat_waits_for_login():
+    asyncio.set_event_loop(spring.loop)
+    transport = Transport()
+    written = []
+    transport.writelines = lambda data: written.extend(line.decode().rstrip("\r\n") for line in data)
+    protocol = spring.LobbyProtocol()
+    protocol.connection_made(transport)
+    try:
+        protocol.carried = [("SAY main <alice> before", None, False)]
+        protocol.say("main", "<bob> after")
+        protocol.writeln("PONG")
+        spring.loop.run_until_complete(asyncio.sleep(0.01))
+        assert written == ["PONG"]
+
+        protocol.data_received(b"ACCEPTED glenda\n")
+        spring.loop.run_until_complete(asyncio.sleep(0.01))
+        assert [line for line in written if line != "PING"] == ["PONG", "SAY main <alice> before",
+                                                                "SAY main <bob> after"]
+    finally:
+        protocol.work = False
+        protocol.heartbeat.stop()
+        if protocol.login_handle is not None:
+            protocol.login_handle.cancel()
+        if protocol._queue_handle is not None:
+            protocol._queue_handle.cancel()
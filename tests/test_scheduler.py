@@ -0,0 +1,71 @@
+from asyncspring.scheduler import FairQueue, SendQueue
+
+
+def lines(queue):
+    sent = []
+    while queue:
+        sent.append(queue.pop()[0])
+    return sent
+
+
+def test_sheds_whole_messages():
+    queue = SendQueue(chat_backlog=3)
+    queue.push("SAY main <alice> one")
+    queue.push("SAY main <bob> long 1")
+    queue.push("SAY main <bob> long 2", continued=True)
+    queue.push("SAY main <carol> two")
+    queue.push("SAY main <dave> three")
+    assert lines(queue) == ["SAYEX main dropped 2 messages to keep up", "SAY main <carol> two",
+                            "SAY main <dave> three"]
+    assert queue.stats()["shed"] == 3
+
+
+def test_message_longer_than_backlog_is_shed_whole():
+    queue = SendQueue(chat_backlog=2)
+    queue.push("SAY main <alice> one")
+    queue.push("SAY main <bob> long 1")
+    queue.push("SAY main <bob> long 2", continued=True)
+    queue.push("SAY main <bob> long 3", continued=True)
+    queue.push("SAY main <carol> two")
+    assert lines(queue) == ["SAYEX main dropped 2 messages to keep up", "SAY main <carol> two"]
+
+
+def test_message_in_flight_is_not_cut():
+    queue = FairQueue(limit=2)
+    queue.append(("SAY main <bob> long 1", 0, None))
+    queue.append(("SAY main <bob> long 2", 0, None), continued=True)
+    assert queue.popleft()[0] == "SAY main <bob> long 1"
+    queue.append(("SAY main <alice> one", 0, None))
+    queue.append(("SAY main <carol> two", 0, None))
+    sent = [queue.popleft()[0] for _ in range(len(queue))]
+    assert sent == ["SAY main <bob> long 2", "SAYEX main dropped 1 messages to keep up", "SAY main <carol> two"]
+
+
+def test_takes_turns_between_channels():
+    queue = SendQueue()
+    queue.push("SAY main <alice> 1")
+    queue.push("SAY main <alice> 2", continued=True)
+    queue.push("SAY dev <bob> 1")
+    assert lines(queue) == ["SAY main <alice> 1", "SAY dev <bob> 1", "SAY main <alice> 2"]
+
+
+def test_drained_messages_are_shed_whole_when_pushed_again():
+    old = SendQueue()
+    old.push("SAY main <bob> long 1")
+    old.push("SAY main <bob> long 2", continued=True)
+    queue = SendQueue(chat_backlog=2)
+    for line, priority, origin, continued in old.drain():
+        queue.push(line, priority, origin, continued)
+    queue.push("SAY main <carol> two")
+    assert lines(queue) == ["SAYEX main dropped 1 messages to keep up", "SAY main <carol> two"]
+
+
+def test_notice_follows_the_end_of_a_message_in_flight():
+    queue = FairQueue(limit=2)
+    queue.append(("SAY main <bob> long 1", 0, None))
+    queue.append(("SAY main <bob> long 2", 0, None), continued=True)
+    assert queue.popleft()[0] == "SAY main <bob> long 1"
+    queue.limit = 1
+    queue.append(("SAY main <alice> one", 0, None))
+    sent = [queue.popleft()[0] for _ in range(len(queue))]
+    assert sent == ["SAY main <bob> long 2", "SAYEX main dropped 1 messages to keep up"]
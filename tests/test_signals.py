@@ -0,0 +1,56 @@
+import pytest
+from asyncblink import signal
+
+from asyncspring import signals
+
+
+@pytest.fixture
+def fast():
+    signals.enable_fast_send()
+    yield
+    signals.disable_fast_send()
+
+
+def test_fast_send_reaches_new_receivers(fast):
+    sig = signal("test-fast-send")
+    seen = []
+
+    def first(sender, **kwargs):
+        seen.append(("first", kwargs["text"]))
+
+    def second(sender, **kwargs):
+        seen.append(("second", kwargs["text"]))
+
+    sig.connect(first)
+    signals.send(sig, None, text="a")
+    sig.connect(second)
+    signals.send(sig, None, text="b")
+    assert seen == [("first", "a"), ("first", "b"), ("second", "b")]
+
+
+def test_sender_bound_receivers_use_signal_send(fast):
+    sig = signal("test-sender-bound")
+    seen = []
+
+    def bound(sender, **kwargs):
+        seen.append(sender)
+
+    sender = object()
+    sig.connect(bound, sender=sender)
+    signals.send(sig, object())
+    signals.send(sig, sender)
+    assert seen == [sender]
+
+
+def test_missing_blinker_internals_fall_back(fast, monkeypatch):
+    monkeypatch.setattr(signals, "ANY_ID", None)
+    sig = signal("test-fallback")
+    seen = []
+
+    def receiver(sender, **kwargs):
+        seen.append(kwargs)
+
+    sig.connect(receiver)
+    signals.send(sig, None, n=1)
+    assert seen == [{"n": 1}]
+    assert signals._receivers[sig][1] is None
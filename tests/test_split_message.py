@@ -0,0 +1,55 @@
+import pytest
+
+from asyncspring.spring import split_message
+
+PREFIX = b"SAY main "
+
+
+def split(message, limit=50, prefix=PREFIX):
+    lines = list(split_message(prefix, message, limit))
+    for line in lines:
+        assert len(line) <= limit
+        assert line.startswith(prefix)
+        line.decode("utf-8")
+    return [line[len(prefix):].decode("utf-8") for line in lines]
+
+
+def joined(pieces):
+    # Cuts at a space drop that space.
+    return "".join(pieces).replace(" ", "")
+
+
+def test_short_message_is_one_line():
+    assert split("hello there") == ["hello there"]
+
+
+def test_cuts_at_the_last_space():
+    pieces = split("word " * 30)
+    assert all(not piece.startswith(" ") for piece in pieces)
+    assert joined(pieces) == "word" * 30
+
+
+def test_prefix_counts_towards_the_limit():
+    message = "x" * 100
+    assert [len(piece) for piece in split(message, limit=50)] == [41, 41, 18]
+    assert [len(piece) for piece in split(message, limit=50, prefix=b"SAYPRIVATE someone ")] == [31, 31, 31, 7]
+
+
+def test_no_spaces_is_cut_at_the_limit():
+    pieces = split("a" * 200)
+    assert len(pieces[0].encode()) == 50 - len(PREFIX)
+    assert "".join(pieces) == "a" * 200
+
+
+@pytest.mark.parametrize("char", ["é", "€", "😀"])
+def test_multibyte_characters_are_never_cut(char):
+    message = "a" + char * 60
+    pieces = split(message)
+    assert "".join(pieces) == message
+    assert all(50 - len(PREFIX) - len(char.encode()) < len(piece.encode()) for piece in pieces[:-1])
+
+
+def test_emoji_with_spaces():
+    message = " ".join(["😀😀😀"] * 20)
+    pieces = split(message)
+    assert joined(pieces) == message.replace(" ", "")